@@ -0,0 +1,49 @@
+"""Helpers shared by the benchmarks: offline NiceGUI clients, outbox sizes and synthetic fee schedules.
+
+Importing this module puts the repository root on sys.path, so the benchmarks can import main.
+"""
+import asyncio
+import json
+import os
+import sys
+
+import pandas as pd
+from nicegui import Client, core
+from nicegui.page import page
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def offline_client():
+    """A client for building the app's tabs without a server"""
+    core.loop = asyncio.new_event_loop()  # lets run_javascript queue messages without a server
+    return Client(page("/"), request=None)
+
+
+def run_handler(client, coroutine):
+    """Run an async event handler to completion in the client's context, as the server does (notifications need it)"""
+    async def handler():
+        with client:
+            return await coroutine
+    return core.loop.run_until_complete(handler())
+
+
+def outbox_bytes(client, *elements):
+    """Size of the element updates and messages queued for the browser, then clear the outbox"""
+    core.loop.run_until_complete(asyncio.sleep(0))  # let fire-and-forget run_javascript calls enqueue
+    size = sum(len(json.dumps(element._to_dict(), default=str)) for element in elements
+               if element.id in client.outbox.updates)
+    size += sum(len(json.dumps(data, default=str)) for _, _, data in client.outbox.messages)
+    client.outbox.updates.clear()
+    client.outbox.messages.clear()
+    return size
+
+
+def fee_schedule_frame(rng, codes, payers):
+    """A fee schedule of distinct random CPT codes with a price column per payer name"""
+    df = pd.DataFrame({
+        "CPT": [f"{code:05d}" for code in rng.choice(100_000, codes, replace=False)],
+        "Description": [f"Procedure {i}" for i in range(codes)],
+        "Total RVU": rng.uniform(0.1, 30, codes).round(2),
+    })
+    return pd.concat([df, pd.DataFrame(rng.uniform(20, 2000, (codes, len(payers))).round(2), columns=payers)], axis=1)
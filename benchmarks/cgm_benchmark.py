@@ -0,0 +1,87 @@
+"""Processing time of a 90 day CGM export: parsing, time in ranges, AGP bands and the display trace.
+
+Writes a synthetic Dexcom Clarity export (5 minute readings with the usual header rows, a sensor gap and
+Low/High readings) and times analyze_cgm on it, checking the AGP bands against np.percentile per bin and that
+out of range text readings count at each format's sensor limits.
+Run from the repository root: python benchmarks/cgm_benchmark.py
+"""
+import csv
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import _common  # noqa: F401 (puts the repository root on sys.path)
+from main import CGM_AGP_BIN_MINUTES, CGM_AGP_PERCENTILES, analyze_cgm, read_cgm_export
+
+DAYS = 90
+REPEATS = 5
+
+
+def write_dexcom_export(path, days=DAYS):
+    """Dexcom style export with sinusoidal daily glucose and noise"""
+    rng = np.random.default_rng(0)
+    times = np.datetime64("2024-01-01T00:02:31") + np.arange(days * 288) * np.timedelta64(300, "s")
+    minutes = np.arange(days * 288) * 5 % 1440
+    glucose = 130 + 45 * np.sin(minutes / 1440 * 2 * np.pi) + rng.normal(0, 25, len(times))
+    glucose[::1000] += 300  # a few excursions past the sensor ceiling
+    glucose = np.clip(glucose.round(), 30, 420)
+    keep = np.ones(len(times), dtype=bool)
+    keep[5000:5100] = False  # sensor warm up gap
+    with open(path, "w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["Index", "Timestamp (YYYY-MM-DDThh:mm:ss)", "Event Type", "Event Subtype", "Patient Info",
+                         "Device Info", "Source Device ID", "Glucose Value (mg/dL)", "Insulin Value (u)",
+                         "Carb Value (grams)", "Duration (hh:mm:ss)", "Glucose Rate of Change (mg/dL/min)",
+                         "Transmitter Time (Long Integer)", "Transmitter ID"])
+        writer.writerow([1, "", "FirstName", "", "Test", "", "", "", "", "", "", "", "", ""])
+        writer.writerow([2, "", "Device", "", "", "G6 Mobile App", "Android G6", "", "", "", "", "", "", ""])
+        for i, (t, g) in enumerate(zip(times[keep], glucose[keep]), 3):
+            value = "Low" if g < 40 else "High" if g > 400 else int(g)
+            writer.writerow([i, str(t), "EGV", "", "", "", "Android G6", value, "", "", "", "", "", "8XXXXX"])
+
+
+def write_libre_export(path):
+    """LibreView style export with LO/HI historic readings and a scan that repeats one of them"""
+    with open(path, "w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["Glucose Data", "Generated on", "01-02-2024 09:00 UTC", "Generated by", "Test"])
+        writer.writerow(["Device", "Serial Number", "Device Timestamp", "Record Type", "Historic Glucose mg/dL",
+                         "Scan Glucose mg/dL"])
+        for i, (value, record) in enumerate([("120", "0"), ("LO", "0"), ("HI", "0"), ("", "1"), ("180", "0")]):
+            writer.writerow(["FreeStyle Libre 2", "ABC", f"01-01-2024 {i:02d}:00", record, value,
+                             "HI" if record == "1" else ""])
+
+
+def main():
+    path = os.path.join(tempfile.mkdtemp(), "dexcom_export.csv")
+    write_dexcom_export(path)
+
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        metrics = analyze_cgm(path)
+        timings.append(time.perf_counter() - start)
+
+    _, times, glucose = read_cgm_export(path)
+    bins = ((times - times.astype("datetime64[D]")).astype(np.int64) // 60) // CGM_AGP_BIN_MINUTES
+    expected = np.array([np.percentile(glucose[bins == b], CGM_AGP_PERCENTILES) for b in range(len(metrics["agp"]))])
+    print(f"{metrics['readings']} readings over {metrics['days']:.0f} days in {min(timings) * 1000:.0f} ms "
+          f"(best of {REPEATS}), {len(metrics['trace'])} trace points sent")
+    print(f"in range {metrics['ranges'][2]}%, GMI {metrics['gmi']:.1f}%, CV {metrics['cv']:.1f}%, "
+          f"AGP matches np.percentile: {np.allclose(metrics['agp'], expected)}")
+    os.remove(path)
+
+    # Dexcom exports Low/High outside 40-400 mg/dL, Libre LO/HI outside 40-500 mg/dL
+    assert glucose.min() == 40 and glucose.max() == 400
+    path = os.path.join(tempfile.mkdtemp(), "libre_export.csv")
+    write_libre_export(path)
+    name, _, glucose = read_cgm_export(path)
+    assert name == "Libre" and glucose.tolist() == [120, 40, 500, 180], glucose
+    print("text readings at the sensor limits: Dexcom 40/400, Libre 40/500")
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Batch cost estimates for a day's worth of encounters through the /api/cost/estimate pipeline.
+
+Builds a synthetic 2,000 CPT x 20 payer fee schedule and 100,000 encounters of 1 to 6 codes (some with
+modifiers and some self pay), then times parsing the JSON body, the vectorized estimate and serializing the
+streamed CSV. A sample of encounters is checked against pricing them one at a time like the cost tab does.
+Run from the repository root: python benchmarks/cost_batch_benchmark.py
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from _common import fee_schedule_frame
+from main import (FeeSchedule, PaymentReductions, estimate_encounters, is_self_pay, payment_split, read_encounters,
+                  split_cpt_modifiers, stream_estimates)
+
+ENCOUNTERS = 100_000
+CODES = 2_000
+PAYERS = 20
+CHECKED = 500
+
+
+def write_fee_schedule(path, rng):
+    payers = ["Office Self Pay"] + [f"Payer {i}" for i in range(1, PAYERS)]
+    df = fee_schedule_frame(rng, CODES, payers)
+    df.to_csv(path, index=False)
+    return df["CPT"].tolist(), payers
+
+
+def make_encounters(codes, payers, rng):
+    encounters = []
+    for i in range(ENCOUNTERS):
+        lines = [str(code) + ("-59" if rng.random() < 0.1 else "") for code in rng.choice(codes, rng.integers(1, 7))]
+        encounter = {"id": f"E{i}", "payer": payers[rng.integers(PAYERS)], "codes": lines}
+        if rng.random() < 0.8:
+            deductible = float(rng.choice([0, 500, 1500, 3000]))
+            out_of_pocket = float(rng.choice([3000, 6000, 8000]))
+            encounter.update(deductible=deductible, met_deductible=round(float(rng.uniform(0, deductible)), 2),
+                             out_of_pocket=out_of_pocket, met_out_of_pocket=round(float(rng.uniform(0, out_of_pocket)), 2),
+                             coinsurance=float(rng.choice([70, 80, 90])))
+        encounters.append(encounter)
+    return encounters
+
+
+def one_at_a_time(encounter, fees, reductions):
+    """One encounter priced the way the cost tab prices it"""
+    entries = [split_cpt_modifiers(line) for line in encounter["codes"]]
+    codes = [code for code, _ in entries]
+    lines = fees.lookup(codes, encounter["payer"])
+    costs = np.array([price for _, _, price, _ in lines])
+    factors = reductions.factors([0] * len(codes), [encounter["payer"]] * len(codes), codes,
+                                 [modifiers for _, modifiers in entries], [rvu for *_, rvu in lines], costs)
+    cost = sum(costs * factors)
+    if "deductible" not in encounter or is_self_pay(encounter["payer"]):
+        return round(cost, 2), round(cost, 2)
+    patient, _ = payment_split(cost, encounter["deductible"], encounter["met_deductible"], encounter["out_of_pocket"],
+                               encounter["met_out_of_pocket"], encounter["coinsurance"])
+    return round(cost, 2), round(float(patient), 2)
+
+
+def main():
+    rng = np.random.default_rng(0)
+    directory = tempfile.mkdtemp()
+    csv_path = os.path.join(directory, "fee_schedule.csv")
+    codes, payers = write_fee_schedule(csv_path, rng)
+    fees = FeeSchedule.open(csv_path, os.path.join(directory, "fee_schedule_store"))
+    reductions = PaymentReductions({"default": {"exempt_modifiers": ["59"]}})
+    encounters = make_encounters(codes, payers, rng)
+    body = json.dumps(encounters).encode()
+
+    start = time.perf_counter()
+    df = read_encounters(body, "application/json")
+    parsed = time.perf_counter()
+    results = estimate_encounters(df, fees, reductions)
+    estimated = time.perf_counter()
+    streamed = sum(len(chunk) for chunk in stream_estimates(results, as_csv=True))
+    done = time.perf_counter()
+
+    sample = rng.choice(ENCOUNTERS, CHECKED, replace=False)
+    expected = [one_at_a_time(encounters[i], fees, reductions) for i in sample]
+    matches = all(
+        (results["cost"][i], results["patient_payment"][i]) == split for i, split in zip(sample, expected)
+    )
+    print(f"{ENCOUNTERS:,} encounters ({len(body) / 1e6:.1f} MB JSON) in {(done - start) * 1000:.0f} ms: "
+          f"parse {(parsed - start) * 1000:.0f} ms, estimate {(estimated - parsed) * 1000:.0f} ms, "
+          f"CSV {(done - estimated) * 1000:.0f} ms ({streamed / 1e6:.1f} MB)")
+    print(f"{CHECKED} sampled encounters match one at a time pricing: {matches}")
+
+    # Self pay encounters are billed in full even when insurance fields were sent, non-object items are rejected
+    self_pay = (results["payer"] == "Office Self Pay") & df["deductible"].notna()
+    assert self_pay.any() and (results["patient_payment"][self_pay] == results["cost"][self_pay]).all()
+    assert results["insurance_payment"][self_pay].isna().all()
+    try:
+        read_encounters(b'[{"payer": "Office Self Pay", "codes": []}, 1]', "application/json")
+        raise AssertionError("a non-object encounter was accepted")
+    except ValueError:
+        pass
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Open and CPT lookup time of the memory mapped fee schedule store for a large schedule.
+
+Builds a synthetic 15,000 CPT x 200 payer column schedule (payers by contract year), compiles it into the
+columnar store and times opening it and a 20 code estimate against the per-code DataFrame scan the cost
+estimator used to do, and against reading the whole CSV.
+Run from the repository root: python benchmarks/fee_schedule_benchmark.py
+"""
+import os
+import shutil
+import tempfile
+import time
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from _common import fee_schedule_frame
+from main import FeeSchedule
+
+CODES = 15_000
+PAYERS = 200
+ESTIMATE = 20
+
+
+def main():
+    rng = np.random.default_rng(0)
+    payers = [f"Payer {i % 50} {2020 + i // 50}" for i in range(PAYERS)]
+    df = fee_schedule_frame(rng, CODES, payers)
+    codes = df["CPT"].sample(ESTIMATE, random_state=0).tolist() + ["992131"]
+    payer = payers[PAYERS // 2]
+
+    directory = tempfile.mkdtemp()
+    csv_path = os.path.join(directory, "fee_schedule.csv")
+    store = os.path.join(directory, "fee_schedule_store")
+    df.to_csv(csv_path, index=False)
+
+    start = time.perf_counter()
+    FeeSchedule.compile(csv_path, store)
+    compiled = time.perf_counter() - start
+    opened = min(timeit.repeat(lambda: FeeSchedule.open(csv_path, store), number=20, repeat=5)) / 20
+    parsed = min(timeit.repeat(lambda: pd.read_csv(csv_path, dtype={"CPT": str}), number=1, repeat=3))
+    fees = FeeSchedule.open(csv_path, store)
+
+    def store_lookup():
+        unknown = fees.unknown(codes)
+        return unknown, fees.lookup([code for code in codes if code not in unknown], payer)
+
+    def scan():
+        unknown = [code for code in codes if code not in df["CPT"].values]
+        rows = []
+        for code in codes:
+            if code in unknown:
+                continue
+            code_df = df.loc[df["CPT"] == code]
+            rows.append((code, code_df["Description"].values[0], code_df[payer].astype(float).values[0],
+                         code_df["Total RVU"].astype(float).values[0]))
+        return unknown, rows
+
+    assert store_lookup() == scan()
+    print(f"compile once: {compiled * 1000:8.1f} ms, open: {opened * 1000:.2f} ms "
+          f"(reading the CSV: {parsed * 1000:.0f} ms), {PAYERS} payer columns mapped")
+    for name, function, number in (("store lookup", store_lookup, 5_000), ("DataFrame scan", scan, 20)):
+        best = min(timeit.repeat(function, number=number, repeat=5)) / number
+        print(f"{name:>14}: {best * 1e6:10.1f} us per {ESTIMATE} code estimate")
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""Websocket payload per insulin/glucose chart update: full option pushes versus series deltas.
+
+Builds the Insulin & GTT tab on an offline client and serializes what its outbox would send for
+one Generate Plot click, the old way (chart.update() on both charts) and the new way (setData patches).
+Run from the repository root: python benchmarks/highchart_update_benchmark.py
+"""
+from _common import offline_client, outbox_bytes
+from main import InsulinGlucosePlot
+
+LAB_RESULTS = {"i1": "12", "i2": "90", "i3": "110", "i4": "75", "g1": "92", "g2": "160", "g3": "150", "g4": "118"}
+
+
+def main():
+    client = offline_client()
+    with client:
+        plot = InsulinGlucosePlot()
+        plot.InsGlu_UI_Setup()
+        for name, value in LAB_RESULTS.items():
+            getattr(plot, name).value = value
+        charts = [plot.insulin_chart, plot.glucose_chart]
+        outbox_bytes(client, *charts)
+
+        plot.gather_data_ins_glu()
+        delta = outbox_bytes(client, *charts)
+
+        # What the same click used to send: the options were mutated in place and both charts updated
+        plot.insulin_chart.update()
+        plot.glucose_chart.update()
+        full = outbox_bytes(client, *charts)
+
+    print(f"full option update: {full:,} bytes per click")
+    print(f"series delta:       {delta:,} bytes per click ({full / delta:.0f}x smaller)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Event loop responsiveness during concurrent ICD searches against a local stub of the NIH API.
+
+Compares the old blocking requests.get handler with the pooled async ICDApiClient.
+Run from the repository root: python benchmarks/icd_async_benchmark.py
+"""
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import _common  # noqa: F401 (puts the repository root on sys.path)
+from main import ICDApiClient
+
+SEARCHES = 50
+STUB_DELAY = 0.1  # simulated NIH response time in seconds
+TICK = 0.01  # heartbeat interval standing in for UI work on the event loop
+PAYLOAD = json.dumps([1, ["E11.9"], None, [["E11.9", "Type 2 diabetes mellitus without complications"]]]).encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def do_GET(self):
+        time.sleep(STUB_DELAY)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        self.end_headers()
+        self.wfile.write(PAYLOAD)
+
+    def log_message(self, *args):
+        pass
+
+
+async def heartbeat(lags, stop):
+    """Measures how late the event loop wakes up compared to the requested sleep"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def run_scenario(search):
+    lags = []
+    stop = asyncio.Event()
+    beat = asyncio.create_task(heartbeat(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(search(f"term {i}") for i in range(SEARCHES)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+    lags.sort()
+    return elapsed, lags[len(lags) // 2], lags[int(len(lags) * 0.99)], lags[-1]
+
+
+async def main(url):
+    async def blocking_search(term):
+        # What the old sync handler did: the whole loop waits for each response
+        response = requests.get(url, params={"sf": "code,name", "terms": term})
+        return json.loads(response.content)
+
+    client = ICDApiClient(url=url)
+    results = {
+        "blocking requests.get": await run_scenario(blocking_search),
+        "async pooled client": await run_scenario(client.search),
+    }
+    await client.close()
+
+    print(f"{SEARCHES} concurrent searches, stub delay {STUB_DELAY * 1000:.0f} ms, heartbeat every {TICK * 1000:.0f} ms")
+    print(f"{'scenario':<24}{'total (s)':>10}{'lag p50 (ms)':>14}{'lag p99 (ms)':>14}{'lag max (ms)':>14}")
+    for name, (elapsed, p50, p99, worst) in results.items():
+        print(f"{name:<24}{elapsed:>10.2f}{p50 * 1000:>14.1f}{p99 * 1000:>14.1f}{worst * 1000:>14.1f}")
+
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        asyncio.run(main(f"http://127.0.0.1:{server.server_port}/api/icd10cm/v3/search"))
+    finally:
+        server.shutdown()
@@ -0,0 +1,39 @@
+"""Batch throughput of the nearest insulin pattern classifier.
+
+Classifies noisy copies of the Kraft patterns with some missing samples and reports curves per second
+and how often the pattern a curve was generated from is recovered.
+Run from the repository root: python benchmarks/ogtt_classifier_benchmark.py
+"""
+import time
+
+import numpy as np
+
+import _common  # noqa: F401 (puts the repository root on sys.path)
+from main import INSULIN_PATTERNS, insulin_classifier
+
+CURVES = 100_000
+NOISE = 0.25  # log-normal sigma applied to every sample
+MISSING = 0.05  # fraction of samples dropped
+REPEATS = 5
+
+
+def main():
+    rng = np.random.default_rng(0)
+    patterns = np.array(list(INSULIN_PATTERNS.values()), dtype=np.float64)
+    truth = rng.integers(0, len(patterns), CURVES)
+    curves = patterns[truth] * rng.lognormal(0, NOISE, (CURVES, patterns.shape[1]))
+    curves[rng.random(curves.shape) < MISSING] = np.nan
+
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        best, confidence, _ = insulin_classifier.classify(curves)
+        timings.append(time.perf_counter() - start)
+
+    best_time = min(timings)
+    print(f"{CURVES} curves in {best_time * 1000:.1f} ms ({CURVES / best_time:,.0f} curves/s, best of {REPEATS})")
+    print(f"pattern recovered for {np.mean(best == truth):.1%}, mean confidence {np.nanmean(confidence):.2f}")
+
+
+if __name__ == "__main__":
+    main()
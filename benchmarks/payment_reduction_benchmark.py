@@ -0,0 +1,70 @@
+"""Throughput of the multiple procedure payment reduction engine on a batch of encounters.
+
+Builds 10,000 synthetic claims of 1 to 12 lines across payers with different ladders, exempt codes and an
+exempt modifier, times PaymentReductions.factors on the whole batch and checks it against ranking each
+claim in a per-claim pandas loop. Also checks that a second CPT code on a line is rejected, not taken as a modifier.
+Run from the repository root: python benchmarks/payment_reduction_benchmark.py
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+import _common  # noqa: F401 (puts the repository root on sys.path)
+from main import PaymentReductions, split_cpt_modifiers
+
+CLAIMS = 10_000
+RULES = {
+    "default": {"ladder": [1.0, 0.5], "exempt_codes": ["36415", "85025"], "exempt_modifiers": ["79"]},
+    "payers": {"Insurance B": {"ladder": [1.0, 0.5, 0.5, 0.25]}, "Office Self Pay": {"ladder": [1.0]}},
+}
+REPEATS = 5
+
+
+def per_claim(reductions, df):
+    """Reference: rank every claim's lines one claim at a time"""
+    factors = pd.Series(1.0, index=df.index)
+    for _, claim in df.groupby("claim"):
+        rules = reductions.rules(claim["payer"].iloc[0])
+        exempt = claim["code"].isin(rules["exempt_codes"]) | claim["modifiers"].map(
+            lambda modifiers, rules=rules: any(modifier in rules["exempt_modifiers"] for modifier in modifiers))
+        ranked = claim[~exempt].sort_values(["rvu", "cost"], ascending=False, kind="stable")
+        ladder = rules["ladder"]
+        factors[ranked.index] = [ladder[min(rank, len(ladder) - 1)] for rank in range(len(ranked))]
+    return factors.to_numpy()
+
+
+def main():
+    rng = np.random.default_rng(0)
+    sizes = rng.integers(1, 13, CLAIMS)
+    claims = np.repeat(np.arange(CLAIMS), sizes)
+    payers = np.array(["Office Self Pay", "Insurance A", "Insurance B"], dtype=object)[rng.integers(0, 3, CLAIMS)][claims]
+    codes = np.array(["99213", "20610", "11042", "36415", "85025", "17000"], dtype=object)[rng.integers(0, 6, len(claims))]
+    modifiers = [("79",) if hit else () for hit in rng.random(len(claims)) < 0.05]
+    rvus = rng.uniform(0.1, 10, len(claims)).round(1)
+    costs = (rvus * 35).round(2)
+    reductions = PaymentReductions(RULES)
+    assert split_cpt_modifiers("20610-59 rt") == ("20610", ("59", "RT"))
+    for line in ("99213, 20610", "99213 20610-59", "20610-5"):
+        try:
+            split_cpt_modifiers(line)
+        except ValueError:
+            continue
+        raise AssertionError(f"{line!r} was accepted as a code with modifiers")
+
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        factors = reductions.factors(claims, payers, codes, modifiers, rvus, costs)
+        timings.append(time.perf_counter() - start)
+
+    df = pd.DataFrame({"claim": claims, "payer": payers, "code": codes, "modifiers": modifiers, "rvu": rvus, "cost": costs})
+    start = time.perf_counter()
+    expected = per_claim(reductions, df)
+    looped = time.perf_counter() - start
+    print(f"{CLAIMS:,} claims ({len(claims):,} lines) in {min(timings) * 1000:.1f} ms (best of {REPEATS}), "
+          f"per-claim loop {looped * 1000:.0f} ms, matches: {np.allclose(factors, expected)}")
+
+
+if __name__ == "__main__":
+    main()
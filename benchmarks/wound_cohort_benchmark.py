@@ -0,0 +1,52 @@
+"""Clinic wide wound healing scoring time.
+
+Writes a synthetic clinic measurement CSV (weekly visits per wound, some healing, some stalled, some closed)
+and times process_wound_cohort on it.
+Run from the repository root: python benchmarks/wound_cohort_benchmark.py
+"""
+import io
+import time
+
+import numpy as np
+import pandas as pd
+
+import _common  # noqa: F401 (puts the repository root on sys.path)
+from main import process_wound_cohort
+
+WOUNDS = 10_000
+VISITS = 8
+REPEATS = 5
+
+
+def clinic_csv():
+    """Weekly measurements with log-linear healing at a random rate per wound"""
+    rng = np.random.default_rng(0)
+    wound = np.repeat(np.arange(WOUNDS), VISITS)
+    visit = np.tile(np.arange(VISITS), WOUNDS)
+    days = visit * 7 + rng.integers(0, 3, len(wound))
+    rate = rng.uniform(-0.01, 0.06, WOUNDS)[wound]
+    area = rng.uniform(1, 20, WOUNDS)[wound] * np.exp(-rate * days) * rng.lognormal(0, 0.05, len(wound))
+    area[(wound % 25 == 0) & (visit == VISITS - 1)] = 0
+    side = np.sqrt(area).round(2)
+    return pd.DataFrame({
+        "patient_id": (wound // 2).astype(str),
+        "wound_id": (wound % 2).astype(str),
+        "date": np.datetime64("2024-01-01") + days.astype("timedelta64[D]"),
+        "length": side,
+        "width": side,
+    }).to_csv(index=False).encode()
+
+
+def main():
+    data = clinic_csv()
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        results, closed = process_wound_cohort(io.BytesIO(data))
+        timings.append(time.perf_counter() - start)
+    print(f"{WOUNDS * VISITS} measurement rows, {WOUNDS} wounds in {min(timings) * 1000:.0f} ms (best of {REPEATS})")
+    print(f"{len(results)} open ({(results['status'] == 'Not healing').sum()} not healing), {closed} closed")
+
+
+if __name__ == "__main__":
+    main()
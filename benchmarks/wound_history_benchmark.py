@@ -0,0 +1,75 @@
+"""Wound plot cost for long histories: server time per Generate Plot and the points sent to the browser.
+
+Builds the Wound Tracker tab on an offline client, enters years of daily measurements and times the click
+(parsing, healing fit and LTTB downsampling), then a zoom into one month re-sampled at full resolution. The
+same measurements are then saved and loaded as a history, which zooms by reading the window from the store.
+Run from the repository root: python benchmarks/wound_history_benchmark.py
+"""
+import os
+import tempfile
+import time
+import types
+
+import numpy as np
+import pandas as pd
+
+from _common import offline_client, outbox_bytes, run_handler
+from main import WOUND_DB_FILE, WOUND_METRICS, WoundTracker, wound_store
+
+SIZES = [365, 5 * 365, 20 * 365]
+ZOOM = types.SimpleNamespace(args={"xaxis.range[0]": "2000-06-01", "xaxis.range[1]": "2000-07-01"})
+
+
+def main():
+    wound_store.path = os.path.join(tempfile.mkdtemp(), WOUND_DB_FILE)  # keep benchmark runs out of the app's database
+    client = offline_client()
+    rng = np.random.default_rng(0)
+    with client:
+        for n in SIZES:
+            tracker = WoundTracker()
+            tracker.woundtracker_UI_Setup()
+            outbox_bytes(client, tracker.plot)
+            days = np.arange(n)
+            dates = pd.date_range("2000-01-01", periods=n).strftime("%Y-%m-%d")
+            tracker.dates.value = "\n".join(dates)
+            sizes = []
+            for box, size in ((tracker.w_width, 5), (tracker.w_length, 7), (tracker.w_depth, 1)):
+                values = (size * np.exp(-days / n) * rng.lognormal(0, 0.05, n)).round(2)
+                box.value = "\n".join(f"{value:.2f}" for value in values)
+                sizes.append(values.tolist())
+            outbox_bytes(client, tracker.plot)
+
+            start = time.perf_counter()
+            tracker.generate_plot()
+            elapsed = time.perf_counter() - start
+            sent = outbox_bytes(client, tracker.plot)
+            shown = sum(len(trace["x"]) for trace in tracker.fig["data"][:len(WOUND_METRICS)])
+
+            start = time.perf_counter()
+            run_handler(client, tracker.zoom_plot(ZOOM))
+            zoom = time.perf_counter() - start
+            zoom_sent = outbox_bytes(client, tracker.plot)
+            print(f"{n:>5} measurements: plot {elapsed * 1000:4.0f} ms, {shown:>5} of {n * len(WOUND_METRICS)} points "
+                  f"({sent / 1024:.0f} KB, {tracker.fig['data'][0]['type']}); one month zoom {zoom * 1000:.0f} ms "
+                  f"({zoom_sent / 1024:.0f} KB)")
+
+            wound_store.save("Benchmark", f"{n} days", zip(dates, *sizes))
+            tracker.reset_plot()
+            tracker.patient.value = "Benchmark"
+            tracker.site.set_options([f"{n} days"], value=f"{n} days")
+            outbox_bytes(client, tracker.plot)
+            start = time.perf_counter()
+            run_handler(client, tracker.load_history())
+            elapsed = time.perf_counter() - start
+            sent = outbox_bytes(client, tracker.plot)
+            start = time.perf_counter()
+            run_handler(client, tracker.zoom_plot(ZOOM))
+            zoom = time.perf_counter() - start
+            zoom_sent = outbox_bytes(client, tracker.plot)
+            print(f"{'':>5} saved history: load {elapsed * 1000:4.0f} ms ({sent / 1024:.0f} KB, "
+                  f"{tracker.dates.value.count(chr(10)) + 1} lines per textarea); one month zoom {zoom * 1000:.0f} ms "
+                  f"({zoom_sent / 1024:.0f} KB)")
+
+
+if __name__ == "__main__":
+    main()
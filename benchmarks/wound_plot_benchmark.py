@@ -0,0 +1,45 @@
+"""Websocket payload per wound plot click as measurements are added one visit at a time.
+
+Builds the Wound Tracker tab on an offline client, appends one measurement per Generate Plot click and
+serializes what the outbox would send for the click, next to a full redraw of the same figure.
+Run from the repository root: python benchmarks/wound_plot_benchmark.py
+"""
+import os
+import tempfile
+
+from _common import offline_client, outbox_bytes
+from main import WOUND_DB_FILE, WoundTracker, wound_store
+
+VISITS = 50
+REPORT = [1, 10, 50]
+
+
+def main():
+    wound_store.path = os.path.join(tempfile.mkdtemp(), WOUND_DB_FILE)  # keep benchmark runs out of the app's database
+    client = offline_client()
+    with client:
+        tracker = WoundTracker()
+        tracker.woundtracker_UI_Setup()
+        outbox_bytes(client, tracker.plot)
+
+        dates, widths, lengths, depths = [], [], [], []
+        for visit in range(1, VISITS + 1):
+            dates.append(f"2024-{1 + visit // 28:02d}-{1 + visit % 28:02d}")
+            widths.append(str(round(4 - visit * 0.05, 2)))
+            lengths.append(str(round(6 - visit * 0.08, 2)))
+            depths.append(str(round(1 - visit * 0.01, 2)))
+            for box, values in ((tracker.dates, dates), (tracker.w_width, widths), (tracker.w_length, lengths),
+                                (tracker.w_depth, depths)):
+                box.value = "\n".join(values)
+            outbox_bytes(client, tracker.plot)
+
+            tracker.generate_plot()
+            delta = outbox_bytes(client, tracker.plot)
+            tracker.plot.update()
+            full = outbox_bytes(client, tracker.plot)
+            if visit in REPORT:
+                print(f"click {visit:>2}: {delta:>5,} bytes sent, full redraw would be {full:>6,} bytes")
+
+
+if __name__ == "__main__":
+    main()
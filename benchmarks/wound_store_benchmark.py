@@ -0,0 +1,57 @@
+"""Wound measurement store: bulk and single visit inserts and history loads.
+
+Fills a temporary database with years of weekly measurements for many patients and sites, then times
+saving one new visit and loading a site's full history.
+Run from the repository root: python benchmarks/wound_store_benchmark.py
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import _common  # noqa: F401 (puts the repository root on sys.path)
+from main import WoundStore
+
+PATIENTS = 1000
+SITES = ["Left heel", "Right heel", "Sacrum"]
+WEEKS = 5 * 52
+SAMPLES = 200
+
+
+def main():
+    store = WoundStore(os.path.join(tempfile.mkdtemp(), "wounds.db"))
+    dates = [str(date) for date in np.datetime64("2020-01-06") + np.arange(WEEKS) * np.timedelta64(7, "D")]
+    rng = np.random.default_rng(0)
+
+    start = time.perf_counter()
+    for patient in range(PATIENTS):
+        for site in SITES:
+            sizes = rng.uniform(0.5, 5, (WEEKS, 3)).round(2).tolist()
+            store.save(f"P{patient:05d}", site, [(date, *size) for date, size in zip(dates, sizes)])
+    elapsed = time.perf_counter() - start
+    rows = PATIENTS * len(SITES) * WEEKS
+    print(f"bulk: {rows:,} rows in {elapsed:.1f} s ({rows / elapsed:,.0f} rows/s, one transaction per site)")
+
+    patients = rng.integers(0, PATIENTS, SAMPLES)
+    timings = []
+    for i, patient in enumerate(patients):
+        begin = time.perf_counter()
+        store.save(f"P{patient:05d}", SITES[i % len(SITES)], [("2025-01-06", 1.0, 1.5, 0.2)])
+        timings.append(time.perf_counter() - begin)
+    print(f"one visit insert: median {np.median(timings) * 1000:.2f} ms")
+
+    timings = []
+    for i, patient in enumerate(patients):
+        begin = time.perf_counter()
+        history = store.history(f"P{patient:05d}", SITES[i % len(SITES)])
+        timings.append(time.perf_counter() - begin)
+    print(f"history load ({len(history)} measurements): median {np.median(timings) * 1000:.2f} ms, "
+          f"max {max(timings) * 1000:.2f} ms")
+    plan = store.connect().execute("EXPLAIN QUERY PLAN SELECT date, width, length, depth FROM measurements "
+                                   "WHERE patient = ? AND site = ? ORDER BY date", ("P00000", SITES[0])).fetchall()
+    print("query plan:", plan[0][-1])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,86 +1,1878 @@
-from nicegui import ui, app, Client
+from nicegui import ui, app, Client, run
+from fastapi import HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 import requests
+import httpx
+import asyncio
 import json
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import pandas as pd
+import numpy as np
 from ollama import AsyncClient
 import os
 import io
 import PyPDF2
 from PyPDF2.generic import NameObject
 from datetime import datetime
+import bisect
+import csv
+import functools
+import glob
+import gzip
+import hashlib
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
 
 # Functions ======================================================================================
+#%% ========== Code Usage ========================================================================
+# Per-provider code use counts behind the quick pick chips in the ICD and cost tabs. Counts halve every
+# CODE_USAGE_HALF_LIFE seconds and only the CODE_USAGE_MAX_CODES most used codes per provider are kept.
+CODE_USAGE_FILE = "code_usage.json"
+CODE_USAGE_HALF_LIFE = 30 * 24 * 60 * 60
+CODE_USAGE_MAX_CODES = 200
+CODE_USAGE_TOP = 10
+# Uses within this many seconds are written to disk together, off the event loop
+CODE_USAGE_SAVE_DELAY = 5
+
+
+class CodeUsage:
+    """Least frequently used code cache with decay, {provider: {kind: {code: [score, last used]}}} on disk"""
+    def __init__(self, path=CODE_USAGE_FILE, half_life=CODE_USAGE_HALF_LIFE, max_codes=CODE_USAGE_MAX_CODES):
+        self.path = path
+        self.half_life = half_life
+        self.max_codes = max_codes
+        self.counts = {}
+        # record() runs on the event loop and only schedules a save, the file is written by a timer thread
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.save_timer = None
+        # Decay scales every score of a provider by the same factor, so a ranking only changes when a code is used
+        self.top_cache = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.counts = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Could not read {path}: {e}")
+
+    def decayed(self, entry, now):
+        score, updated = entry
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def providers(self):
+        """Known providers, most recently active first"""
+        last_used = {
+            provider: max((entry[1] for codes in kinds.values() for entry in codes.values()), default=0)
+            for provider, kinds in self.counts.items()
+        }
+        return sorted(last_used, key=last_used.get, reverse=True)
+
+    def record(self, provider, kind, codes):
+        if not provider or not codes:
+            return
+        now = time.time()
+        with self.lock:
+            usage = self.counts.setdefault(provider, {}).setdefault(kind, {})
+            for code in codes:
+                usage[code] = [self.decayed(usage.get(code, (0, now)), now) + 1, now]
+            if len(usage) > self.max_codes:
+                for code in sorted(usage, key=lambda code: self.decayed(usage[code], now))[:len(usage) - self.max_codes]:
+                    del usage[code]
+            self.top_cache.pop((provider, kind), None)
+            if self.save_timer is None:
+                self.save_timer = threading.Timer(CODE_USAGE_SAVE_DELAY, self.save)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def top(self, provider, kind, n=CODE_USAGE_TOP):
+        """The provider's most used codes, best first"""
+        key = (provider, kind)
+        if key not in self.top_cache:
+            usage = self.counts.get(provider, {}).get(kind, {})
+            now = time.time()
+            self.top_cache[key] = sorted(usage, key=lambda code: self.decayed(usage[code], now), reverse=True)
+        return self.top_cache[key][:n]
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                if self.save_timer is not None:
+                    self.save_timer.cancel()
+                    self.save_timer = None
+                data = json.dumps(self.counts)
+            # Write to a temporary file first so a crash never leaves a truncated file behind
+            try:
+                with open(self.path + ".tmp", "w") as f:
+                    f.write(data)
+                os.replace(self.path + ".tmp", self.path)
+            except OSError as e:
+                print(f"Could not save {self.path}: {e}")
+
+    def flush(self):
+        """Write a pending save now"""
+        if self.save_timer is not None:
+            self.save()
+
+
+code_usage = CodeUsage()
+app.on_shutdown(code_usage.flush)
+
+
 #%% ========== ICD Lookup Functions ==============================================================
+# CMS ICD-10-CM order files (icd10cm_order_YYYY.txt from the yearly "Code Descriptions in Tabular Order"
+# download). Every fiscal year found is loaded side by side, a single unversioned icd10cm_order.txt also works.
+ICD_ORDER_FILE = "icd10cm_order.txt"
+ICD_ORDER_GLOB = "icd10cm_order_*.txt"
+# How often (seconds) to check the order files for changes, a changed code set is reloaded without a restart
+ICD_RELOAD_INTERVAL = 60
+ICD_API_URL = "https://clinicaltables.nlm.nih.gov/api/icd10cm/v3/search"
+# Fall back to the NIH API when the order file is not available
+ICD_API_FALLBACK = True
+# Results are fetched one page at a time as the grid is scrolled (the API allows at most 500 per request)
+ICD_PAGE_SIZE = 100
+ICD_PREFETCH_ROWS = 20
+# The API rejects requests past this many results of a search (offset + count), later pages cannot be loaded
+ICD_API_MAX_RESULTS = 7500
+# Typo tolerant search: minimum trigram similarity for a word to count as a match, and ranked result cap
+ICD_FUZZY_THRESHOLD = 0.35
+ICD_FUZZY_MAX_RESULTS = 500
+# Result sets each loaded index keeps, so paging through a search is a slice
+ICD_MATCH_CACHE_SIZE = 256
+# Typing pause (seconds) before a live search runs
+ICD_DEBOUNCE = 0.06
+# Pooled HTTP client settings, shared by every browser session
+ICD_API_TIMEOUT = httpx.Timeout(5.0, connect=3.0, read=5.0)
+ICD_API_MAX_CONCURRENCY = 10
+# Shared API result cache: entry/size bounds, freshness for hits and empty results, and how long
+# an expired entry may still be served while it is refreshed in the background (seconds)
+ICD_CACHE_MAX_ENTRIES = 5000
+ICD_CACHE_MAX_BYTES = 64 * 1024 * 1024
+ICD_CACHE_TTL = 24 * 60 * 60
+ICD_CACHE_NEGATIVE_TTL = 60 * 60
+ICD_CACHE_STALE_TTL = 7 * 24 * 60 * 60
+# ICD-10-CM chapters by category range, the top level of the hierarchy browser
+ICD_CHAPTERS = [
+    ("A00", "B99", "Certain infectious and parasitic diseases"),
+    ("C00", "D49", "Neoplasms"),
+    ("D50", "D89", "Diseases of the blood and blood-forming organs and certain disorders involving the immune mechanism"),
+    ("E00", "E89", "Endocrine, nutritional and metabolic diseases"),
+    ("F01", "F99", "Mental, behavioral and neurodevelopmental disorders"),
+    ("G00", "G99", "Diseases of the nervous system"),
+    ("H00", "H59", "Diseases of the eye and adnexa"),
+    ("H60", "H95", "Diseases of the ear and mastoid process"),
+    ("I00", "I99", "Diseases of the circulatory system"),
+    ("J00", "J99", "Diseases of the respiratory system"),
+    ("K00", "K95", "Diseases of the digestive system"),
+    ("L00", "L99", "Diseases of the skin and subcutaneous tissue"),
+    ("M00", "M99", "Diseases of the musculoskeletal system and connective tissue"),
+    ("N00", "N99", "Diseases of the genitourinary system"),
+    ("O00", "O9A", "Pregnancy, childbirth and the puerperium"),
+    ("P00", "P96", "Certain conditions originating in the perinatal period"),
+    ("Q00", "Q99", "Congenital malformations, deformations and chromosomal abnormalities"),
+    ("R00", "R99", "Symptoms, signs and abnormal clinical and laboratory findings, not elsewhere classified"),
+    ("S00", "T88", "Injury, poisoning and certain other consequences of external causes"),
+    ("U00", "U85", "Codes for special purposes"),
+    ("V00", "Y99", "External causes of morbidity"),
+    ("Z00", "Z99", "Factors influencing health status and contact with health services"),
+]
+# CMS-HCC risk adjustment model tables (see README for the column layout), scoring is off without them
+HCC_MAPPING_FILE = "hcc_mapping.csv"
+HCC_COEFFICIENT_FILE = "hcc_coefficients.csv"
+HCC_HIERARCHY_FILE = "hcc_hierarchy.csv"
+
+
+def format_icd_code(code):
+    """Insert the dot after the category (E119 -> E11.9)"""
+    return code[:3] + "." + code[3:] if len(code) > 3 else code
+
+
+def sorted_contains(values, item):
+    i = bisect.bisect_left(values, item)
+    return i < len(values) and values[i] == item
+
+
+class ICDIndex:
+    """In-memory ICD-10-CM search engine with a code prefix index and a description token index"""
+    code_re = re.compile(r"^[A-Z][0-9][0-9A-Z]{0,5}$")
+    token_re = re.compile(r"[a-z0-9]+")
+
+    def __init__(self, records, years=(None,)):
+        """records: (code, description, code set bitmask, billable bitmask), bit i is the fiscal year years[i]"""
+        self.years = list(years)
+        self.latest_bit = 1 << (len(self.years) - 1)
+        self.codes = []
+        self.descs = []
+        year_masks = []
+        billable_masks = []
+        for code, desc, year_mask, billable_mask in records:
+            self.codes.append(code)
+            self.descs.append(desc)
+            year_masks.append(year_mask)
+            billable_masks.append(billable_mask)
+        self.code_ids = {code: i for i, code in enumerate(self.codes)}
+
+        # Code set membership per fiscal year; without a date of service the latest code set applies
+        self.year_masks = np.array(year_masks, dtype=np.int64)
+        self.billable_masks = np.array(billable_masks, dtype=np.int64)
+        self.active = (self.year_masks & self.latest_bit) != 0
+        self.billable = ((self.billable_masks & self.latest_bit) != 0).tolist()
+
+        # Effective from October 1 of the first fiscal year with the code, terminated after the last one
+        first = np.log2(self.year_masks & -self.year_masks).astype(int)
+        last = np.log2(self.year_masks).astype(int)
+        if self.years[-1] is None:
+            self.effective = np.full(len(self.codes), "", dtype=object)
+            self.terminated = np.full(len(self.codes), "", dtype=object)
+        else:
+            effective = [f"{year - 1}-10-01" for year in self.years]
+            terminated = [f"{year}-09-30" for year in self.years[:-1]] + [""]
+            self.effective = np.array(effective, dtype=object)[first]
+            self.terminated = np.array(terminated, dtype=object)[last]
+
+        # Precomputed added/deleted codes between every pair of loaded fiscal years
+        self.changes = {}
+        for a, from_year in enumerate(self.years):
+            for b, to_year in enumerate(self.years[a + 1:], a + 1):
+                in_from = (self.year_masks >> a) & 1 == 1
+                in_to = (self.year_masks >> b) & 1 == 1
+                self.changes[(from_year, to_year)] = (np.flatnonzero(in_to & ~in_from), np.flatnonzero(in_from & ~in_to))
+
+        # Column arrays for vectorized bulk validation
+        self.code_index = pd.Index(self.codes)
+        self.billable_array = np.array(self.billable, dtype=bool)
+        self.desc_array = np.array(self.descs, dtype=object)
+        self.dotted_array = np.array([format_icd_code(code) for code in self.codes], dtype=object)
+
+        # Prefix index: row ids ordered by code so a prefix is one contiguous bisect range
+        self.sorted_ids = np.array(sorted(range(len(self.codes)), key=self.codes.__getitem__), dtype=np.int64)
+        self.sorted_codes = [self.codes[i] for i in self.sorted_ids]
+
+        # Inverted index: description token -> ascending row ids, stored back to back in vocabulary order so
+        # the rows of every word starting with a prefix are one contiguous slice of word_rows
+        postings = {}
+        for i, desc in enumerate(self.descs):
+            for token in set(self.token_re.findall(desc.lower())):
+                postings.setdefault(token, []).append(i)
+        self.vocab = sorted(postings)
+        self.word_ids = {word: w for w, word in enumerate(self.vocab)}
+        self.posting_sizes = np.array([len(postings[word]) for word in self.vocab], dtype=np.int64)
+        self.word_offsets = np.concatenate([[0], np.cumsum(self.posting_sizes)])
+        self.word_rows = np.array([i for word in self.vocab for i in postings[word]], dtype=np.int32)
+        self.posting_arrays = np.split(self.word_rows, self.word_offsets[1:-1]) if self.vocab else []
+
+        # Character trigram index over the description vocabulary for typo tolerant search
+        self.trigram_counts = np.zeros(len(self.vocab), dtype=np.int32)
+        trigram_words = {}
+        for w, word in enumerate(self.vocab):
+            grams = self.trigrams(word)
+            self.trigram_counts[w] = len(grams)
+            for gram in grams:
+                trigram_words.setdefault(gram, []).append(w)
+        self.trigram_words = {gram: np.array(ids, dtype=np.int32) for gram, ids in trigram_words.items()}
+
+        self.hierarchy = ICDHierarchy(self)
+
+        # Result caches belong to this index and are dropped with it when the order files are reloaded
+        self.match = functools.lru_cache(maxsize=ICD_MATCH_CACHE_SIZE)(self.match)
+        self.ranked = functools.lru_cache(maxsize=ICD_MATCH_CACHE_SIZE)(self.ranked)
+
+    @staticmethod
+    def trigrams(word):
+        padded = f"  {word} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @staticmethod
+    def read_order_file(path):
+        """Parse the fixed-width CMS order file (order number, code, header flag, short and long description)"""
+        with open(path, encoding="latin-1") as f:
+            for line in f:
+                code = line[6:13].strip()
+                if code:
+                    yield code, line[14] == "1", line[77:].strip()
+
+    @classmethod
+    def from_order_files(cls, paths):
+        """Merge annual order files {fiscal year: path} into one table that keeps each code once"""
+        years = sorted(paths)
+        merged = {}  # code -> [description, code set bitmask, billable bitmask]
+        for bit, year in enumerate(years):
+            for code, billable, desc in cls.read_order_file(paths[year]):
+                entry = merged.setdefault(code, [desc, 0, 0])
+                entry[0] = desc  # the latest year's wording wins
+                entry[1] |= 1 << bit
+                if billable:
+                    entry[2] |= 1 << bit
+        return cls([(code, *merged[code]) for code in sorted(merged)], years)
+
+    def code_set(self, dos=None):
+        """Bitmask of the code set in effect on a date of service (ICD-10-CM changes every October 1)"""
+        if dos is None or self.years[-1] is None:
+            return self.latest_bit
+        fiscal_year = dos.year + 1 if dos.month >= 10 else dos.year
+        if fiscal_year >= self.years[-1]:
+            return self.latest_bit
+        if fiscal_year not in self.years:
+            raise ValueError(f"No ICD-10-CM code set loaded for FY{fiscal_year} (date of service {dos:%m/%d/%Y})")
+        return 1 << self.years.index(fiscal_year)
+
+    def match_code(self, term):
+        prefix = term.strip().upper().replace(".", "")
+        if not self.code_re.match(prefix):
+            return []
+        lo = bisect.bisect_left(self.sorted_codes, prefix)
+        hi = bisect.bisect_right(self.sorted_codes, prefix + "~")  # "~" sorts after every code character
+        return np.sort(self.sorted_ids[lo:hi])
+
+    def match_terms(self, term):
+        tokens = self.token_re.findall(term.lower())
+        if not tokens:
+            return np.empty(0, dtype=np.int64)
+
+        # Every word has to match, the last one as a prefix since it may still be being typed
+        lists = []
+        for token in tokens[:-1]:
+            if token not in self.word_ids:
+                return np.empty(0, dtype=np.int64)
+            lists.append(self.posting_arrays[self.word_ids[token]])
+        lo = bisect.bisect_left(self.vocab, tokens[-1])
+        hi = bisect.bisect_right(self.vocab, tokens[-1] + "~")
+        if lo == hi:
+            return np.empty(0, dtype=np.int64)
+        prefix_rows = None
+        if hi - lo == 1:
+            lists.append(self.posting_arrays[lo])
+        else:
+            prefix_rows = self.word_rows[self.word_offsets[lo]:self.word_offsets[hi]]
+
+        # Intersect the whole words from the shortest list, then keep the rows the prefix words cover
+        lists.sort(key=len)
+        matches = lists[0] if lists else None
+        for ids in lists[1:]:
+            matches = matches[np.isin(matches, ids, assume_unique=True)]
+        if prefix_rows is not None:
+            covered = np.zeros(len(self.codes), dtype=bool)
+            covered[prefix_rows] = True
+            matches = np.flatnonzero(covered) if matches is None else matches[covered[matches]]
+        return matches.astype(np.int64)
+
+    def similar_words(self, token):
+        """Vocabulary words whose trigram (Jaccard) similarity to token reaches ICD_FUZZY_THRESHOLD"""
+        grams = self.trigrams(token)
+        hits = [self.trigram_words[gram] for gram in grams if gram in self.trigram_words]
+        if not hits:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        shared = np.bincount(np.concatenate(hits), minlength=len(self.vocab))
+        words = np.flatnonzero(shared)
+        similarity = shared[words] / (len(grams) + self.trigram_counts[words] - shared[words])
+        keep = similarity >= ICD_FUZZY_THRESHOLD
+        return words[keep], similarity[keep]
+
+    def match_fuzzy(self, term):
+        # Each description scores the best word similarity per query word, summed over the query words
+        scores = np.zeros(len(self.codes))
+        for token in set(self.token_re.findall(term.lower())):
+            words, similarity = self.similar_words(token)
+            if not len(words):
+                continue
+            rows = np.concatenate([self.posting_arrays[w] for w in words])
+            best = np.zeros(len(self.codes))
+            np.maximum.at(best, rows, np.repeat(similarity, self.posting_sizes[words]))
+            scores += best
+
+        # Rank the top candidates by score, ties keep code order
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > ICD_FUZZY_MAX_RESULTS:
+            cutoff = np.partition(scores[candidates], -ICD_FUZZY_MAX_RESULTS)[-ICD_FUZZY_MAX_RESULTS]
+            above = candidates[scores[candidates] > cutoff]
+            ties = candidates[scores[candidates] == cutoff][:ICD_FUZZY_MAX_RESULTS - len(above)]
+            candidates = np.sort(np.concatenate([above, ties]))
+        return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+    def match(self, term, fuzzy=False, code_set=None):
+        """All matching row ids in a code set, code matches first; cached so paging through a result set is a slice"""
+        code_ids = self.match_code(term)
+        matches = self.match_fuzzy(term) if fuzzy else self.match_terms(term)
+        ids = np.concatenate([code_ids, matches[~np.isin(matches, code_ids)]]) if len(code_ids) else matches
+        ids = ids[self.year_masks[ids] & (code_set or self.latest_bit) != 0]
+        ids.setflags(write=False)  # shared by every later call for the same search
+        return ids
+
+    def validate(self, codes, dos=None):
+        """Validate a list of codes in one vectorized pass, with or without the dot"""
+        code_set = self.code_set(dos)
+        entered = pd.Series(codes, dtype=object).astype(str).str.strip()
+        normalized = entered.str.upper().str.replace(".", "", regex=False)
+        rows = self.code_index.get_indexer(normalized)
+        known = rows >= 0
+        rows = np.where(known, rows, 0)
+        valid = known & (self.year_masks[rows] & code_set != 0)
+        return pd.DataFrame({
+            "input": entered,
+            "code": np.where(known, self.dotted_array[rows], ""),
+            "code_nodot": np.where(known, normalized, ""),
+            "valid": valid,
+            "billable": valid & (self.billable_masks[rows] & code_set != 0),
+            "description": np.where(known, self.desc_array[rows], ""),
+            "effective": np.where(known, self.effective[rows], ""),
+            "terminated": np.where(known, self.terminated[rows], ""),
+        })
+
+    def code_changes(self, from_year, to_year):
+        """Rows for the codes added and deleted between two loaded fiscal years"""
+        added, deleted = self.changes[(from_year, to_year)]
+        rows = [{"code": self.dotted_array[i], "change": "Added", "description": self.descs[i]} for i in added]
+        rows += [{"code": self.dotted_array[i], "change": "Deleted", "description": self.descs[i]} for i in deleted]
+        return rows
+
+    def ranked(self, term, fuzzy=False, code_set=None, pinned=()):
+        """match() with the pinned codes (a provider's most used) that matched moved to the front"""
+        ids = self.match(term, fuzzy, code_set)
+        if not pinned:
+            return ids
+        front = np.array([self.code_ids.get(code, -1) for code in pinned], dtype=np.int64)
+        front = front[np.isin(front, ids)]
+        if not len(front):
+            return ids
+        ranked = np.concatenate([front, ids[~np.isin(ids, front)]])
+        ranked.setflags(write=False)
+        return ranked
+
+    def search(self, term, offset=0, count=ICD_PAGE_SIZE, fuzzy=False, dos=None, pinned=()):
+        """Return the total number of matches and one page of (code, description) pairs"""
+        ids = self.ranked(term, fuzzy, self.code_set(dos), tuple(pinned))
+        pairs = [(format_icd_code(self.codes[i]), self.descs[i]) for i in ids[offset:offset + count].tolist()]
+        return len(ids), pairs
+
+
+class ICDHierarchy:
+    """Precomputed chapter -> category -> subcategory -> code tree over an ICDIndex
+
+    Nodes 0..n-1 are the index rows, the chapters follow. Children lists and billable code counts
+    are built once so expanding a node is a list lookup.
+    """
+    def __init__(self, index):
+        self.index = index
+        n = len(index.codes)
+        self.chapters = list(range(n, n + len(ICD_CHAPTERS)))
+        self.parents = [-1] * (n + len(ICD_CHAPTERS))
+        self.children = [[] for _ in self.parents]
+
+        # A code hangs under its longest prefix that is also a code, categories under their chapter.
+        # Only the latest code set is browsed.
+        chapter_of = {}
+        for i, code in enumerate(index.codes):
+            if not index.active[i]:
+                continue
+            parent = -1
+            for length in range(len(code) - 1, 2, -1):
+                parent = index.code_ids.get(code[:length], -1)
+                if parent >= 0 and index.active[parent]:
+                    break
+                parent = -1
+            if parent < 0:
+                category = code[:3]
+                if category not in chapter_of:
+                    chapter_of[category] = next(
+                        (n + c for c, (start, end, title) in enumerate(ICD_CHAPTERS) if start <= category <= end), -1
+                    )
+                parent = chapter_of[category]
+            if parent >= 0:
+                self.parents[i] = parent
+                self.children[parent].append(i)
+
+        # Billable codes at or below each node, children are always longer codes than their parent
+        self.billable_counts = [int(billable) for billable in index.billable] + [0] * len(ICD_CHAPTERS)
+        for i in sorted(range(n), key=lambda i: -len(index.codes[i])):
+            if self.parents[i] >= 0:
+                self.billable_counts[self.parents[i]] += self.billable_counts[i]
+
+    def label(self, node):
+        if node >= len(self.index.codes):
+            start, end, title = ICD_CHAPTERS[node - len(self.index.codes)]
+            return f"{start}-{end}", title
+        return format_icd_code(self.index.codes[node]), self.index.descs[node]
+
+    def path(self, node):
+        """Ancestors of node from the chapter down, including node"""
+        nodes = []
+        while node >= 0:
+            nodes.append(node)
+            node = self.parents[node]
+        return nodes[::-1]
+
+    def rows(self, node=None):
+        """Grid rows for the children of node, or the chapters when node is None"""
+        rows = []
+        for child in self.chapters if node is None else self.children[node]:
+            code, desc = self.label(child)
+            rows.append({
+                "node": child,
+                "code": code,
+                "description": desc,
+                "billable": self.billable_counts[child],
+                "children": len(self.children[child]),
+            })
+        return rows
+
+
+icd_index = None
+
+
+def find_icd_order_files():
+    """Order files by fiscal year, the unversioned ICD_ORDER_FILE is only used when there are none"""
+    paths = {}
+    for path in glob.glob(ICD_ORDER_GLOB):
+        match = re.search(r"(\d{4})\.txt$", path)
+        if match:
+            paths[int(match.group(1))] = path
+    if not paths and os.path.exists(ICD_ORDER_FILE):
+        paths[None] = ICD_ORDER_FILE
+    return paths
+
+
+icd_index_signature = None
+icd_index_checked = None
+icd_index_reloading = False
+
+
+def icd_source_signature(paths):
+    """Changes whenever an order file is added, removed or rewritten"""
+    return tuple(sorted((str(year), path, os.stat(path).st_mtime_ns, os.stat(path).st_size) for year, path in paths.items()))
+
+
+def load_icd_index(paths, signature):
+    """Build the index and its browser bundle for the order files, then swap them in for the current ones"""
+    global icd_index, icd_bundle, icd_index_signature, icd_index_reloading
+    try:
+        index = ICDIndex.from_order_files(paths) if paths else None
+        bundle = build_icd_bundle(index) if index is not None else None
+        icd_bundle, icd_index, icd_index_signature = bundle, index, signature
+    except Exception as e:  # e.g. a file still being copied, the old index keeps serving until the next check
+        print(f"Could not load the ICD-10-CM order files: {e}")
+    finally:
+        icd_index_reloading = False
+
+
+def get_icd_index():
+    """Load the local ICD-10-CM index once per process and again when the order files change, None without them
+
+    The first load (at startup) runs inline. Later reloads are built in a background thread while the old index
+    keeps answering searches, and replace it once they are ready.
+    """
+    global icd_index_checked, icd_index_reloading
+    now = time.monotonic()
+    if icd_index_checked is not None and now - icd_index_checked < ICD_RELOAD_INTERVAL:
+        return icd_index
+    first = icd_index_checked is None
+    icd_index_checked = now
+
+    paths = find_icd_order_files()
+    signature = icd_source_signature(paths) if paths else None
+    if signature != icd_index_signature and not icd_index_reloading:
+        icd_index_reloading = True
+        if first:
+            load_icd_index(paths, signature)
+        else:
+            threading.Thread(target=load_icd_index, args=(paths, signature), daemon=True).start()
+    return icd_index
+
+
+def parse_date_of_service(value):
+    """Date of service from the UI (MM/DD/YYYY) or the API (YYYY-MM-DD), None when empty"""
+    if not value:
+        return None
+    for fmt in ("%m/%d/%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value.strip(), fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid date of service: {value}")
+
+
+# Build the index at startup rather than on the first search
+app.on_startup(get_icd_index)
+
+
+class HCCModel:
+    """CMS-HCC mapping, hierarchies and coefficients precomputed as arrays, so a whole panel scores at once"""
+    def __init__(self, mapping, coefficients, hierarchy):
+        coefficients = coefficients.drop_duplicates("hcc")
+        self.hccs = coefficients["hcc"].to_numpy(dtype=object)
+        self.labels = coefficients["description"].to_numpy(dtype=object)
+        self.coefficients = coefficients["coefficient"].to_numpy(dtype=np.float64)
+        hcc_index = pd.Index(self.hccs)
+
+        # Diagnosis code -> HCC column pairs, a code can map to more than one HCC
+        self.mapping = pd.DataFrame({
+            "code": mapping["code"].str.upper().str.replace(".", "", regex=False),
+            "hcc": hcc_index.get_indexer(mapping["hcc"]),
+        })
+        self.mapping = self.mapping[self.mapping["hcc"] >= 0].drop_duplicates()
+
+        # drops[i, j] is 1 when HCC i trumps HCC j, so present @ drops marks every trumped HCC in one product
+        self.drops = np.zeros((len(self.hccs), len(self.hccs)), dtype=np.float32)
+        higher = hcc_index.get_indexer(hierarchy["hcc"])
+        lower = hcc_index.get_indexer(hierarchy["drops"])
+        known = (higher >= 0) & (lower >= 0)
+        self.drops[higher[known], lower[known]] = 1
+
+    @classmethod
+    def from_files(cls, mapping_path, coefficient_path, hierarchy_path):
+        read = functools.partial(pd.read_csv, dtype=str, keep_default_na=False)
+        coefficients = read(coefficient_path)
+        coefficients["coefficient"] = coefficients["coefficient"].astype(float)
+        return cls(read(mapping_path), coefficients, read(hierarchy_path))
+
+    def score(self, patients, codes):
+        """Score (patient, diagnosis code) pairs, returns patient keys, HCC matrices before/after hierarchies and scores"""
+        codes = pd.Series(codes, dtype=object).astype(str).str.strip().str.upper().str.replace(".", "", regex=False)
+        patient_ids, keys = pd.factorize(pd.Series(patients, dtype=object).astype(str))
+        pairs = pd.DataFrame({"patient": patient_ids, "code": codes}).merge(self.mapping, on="code")
+
+        present = np.zeros((len(keys), len(self.hccs)), dtype=bool)
+        present[pairs["patient"].to_numpy(), pairs["hcc"].to_numpy()] = True
+        kept = present & ~(present.astype(np.float32) @ self.drops > 0)
+        return keys, present, kept, kept @ self.coefficients
+
+    def hcc_lists(self, matrix):
+        """Comma separated HCCs per row of a patient x HCC matrix"""
+        rows, cols = np.nonzero(matrix)
+        lists = pd.Series(self.hccs[cols]).groupby(rows).agg(", ".join)
+        return lists.reindex(range(len(matrix)), fill_value="").to_numpy()
+
+    def score_panel(self, patients, codes):
+        """One row per patient with raw HCCs, HCCs left after the hierarchies and the summed risk score"""
+        keys, present, kept, scores = self.score(patients, codes)
+        return pd.DataFrame({
+            "patient": keys,
+            "hccs": self.hcc_lists(present),
+            "kept": self.hcc_lists(kept),
+            "score": scores.round(3),
+        })
+
+    def explain(self, codes):
+        """Per HCC detail for a single patient's diagnosis list: contributing codes and whether it was trumped"""
+        keys, present, kept, scores = self.score([0] * len(codes), codes)
+        if not len(keys):
+            return [], 0.0
+        normalized = pd.Series(codes, dtype=object).astype(str).str.strip().str.upper().str.replace(".", "", regex=False)
+        matched = self.mapping[self.mapping["code"].isin(normalized)]
+        sources = matched.groupby("hcc")["code"].agg(lambda c: ", ".join(format_icd_code(code) for code in sorted(c)))
+        rows = []
+        for col in np.flatnonzero(present[0]):
+            trumped_by = [self.hccs[i] for i in np.flatnonzero(present[0] & (self.drops[:, col] > 0))]
+            rows.append({
+                "hcc": self.hccs[col],
+                "description": self.labels[col],
+                "codes": sources[col],
+                "coefficient": float(self.coefficients[col]),
+                "status": "Kept" if kept[0, col] else "Dropped (" + ", ".join(trumped_by) + ")",
+            })
+        return rows, float(scores[0])
+
+
+hcc_model = None
+
+
+def get_hcc_model():
+    """Load the HCC model tables once per process, None when any of them is missing"""
+    global hcc_model
+    paths = (HCC_MAPPING_FILE, HCC_COEFFICIENT_FILE, HCC_HIERARCHY_FILE)
+    if hcc_model is None and all(os.path.exists(path) for path in paths):
+        hcc_model = HCCModel.from_files(*paths)
+    return hcc_model
+
+
+app.on_startup(get_hcc_model)
+
+
+class ICDApiClient:
+    """Process-wide keep-alive client for the NIH clinical tables API with bounded concurrency"""
+    def __init__(self, url=ICD_API_URL, timeout=ICD_API_TIMEOUT, max_concurrency=ICD_API_MAX_CONCURRENCY):
+        self.url = url
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = None
+
+    def get_client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self.client
+
+    async def search(self, term, offset=0, count=ICD_PAGE_SIZE):
+        """Returns the total number of matches and one page of (code, description) pairs
+
+        The page is cut short at ICD_API_MAX_RESULTS, past it there are no more pages.
+        """
+        count = min(count, ICD_API_MAX_RESULTS - offset)
+        if count <= 0:
+            return 0, []
+        async with self.semaphore:
+            response = await self.get_client().get(
+                self.url, params={"sf": "code,name", "terms": term, "offset": offset, "count": count}
+            )
+        response.raise_for_status()
+        data = response.json()
+        return data[0], [tuple(pair) for pair in data[3]]
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+icd_api = ICDApiClient()
+app.on_shutdown(icd_api.close)
+
+
+def normalize_icd_term(term):
+    return " ".join(term.lower().split())
+
+
+class ICDQueryCache:
+    """Process-wide LRU + TTL cache with negative caching and stale-while-revalidate"""
+    def __init__(self, max_entries=ICD_CACHE_MAX_ENTRIES, max_bytes=ICD_CACHE_MAX_BYTES, ttl=ICD_CACHE_TTL,
+                 negative_ttl=ICD_CACHE_NEGATIVE_TTL, stale_ttl=ICD_CACHE_STALE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.entries = OrderedDict()  # key -> (fresh until, stale until, size, (total, pairs))
+        self.nbytes = 0
+        self.pending = {}  # key -> in-flight fetch task, shared by concurrent callers
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def estimate_size(value):
+        return 100 + sum(100 + len(code) + len(desc) for code, desc in value[1])
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[2]
+        now = time.monotonic()
+        ttl = self.ttl if value[0] else self.negative_ttl
+        size = self.estimate_size(value)
+        self.entries[key] = (now + ttl, now + ttl + self.stale_ttl, size, value)
+        self.nbytes += size
+
+        # Evict least recently used entries until both bounds hold
+        while len(self.entries) > self.max_entries or (self.nbytes > self.max_bytes and len(self.entries) > 1):
+            self.nbytes -= self.entries.popitem(last=False)[1][2]
+            self.evictions += 1
+
+    async def fetch(self, key, fetch):
+        try:
+            value = await fetch()
+            self.put(key, value)
+            return value
+        finally:
+            del self.pending[key]
+
+    def start_fetch(self, key, fetch):
+        # Concurrent misses and refreshes of the same key share one upstream request
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self.fetch(key, fetch))
+        return self.pending[key]
+
+    @staticmethod
+    def report_refresh(task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"ICD cache refresh failed: {task.exception()}")
+
+    async def get(self, key, fetch):
+        """Return the cached value for key, calling the async fetch() on a miss"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            now = time.monotonic()
+            if now < entry[1]:
+                self.entries.move_to_end(key)
+                if now < entry[0]:
+                    self.hits += 1
+                else:
+                    # Expired but still usable: answer now and refresh in the background
+                    self.stale_hits += 1
+                    self.start_fetch(key, fetch).add_done_callback(self.report_refresh)
+                return entry[3]
+
+        self.misses += 1
+        return await asyncio.shield(self.start_fetch(key, fetch))
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+        }
+
+
+icd_cache = ICDQueryCache()
+
+
+@app.get("/api/icd10/cache")
+def icd_cache_stats():
+    return icd_cache.stats()
+
+
+@app.post("/api/icd10/validate")
+async def icd_validate(request: Request):
+    """Bulk validation endpoint, takes {"codes": [...], "date_of_service": "YYYY-MM-DD"} or a plain JSON list"""
+    index = get_icd_index()
+    if index is None:
+        raise HTTPException(status_code=503, detail=f"ICD code file {ICD_ORDER_FILE} not found")
+    payload = await request.json()
+    codes = payload.get("codes", []) if isinstance(payload, dict) else payload
+    if not isinstance(codes, list):
+        raise HTTPException(status_code=422, detail="Expected a list of codes")
+    try:
+        dos = parse_date_of_service(payload.get("date_of_service")) if isinstance(payload, dict) else None
+        df = index.validate(codes, dos)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return Response(df.to_json(orient="records"), media_type="application/json")
+
+
+@app.get("/api/icd10/changes")
+def icd_changes(from_year: int, to_year: int):
+    """Codes added and deleted between two loaded fiscal years"""
+    index = get_icd_index()
+    if index is None:
+        raise HTTPException(status_code=503, detail=f"ICD code file {ICD_ORDER_FILE} not found")
+    if (from_year, to_year) not in index.changes:
+        raise HTTPException(status_code=404, detail=f"Code sets FY{from_year} and FY{to_year} are not both loaded")
+    return index.code_changes(from_year, to_year)
+
+
+icd_bundle = None
+
+
+def build_icd_bundle(index):
+    """Gzipped JSON of the latest code set for searching in the browser, as (index, version, data)
+
+    The version is a hash of the content, so it only changes with the code set and the versioned URL can be
+    cached by browsers forever.
+    """
+    ids = np.flatnonzero(index.active)
+    payload = json.dumps({
+        "codes": [index.codes[i] for i in ids],
+        "descs": [index.descs[i] for i in ids],
+    }, separators=(",", ":")).encode()
+    version = hashlib.sha256(payload).hexdigest()[:16]
+    return index, version, gzip.compress(payload, mtime=0)
+
+
+def get_icd_bundle():
+    """(version, data) of the bundle built with the loaded index, None without an index"""
+    if get_icd_index() is None or icd_bundle is None:
+        return None
+    return icd_bundle[1:]
+
+
+@app.get("/api/icd10/bundle/{version}")
+def icd_bundle_download(version: str, request: Request):
+    bundle = get_icd_bundle()
+    if bundle is None:
+        raise HTTPException(status_code=503, detail=f"ICD code file {ICD_ORDER_FILE} not found")
+    if version != bundle[0]:
+        raise HTTPException(status_code=404, detail="ICD bundle version is out of date, reload the page")
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{version}"'}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    headers["Content-Encoding"] = "gzip"
+    return Response(bundle[1], media_type="application/json", headers=headers)
+
+# Browser side search over the bundle, same matching as ICDIndex.match_code/match_terms so results agree.
+# A bundle is downloaded once per version and kept in the Cache API (the HTTP cache outside secure contexts).
+ICD_BUNDLE_JS = """
+<script>
+window.icdBundle = {
+  bundles: {},
+  load(url) {
+    if (!this.bundles[url]) {
+      this.bundles[url] = (async () => {
+        let response = window.caches ? await (await caches.open("icd10-bundle")).match(url) : undefined;
+        if (!response) {
+          response = await fetch(url);
+          if (!response.ok) throw new Error(response.statusText);
+          if (window.caches) {
+            const cache = await caches.open("icd10-bundle");
+            await cache.put(url, response.clone());
+            for (const request of await cache.keys()) {
+              if (!request.url.endsWith(url)) await cache.delete(request);
+            }
+          }
+        }
+        const bundle = await response.json();
+        bundle.words = bundle.descs.map((desc) => " " + (desc.toLowerCase().match(/[a-z0-9]+/g) || []).join(" ") + " ");
+        return bundle;
+      })();
+    }
+    return this.bundles[url];
+  },
+  match(bundle, term) {
+    const ids = [];
+    const seen = new Set();
+    const prefix = term.trim().toUpperCase().replaceAll(".", "");
+    if (/^[A-Z][0-9][0-9A-Z]{0,5}$/.test(prefix)) {
+      let lo = 0, hi = bundle.codes.length;
+      while (lo < hi) {
+        const mid = (lo + hi) >> 1;
+        if (bundle.codes[mid] < prefix) lo = mid + 1; else hi = mid;
+      }
+      for (let i = lo; i < bundle.codes.length && bundle.codes[i].startsWith(prefix); i++) {
+        ids.push(i);
+        seen.add(i);
+      }
+    }
+    const tokens = term.toLowerCase().match(/[a-z0-9]+/g) || [];
+    if (tokens.length) {
+      const words = tokens.slice(0, -1).map((token) => " " + token + " ");
+      const last = " " + tokens[tokens.length - 1];
+      bundle.words.forEach((desc, i) => {
+        if (!seen.has(i) && desc.includes(last) && words.every((word) => desc.includes(word))) ids.push(i);
+      });
+    }
+    return ids;
+  },
+  async search(url, term, gridId, labelId) {
+    const label = document.getElementById("c" + labelId);
+    let bundle;
+    try {
+      bundle = await this.load(url);
+    } catch (error) {
+      delete this.bundles[url];
+      label.textContent = "Could not load the ICD code bundle: " + error.message;
+      return;
+    }
+    const rows = this.match(bundle, term).map((i) => {
+      const code = bundle.codes[i];
+      return {code: code.length > 3 ? code.slice(0, 3) + "." + code.slice(3) : code, description: bundle.descs[i]};
+    });
+    getElement(gridId).api.setGridOption("rowData", rows);
+    label.textContent = term.trim() ? `${term} returned ${rows.length} results` : "";
+  },
+};
+</script>
+"""
+
+
+async def icd_search(term, offset=0, count=ICD_PAGE_SIZE, fuzzy=False, dos=None, pinned=()):
+    """Search the local index, or the NIH API when the order file is missing and the fallback is enabled"""
+    index = get_icd_index()
+    if index is not None:
+        return index.search(term, offset, count, fuzzy, dos, pinned)
+    if ICD_API_FALLBACK:
+        # API results are shared by every session through the process-wide cache
+        key = (normalize_icd_term(term), offset, count)
+        results = await icd_cache.get(key, lambda: icd_api.search(term, offset, count))
+        if results is None or not pinned:
+            return results
+        # Pinned codes can only be moved up within the fetched page
+        pinned = set(pinned)
+        return results[0], sorted(results[1], key=lambda pair: pair[0].replace(".", "") not in pinned)
+    return None
+
+
 class ICDLookup:
-    def __init__(self):
+    def __init__(self, provider=None):
+        self.provider = provider
+        self.favorites = None
         self.lookup_term = None
         self.lookup_lab = None
         self.ICDresults = None
         self.ICDcontainer = None
-
-    def icd_lookup(self):
+        self.fuzzy = None
+        self.in_browser = None
+        self.browser_term = None
+        self.bundle_url = None
+        self.mode = None
+        self.browse_path = None
+        self.bulk_codes = None
+        self.date_of_service = None
+        self.from_year = None
+        self.to_year = None
+        self.hcc_codes = None
+        self.hcc_download = None
+        self.hcc_panel = None
+        self.lookup_task = None
+        self.page_task = None
+        # Paging state of the current result set, rows themselves only live in the browser grid
+        self.query = ""
+        self.query_fuzzy = False
+        self.query_dos = None
+        self.query_pinned = ()
+        self.query_id = 0
+        self.total = 0
+        self.loaded = 0
+
+    search_columns = [
+        {"headerName": "Code", "field": "code", "width": "50px"},
+        {"headerName": "Description", "field": "description"},
+    ]
+    browse_columns = [
+        {"headerName": "Code", "field": "code", "width": "50px"},
+        {"headerName": "Description", "field": "description"},
+        {"headerName": "Billable Codes", "field": "billable", "width": "50px"},
+    ]
+    bulk_columns = [
+        {"headerName": "Entered", "field": "input", "width": "60px"},
+        {"headerName": "Code", "field": "code", "width": "60px"},
+        {"headerName": "No Dot", "field": "code_nodot", "width": "60px"},
+        {"headerName": "Status", "field": "status", "width": "60px", "filter": "agTextColumnFilter", "floatingFilter": True},
+        {"headerName": "Description", "field": "description"},
+        {"headerName": "Effective", "field": "effective", "width": "60px"},
+        {"headerName": "Terminated", "field": "terminated", "width": "60px"},
+    ]
+    changes_columns = [
+        {"headerName": "Code", "field": "code", "width": "50px"},
+        {"headerName": "Change", "field": "change", "width": "50px", "filter": "agTextColumnFilter", "floatingFilter": True},
+        {"headerName": "Description", "field": "description"},
+    ]
+    hcc_columns = [
+        {"headerName": "HCC", "field": "hcc", "width": "40px"},
+        {"headerName": "Description", "field": "description"},
+        {"headerName": "Codes", "field": "codes", "width": "60px"},
+        {"headerName": "Coefficient", "field": "coefficient", "width": "50px"},
+        {"headerName": "Status", "field": "status", "width": "60px"},
+    ]
+    panel_columns = [
+        {"headerName": "Patient", "field": "patient", "width": "60px", "filter": "agTextColumnFilter", "floatingFilter": True},
+        {"headerName": "HCCs", "field": "hccs"},
+        {"headerName": "After Hierarchies", "field": "kept"},
+        {"headerName": "Risk Score", "field": "score", "width": "50px", "sort": "desc"},
+    ]
+
+    def set_rows(self, rows):
+        # Update the grid in place, only the rows are sent to the browser
+        self.ICDresults.options["rowData"] = rows
+        self.ICDresults.run_grid_method("setGridOption", "rowData", rows)
+
+    async def icd_lookup(self):
         if self.lookup_lab is None or self.ICDresults is None or self.ICDcontainer is None:
             print("UI components are not initialized. Please call ICD_UI_SetUp first.")
             return
 
-        url = "https://clinicaltables.nlm.nih.gov/api/icd10cm/v3/search?sf=code,name&terms="
+        # A newer search cancels the one still in flight, so stale results never overwrite fresh ones
+        if self.lookup_task is not None and self.lookup_task is not asyncio.current_task():
+            self.lookup_task.cancel()
+        if self.page_task is not None:
+            self.page_task.cancel()
+        self.lookup_task = asyncio.current_task()
+
+        term = self.lookup_term.value
+        self.query_id += 1
+        self.query = term
+        self.query_fuzzy = self.fuzzy.value
+        self.total = 0
+        try:
+            self.query_dos = parse_date_of_service(self.date_of_service.value)
+        except ValueError as e:
+            ui.notify(str(e), position="center", type="negative")
+            return
+        self.query_pinned = tuple(code_usage.top(self.provider_name(), "icd"))
+        self.loaded = 0
+        if not term.strip():
+            self.lookup_lab.set_text("")
+            self.set_rows([])
+            return
 
         # Get results
-        response = requests.get(url + self.lookup_term.value)
-        data = json.loads(response.content)
-        nresults = data[0]
-        icd_codes = data[1]
-        # Already a list of pairs, no need to convert
-        icd_pairs = dict(data[3])
-
-        # Clear all
-        self.lookup_lab.clear()
-        self.ICDresults.clear()
-        self.ICDcontainer.remove(0)
-
-        self.lookup_lab.set_text(f"{self.lookup_term.value} returned {nresults} results")
-        self.lookup_lab.style("font-size: 14px")
-
-        # Add results to table
-        df = pd.DataFrame(icd_pairs.items())
-
-        with self.ICDcontainer.classes("w-full items-center").style("align-items: center;"):
-            self.ICDresults = ui.aggrid.from_pandas(df).style("width:60%; min-height: 500px")
-        
-        self.ICDresults.options["columnDefs"][0]["width"] = "50px"
-        self.ICDresults.options["columnDefs"][0]["headerName"] = "Code"
-        self.ICDresults.options["columnDefs"][1]["headerName"] = "Description"
+        try:
+            results = await icd_search(term, fuzzy=self.query_fuzzy, dos=self.query_dos, pinned=self.query_pinned)
+        except ValueError as e:
+            ui.notify(str(e), position="center", type="negative")
+            self.set_rows([])
+            return
+        except httpx.HTTPError as e:
+            ui.notify(f"ICD lookup failed: {str(e)}", position="center", type="negative")
+            return
+        if results is None:
+            ui.notify(f"ICD code file {ICD_ORDER_FILE} not found.", position="center", type="negative")
+            return
+        nresults, icd_pairs = results
+
+        self.total = nresults
+        self.loaded = len(icd_pairs)
+        label = f"{term} returned {nresults} results"
+        if get_icd_index() is None and nresults > ICD_API_MAX_RESULTS:
+            # Scrolling stops at the API's result limit
+            self.total = ICD_API_MAX_RESULTS
+            label += f", the first {ICD_API_MAX_RESULTS} can be shown"
+        self.lookup_lab.set_text(label)
+        self.set_rows([{"code": code, "description": desc} for code, desc in icd_pairs])
+
+    async def load_next_page(self, e):
+        # Stream the next page into the grid once the user scrolls close to the last loaded row
+        if self.page_task is not None or self.loaded >= self.total or e.args.get("lastRow") is None:
+            return
+        if e.args["lastRow"] < self.loaded - ICD_PREFETCH_ROWS:
+            return
+
+        self.page_task = asyncio.current_task()
+        query_id = self.query_id
+        try:
+            results = await icd_search(self.query, self.loaded, fuzzy=self.query_fuzzy, dos=self.query_dos,
+                                       pinned=self.query_pinned)
+        except httpx.HTTPError as e:
+            ui.notify(f"ICD lookup failed: {str(e)}", position="center", type="negative")
+            return
+        finally:
+            self.page_task = None
+        if results is None or query_id != self.query_id:
+            return
+
+        icd_pairs = results[1]
+        if not icd_pairs:
+            self.total = self.loaded
+            return
+        self.loaded += len(icd_pairs)
+        rows = [{"code": code, "description": desc} for code, desc in icd_pairs]
+        self.ICDresults.run_grid_method("applyTransaction", {"add": rows})
+
+    async def live_lookup(self):
+        # Debounce keystrokes: the next keystroke cancels this task while it waits
+        if self.lookup_task is not None:
+            self.lookup_task.cancel()
+        self.lookup_task = asyncio.current_task()
+        await asyncio.sleep(ICD_DEBOUNCE)
+        await self.icd_lookup()
+
+    def set_mode(self):
+        # Every mode shares the result grid, switching replaces its columns and rows
+        for task in (self.lookup_task, self.page_task):
+            if task is not None:
+                task.cancel()
+        self.query_id += 1
+        self.total = 0
+        self.loaded = 0
+        self.lookup_lab.set_text("")
+        self.ICDresults.options["columnDefs"] = {
+            1: self.search_columns, 2: self.browse_columns, 3: self.bulk_columns, 4: self.changes_columns,
+            5: self.hcc_columns,
+        }[self.mode.value]
+        self.ICDresults.options["rowData"] = []
+        self.ICDresults.update()
+        if self.mode.value == 2:
+            self.open_node(None)
+        if self.mode.value == 4:
+            self.show_changes()
+
+    def open_node(self, node):
+        index = get_icd_index()
+        if index is None:
+            ui.notify(f"Browsing needs the ICD code file {ICD_ORDER_FILE}.", position="center", type="negative")
+            return
+        hierarchy = index.hierarchy
+
+        # Breadcrumb back up to the chapters
+        self.browse_path.clear()
+        with self.browse_path:
+            ui.button("Chapters", on_click=lambda: self.open_node(None)).props("flat dense no-caps")
+            for parent in hierarchy.path(node) if node is not None else []:
+                code = hierarchy.label(parent)[0]
+                ui.label("/")
+                ui.button(code, on_click=lambda parent=parent: self.open_node(parent)).props("flat dense no-caps")
+
+        if node is None:
+            self.lookup_lab.set_text(f"{len(hierarchy.chapters)} chapters")
+        else:
+            code, desc = hierarchy.label(node)
+            self.lookup_lab.set_text(f"{code} {desc}: {hierarchy.billable_counts[node]} billable codes")
+        self.set_rows(hierarchy.rows(node))
+
+    def bulk_validate(self):
+        index = get_icd_index()
+        if index is None:
+            ui.notify(f"Bulk validation needs the ICD code file {ICD_ORDER_FILE}.", position="center", type="negative")
+            return
+
+        codes = [code for code in re.split(r"[\s,;]+", self.bulk_codes.value or "") if code]
+        try:
+            df = index.validate(codes, parse_date_of_service(self.date_of_service.value))
+        except ValueError as e:
+            ui.notify(str(e), position="center", type="negative")
+            return
+        df["status"] = np.where(df["billable"], "Billable", np.where(df["valid"], "Header", "Invalid"))
+
+        code_usage.record(self.provider_name(), "icd", df.loc[df["valid"], "code_nodot"].tolist())
+        self.show_favorites()
+
+        nvalid = int(df["valid"].sum())
+        self.lookup_lab.set_text(
+            f"{len(df)} codes: {nvalid} valid ({int(df['billable'].sum())} billable), {len(df) - nvalid} invalid"
+        )
+        self.set_rows(df[["input", "code", "code_nodot", "status", "description", "effective", "terminated"]].to_dict("records"))
+
+    def show_changes(self):
+        index = get_icd_index()
+        if index is None or len(index.years) < 2:
+            self.lookup_lab.set_text("Code set changes need CMS order files for at least two fiscal years (icd10cm_order_YYYY.txt).")
+            self.set_rows([])
+            return
+        if (self.from_year.value, self.to_year.value) not in index.changes:
+            self.lookup_lab.set_text("Pick an earlier From year than To year.")
+            self.set_rows([])
+            return
+
+        rows = index.code_changes(self.from_year.value, self.to_year.value)
+        nadded = sum(row["change"] == "Added" for row in rows)
+        self.lookup_lab.set_text(
+            f"FY{self.from_year.value} to FY{self.to_year.value}: {nadded} codes added, {len(rows) - nadded} deleted"
+        )
+        self.set_rows(rows)
+
+    def set_columns(self, columns):
+        if self.ICDresults.options["columnDefs"] is not columns:
+            self.ICDresults.options["columnDefs"] = columns
+            self.ICDresults.options["rowData"] = []
+            self.ICDresults.update()
+
+    def hcc_score(self):
+        model = get_hcc_model()
+        if model is None:
+            ui.notify(f"Risk scoring needs {HCC_MAPPING_FILE}, {HCC_COEFFICIENT_FILE} and {HCC_HIERARCHY_FILE}.",
+                      position="center", type="negative")
+            return
+
+        codes = [code for code in re.split(r"[\s,;]+", self.hcc_codes.value or "") if code]
+        rows, score = model.explain(codes)
+        self.hcc_panel = None
+        self.hcc_download.set_visibility(False)
+        self.lookup_lab.set_text(f"{len(codes)} codes, {len(rows)} HCCs, risk score {score:.3f}")
+        self.set_columns(self.hcc_columns)
+        self.set_rows(rows)
+
+    async def hcc_upload(self, e):
+        model = get_hcc_model()
+        if model is None:
+            ui.notify(f"Risk scoring needs {HCC_MAPPING_FILE}, {HCC_COEFFICIENT_FILE} and {HCC_HIERARCHY_FILE}.",
+                      position="center", type="negative")
+            return
+
+        # One row per diagnosis (patient_id, code) or per patient (patient_id, codes separated by spaces/commas)
+        try:
+            df = await run.io_bound(pd.read_csv, e.content, dtype=str, keep_default_na=False)
+        except (ValueError, pd.errors.ParserError) as error:
+            ui.notify(f"Could not read {e.name}: {error}", position="center", type="negative")
+            return
+        if "patient_id" not in df.columns or not {"code", "codes"} & set(df.columns):
+            ui.notify("The CSV needs a patient_id column and a code or codes column.", position="center", type="negative")
+            return
+        if "code" not in df.columns:
+            # Patients without codes stay in the panel with a score of 0
+            df = df.assign(code=df["codes"].str.split(r"[\s,;]+")).explode("code")
+
+        self.hcc_panel = await run.io_bound(model.score_panel, df["patient_id"].to_numpy(), df["code"].to_numpy())
+        self.hcc_download.set_visibility(True)
+        self.lookup_lab.set_text(
+            f"{e.name}: {len(self.hcc_panel)} patients, mean risk score {self.hcc_panel['score'].mean():.3f}"
+        )
+        self.set_columns(self.panel_columns)
+        self.set_rows(self.hcc_panel.to_dict("records"))
+
+    def hcc_save(self):
+        if self.hcc_panel is not None:
+            ui.download(self.hcc_panel.to_csv(index=False).encode(), filename="hcc_risk_scores.csv", media_type="text/csv")
+
+    def provider_name(self):
+        return self.provider.value if self.provider is not None else None
+
+    def show_favorites(self):
+        # Quick pick chips for the provider's most used codes, clicking one searches for it
+        self.favorites.clear()
+        with self.favorites:
+            for code in code_usage.top(self.provider_name(), "icd"):
+                ui.chip(format_icd_code(code), on_click=lambda code=code: self.pick_favorite(code)).props("outline")
+
+    def pick_favorite(self, code):
+        self.mode.value = 1
+        self.in_browser.value = False
+        self.lookup_term.value = format_icd_code(code)
+
+    def grid_click(self, e):
+        data = e.args.get("data") or {}
+        if self.mode.value == 2 and data.get("children"):
+            self.open_node(data["node"])
+        if self.mode.value == 1 and data.get("code"):
+            code_usage.record(self.provider_name(), "icd", [data["code"].replace(".", "")])
+            self.show_favorites()
 
     def ICD_reset(self):
         if self.ICDcontainer is None:
             print("ICD container is not initialized. Please call ICD_UI_SetUp first.")
             return
 
-        self.ICDcontainer.remove(0)
-        with self.ICDcontainer.classes("w-full items-center").style("align-items: center;"):
-            self.ICDresults = ui.aggrid({}).style("width:60%; min-height: 500px; padding-top: 20px")
+        if self.mode.value == 2:
+            self.open_node(None)
+            return
+        if self.mode.value == 3:
+            self.bulk_codes.value = ""
+            self.lookup_lab.set_text("")
+            self.set_rows([])
+            return
+        if self.mode.value == 5:
+            self.hcc_codes.value = ""
+            self.hcc_panel = None
+            self.hcc_download.set_visibility(False)
+            self.lookup_lab.set_text("")
+            self.set_columns(self.hcc_columns)
+            self.set_rows([])
+            return
+        if self.in_browser.value:
+            ui.run_javascript(f'document.getElementById("c{self.browser_term.id}").value = ""')
+        self.lookup_term.value = ""
+        self.lookup_lab.set_text("")
+        self.set_rows([])
+
+    def set_search_location(self):
+        # Searching in the browser shows its own results, start both ways from an empty grid
+        self.lookup_term.value = ""
+        self.lookup_lab.set_text("")
+        self.set_rows([])
+        if self.in_browser.value:
+            ui.run_javascript(f'document.getElementById("c{self.browser_term.id}").value = ""; icdBundle.load("{self.bundle_url}")')
 
     def ICD_UI_SetUp(self):
         with ui.column().classes("w-full items-center").style("align-items: center;"):
             ui.label("ICD10 Lookup").style("font-weight: bold; font-size: 25px;")
             ui.separator().style('width: 85%')
 
-            self.lookup_term = ui.input("Enter Code or Term to lookup").style("width: 60%")
-            with ui.row():
-                ui.button("Search", on_click=self.icd_lookup).style("width:150px")
-                ui.button("Reset", on_click=self.ICD_reset).style("width:150px")
+            self.mode = ui.toggle({1: "Search", 2: "Browse", 3: "Bulk Validate", 4: "Changes", 5: "Risk Score"},
+                                  value=1, on_change=self.set_mode)
+
+            # The selected provider's most used codes
+            self.favorites = ui.row().classes("items-center")
+            self.show_favorites()
+            if self.provider is not None:
+                self.provider.on_value_change(self.show_favorites)
+
+            # Date of service picks the fiscal year code set for searching and validating, empty means the latest
+            with ui.input("Date of Service (latest code set if empty)").bind_visibility_from(
+                    self.mode, "value", backward=lambda mode: mode in (1, 3)).style("width: 300px") as self.date_of_service:
+                with ui.menu().props('no-parent-event') as menu:
+                    with ui.date(mask='MM/DD/YYYY').bind_value(self.date_of_service):
+                        with ui.row().classes('justify-end'):
+                            ui.button('Today', on_click=lambda: self.date_of_service.set_value(datetime.now().strftime('%m/%d/%Y'))).props('flat')
+                            ui.button('Close', on_click=menu.close).props('flat')
+                    with self.date_of_service.add_slot('append'):
+                        ui.icon('edit_calendar').on('click', menu.open).classes('cursor-pointer')
+
+            # Search Container
+            search_container = ui.column().bind_visibility_from(self.mode, "value", value=1)
+            with search_container.classes("w-full items-center").style("align-items: center;"):
+                self.lookup_term = ui.input("Enter Code or Term to lookup", on_change=self.live_lookup).style("width: 60%")
+                # Browser side search: a plain input whose keystrokes never reach the server
+                self.browser_term = ui.element("input").props('placeholder="Enter Code or Term to lookup (searched in your browser)"')
+                self.browser_term.classes("q-pa-sm rounded-borders").style("width: 60%; border: 1px solid #606060; background: transparent; color: inherit;")
+                with ui.row().classes("items-center"):
+                    search_button = ui.button("Search", on_click=self.icd_lookup).style("width:150px")
+                    ui.button("Reset", on_click=self.ICD_reset).style("width:150px")
+                    self.fuzzy = ui.switch("Typo tolerant", on_change=self.icd_lookup)
+                    self.in_browser = ui.switch("Search in browser", on_change=self.set_search_location)
+                for element in (self.lookup_term, search_button, self.fuzzy):
+                    element.bind_visibility_from(self.in_browser, "value", backward=lambda value: not value)
+                self.browser_term.bind_visibility_from(self.in_browser, "value")
+
+                bundle = get_icd_bundle()
+                if bundle is None:
+                    self.in_browser.set_visibility(False)
+                else:
+                    self.bundle_url = f"/api/icd10/bundle/{bundle[0]}"
+                    ui.add_body_html(ICD_BUNDLE_JS)
+
+            # Browse Container
+            browse_container = ui.column().bind_visibility_from(self.mode, "value", value=2)
+            with browse_container.classes("w-full items-center").style("align-items: center;"):
+                self.browse_path = ui.row().classes("items-center")
+
+            # Bulk Validate Container
+            bulk_container = ui.column().bind_visibility_from(self.mode, "value", value=3)
+            with bulk_container.classes("w-full items-center").style("align-items: center;"):
+                self.bulk_codes = ui.textarea("Paste ICD-10 codes (one per line or comma separated)").style("width: 60%")
+                with ui.row():
+                    ui.button("Validate", on_click=self.bulk_validate).style("width:150px")
+                    ui.button("Reset", on_click=self.ICD_reset).style("width:150px")
+
+            # Changes Container
+            changes_container = ui.column().bind_visibility_from(self.mode, "value", value=4)
+            with changes_container.classes("w-full items-center").style("align-items: center;"):
+                index = get_icd_index()
+                years = index.years if index is not None and len(index.years) > 1 else []
+                with ui.row():
+                    self.from_year = ui.select(years, label="From FY", value=years[-2] if years else None,
+                                               on_change=self.show_changes).style("width:150px")
+                    self.to_year = ui.select(years, label="To FY", value=years[-1] if years else None,
+                                             on_change=self.show_changes).style("width:150px")
+
+            # Risk Score Container
+            hcc_container = ui.column().bind_visibility_from(self.mode, "value", value=5)
+            with hcc_container.classes("w-full items-center").style("align-items: center;"):
+                self.hcc_codes = ui.textarea("Paste a patient's diagnosis codes").style("width: 60%")
+                with ui.row():
+                    ui.button("Score", on_click=self.hcc_score).style("width:150px")
+                    ui.button("Reset", on_click=self.ICD_reset).style("width:150px")
+                    self.hcc_download = ui.button("Download Results", on_click=self.hcc_save).style("width:200px")
+                    self.hcc_download.set_visibility(False)
+                ui.upload(label="Or upload a patient panel CSV (patient_id, code or codes)", on_upload=self.hcc_upload,
+                          auto_upload=True).props("accept=.csv").style("width: 60%")
 
             self.ICDcontainer = ui.column()
             with self.ICDcontainer.classes("w-full items-center").style("align-items: center;"):
-                self.ICDresults = ui.aggrid({}).style("width:60%; min-height: 500px; padding-top: 20px")
+                self.ICDresults = ui.aggrid({
+                    "columnDefs": self.search_columns,
+                    "rowData": [],
+                }).style("width:60%; min-height: 500px; padding-top: 20px")
+                self.ICDresults.on("viewportChanged", self.load_next_page, ["lastRow"], throttle=0.1)
+                self.ICDresults.on("cellClicked", self.grid_click, ["data"])
 
             self.lookup_lab = ui.label("").style("font-size: 14px;")  # Initialize lookup_lab here
+            if self.bundle_url is not None:
+                self.browser_term.on("input", js_handler=(
+                    f'(e) => icdBundle.search("{self.bundle_url}", e.target.value, {self.ICDresults.id}, {self.lookup_lab.id})'
+                ))
 
             ui.html('ICD10 codes based on <a href="https://clinicaltables.nlm.nih.gov/" target="_blank" style="color: #6FA5D8;">NIH database</a>')
 
 
+#%% ========== Chart Export ======================================================================
+# Server side rendering of the tool charts (plotly + kaleido in NiceGUI's worker process pool) and a
+# byte bounded cache of the rendered files, keyed on the chart content
+CHART_EXPORT_FORMATS = {"png": "image/png", "svg": "image/svg+xml", "pdf": "application/pdf"}
+CHART_EXPORT_WIDTH = 1000
+CHART_EXPORT_HEIGHT = 500
+CHART_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+
+def render_chart(figure_json, fmt, width, height):
+    """Render a plotly figure given as JSON to image bytes, runs in a worker process"""
+    return go.Figure(json.loads(figure_json)).to_image(format=fmt, width=width, height=height)
+
+
+def highchart_figure(*charts):
+    """Plotly figure with the line series of one or more highchart option dicts side by side"""
+    fig = make_subplots(rows=1, cols=len(charts), subplot_titles=[chart["title"]["text"] for chart in charts])
+    for col, chart in enumerate(charts, 1):
+        for series in chart["series"]:
+            points = [point for point in series["data"] if point[1] is not None]
+            fig.add_trace(go.Scatter(
+                x=[point[0] for point in points],
+                y=[point[1] for point in points],
+                mode="lines+markers",
+                name=series["name"],
+                line=dict(color=series.get("color"), width=series.get("lineWidth", 2)),
+            ), row=1, col=col)
+        fig.update_xaxes(title_text=chart["xAxis"]["title"]["text"], row=1, col=col)
+        fig.update_yaxes(title_text=chart["yAxis"]["title"]["text"], row=1, col=col)
+    fig.update_layout(template="plotly_white")
+    return fig
+
+
+class ChartCache:
+    """Content addressed LRU of rendered charts: the same chart data in the same format renders once"""
+    def __init__(self, max_bytes=CHART_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # sha256 of format, size and figure JSON -> rendered bytes
+        self.nbytes = 0
+        self.pending = {}  # key -> in-flight render, shared by concurrent exports of the same chart
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, key, data):
+        self.entries[key] = data
+        self.nbytes += len(data)
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            self.nbytes -= len(self.entries.popitem(last=False)[1])
+            self.evictions += 1
+
+    async def render_new(self, key, figure_json, fmt, width, height):
+        try:
+            data = await run.cpu_bound(render_chart, figure_json, fmt, width, height)
+            if data is not None:  # None when the app is shutting down
+                self.put(key, data)
+            return data
+        finally:
+            del self.pending[key]
+
+    async def render(self, fig, fmt, width=CHART_EXPORT_WIDTH, height=CHART_EXPORT_HEIGHT):
+        """Rendered bytes of a plotly figure, from the cache when the same chart was exported before"""
+        figure_json = fig.to_json()
+        key = hashlib.sha256(f"{fmt}:{width}x{height}:{figure_json}".encode()).hexdigest()
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self.render_new(key, figure_json, fmt, width, height))
+        return await asyncio.shield(self.pending[key])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+chart_cache = ChartCache()
+
+
+@app.get("/api/charts/cache")
+def chart_cache_stats():
+    return chart_cache.stats()
+
+
+async def export_chart(fig, fmt, name):
+    """Render fig through the cache and send it to the browser as name.fmt"""
+    try:
+        data = await chart_cache.render(fig, fmt)
+    except Exception as e:
+        ui.notify(f"Chart export failed: {str(e)}", position="center", type="negative")
+        return
+    if data is not None:
+        ui.download(data, filename=f"{name}.{fmt}", media_type=CHART_EXPORT_FORMATS[fmt])
+
+
 #%% ========== Insulin & Glucose Plot ============================================================
+# Kraft insulin response patterns (uIU/ml at the OGTT sample times) used both for the chart and the classifier
+INSULIN_TIMES = [0, 30, 60, 120]
+INSULIN_PATTERNS = {
+    "Pattern 1": [8, 59, 61, 30],
+    "Pattern 2": [13, 93, 116, 80],
+    "Pattern 3": [13, 64, 93, 133],
+    "Pattern 4": [56, 147, 165, 185],
+    "Pattern 5": [5, 15, 16, 15],
+}
+INSULIN_PATTERN_COLORS = ["#9FE9EF", "#62D1E4", "#25B0DA", "#1B749D", "#104060"]
+# Classifier cost = RMS log distance + weight * (1 - shape correlation), confidence is a softmax over -cost / temperature
+INSULIN_SHAPE_WEIGHT = 0.5
+INSULIN_TEMPERATURE = 0.15
+# Batch panels are read this many rows at a time, only the first OGTT_PREVIEW_ROWS results are shown in the table
+OGTT_CHUNK_ROWS = 50000
+OGTT_PREVIEW_ROWS = 1000
+OGTT_HOMA_BINS = [0, 1, 2, 3, 4, 5, np.inf]
+OGTT_HOMA_LABELS = ["<1", "1-2", "2-3", "3-4", "4-5", "5+"]
+# CGM exports: the timestamp, record type and glucose columns of each supported format and the record type kept
+# (Dexcom estimated glucose values, Libre historic readings; Libre scans duplicate them). Readings outside the
+# sensor range are exported as text and counted at that sensor's limits (mg/dL): Dexcom "Low"/"High" at 40/400,
+# Libre "LO"/"HI" at 40/500.
+CGM_FORMATS = {
+    "Dexcom": {"timestamp": "Timestamp (YYYY-MM-DDThh:mm:ss)", "type": "Event Type", "keep": "EGV",
+               "glucose": "Glucose Value", "text": {"low": 40, "high": 400}},
+    "Libre": {"timestamp": "Device Timestamp", "type": "Record Type", "keep": "0", "glucose": "Historic Glucose",
+              "text": {"lo": 40, "hi": 500}},
+}
+CGM_TIMESTAMP_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%m-%d-%Y %I:%M %p", "%m-%d-%Y %H:%M", "%d-%m-%Y %H:%M",
+                         "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"]
+CGM_MMOL_TO_MGDL = 18.018
+CGM_CHUNK_ROWS = 50000
+# Consensus ranges (mg/dL): very low <54, low 54-69, in range 70-180, high 181-250, very high >250
+CGM_RANGE_BINS = [0, 54, 70, 181, 251, np.inf]
+CGM_RANGE_LABELS = ["Very Low", "Low", "In Range", "High", "Very High"]
+CGM_RANGE_COLORS = ["#8B0000", "#E53935", "#43A047", "#FDD835", "#FB8C00"]
+CGM_AGP_BIN_MINUTES = 15
+CGM_AGP_PERCENTILES = [5, 25, 50, 75, 95]
+# The glucose trace is thinned to about this many points for the browser, gaps longer than CGM_GAP_MINUTES are left open
+CGM_DISPLAY_POINTS = 2000
+CGM_GAP_MINUTES = 60
+
+
+class InsulinPatternClassifier:
+    """Nearest Kraft pattern for whole batches of insulin curves with matrix operations
+
+    Curves are resampled onto the pattern times, compared in log space (so a doubled response is the
+    same distance at any level) and by shape (correlation of the centered curves).
+    """
+    def __init__(self, times=INSULIN_TIMES, patterns=INSULIN_PATTERNS):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.names = list(patterns)
+        self.patterns = np.log1p(np.array(list(patterns.values()), dtype=np.float64))
+        self.pattern_norms = (self.patterns ** 2).sum(axis=1)
+        self.pattern_shapes = self.shapes(self.patterns)
+
+    @staticmethod
+    def shapes(curves):
+        """Rows centered and scaled to unit length, flat rows stay zero"""
+        centered = curves - curves.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(centered, axis=1, keepdims=True)
+        return np.divide(centered, norms, out=np.zeros_like(centered), where=norms > 0)
+
+    def interpolation_matrix(self, times):
+        """Linear operator taking values sampled at times to the pattern times (held flat outside the range)"""
+        times = np.asarray(times, dtype=np.float64)
+        return np.stack([np.interp(self.times, times, row) for row in np.eye(len(times))], axis=1)
+
+    @staticmethod
+    def fill_missing(values):
+        """Linearly interpolate NaNs along each row from the nearest measured neighbours, in one pass"""
+        values = np.array(values, dtype=np.float64)
+        missing = np.isnan(values)
+        if not missing.any():
+            return values
+        n, m = values.shape
+        columns = np.broadcast_to(np.arange(m), (n, m))
+        previous = np.maximum.accumulate(np.where(missing, -1, columns), axis=1)
+        following = np.minimum.accumulate(np.where(missing, m, columns)[:, ::-1], axis=1)[:, ::-1]
+        # Hold the first/last measured value flat beyond the ends
+        left = np.where(previous < 0, following, previous)
+        right = np.where(following >= m, left, following)
+        rows = np.arange(n)[:, None]
+        span = np.where(right > left, right - left, 1)
+        weight = np.where(right > left, (columns - left) / span, 0)
+        left_values = values[rows, np.minimum(left, m - 1)]
+        right_values = values[rows, np.minimum(right, m - 1)]
+        return np.where(missing, left_values + weight * (right_values - left_values), values)
+
+    def classify(self, values, times=None):
+        """Best pattern index, its confidence and all pattern probabilities for each row of values
+
+        values: curves x samples (NaN for a missing sample), taken at times (default: the pattern times).
+        Rows without any measured value get a NaN confidence.
+        """
+        values = self.fill_missing(np.atleast_2d(values))
+        if times is not None:
+            values = values @ self.interpolation_matrix(times).T
+        curves = np.log1p(np.clip(values, 0, None))
+
+        # Squared distances to every pattern from one matrix product: |x|^2 + |p|^2 - 2 x.p
+        distances = (curves ** 2).sum(axis=1, keepdims=True) + self.pattern_norms - 2 * curves @ self.patterns.T
+        distances = np.sqrt(np.clip(distances, 0, None) / len(self.times))
+        correlation = self.shapes(curves) @ self.pattern_shapes.T
+        cost = distances + INSULIN_SHAPE_WEIGHT * (1 - correlation)
+
+        logits = -cost / INSULIN_TEMPERATURE
+        probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        best = probabilities.argmax(axis=1)
+        return best, probabilities[np.arange(len(best)), best], probabilities
+
+
+insulin_classifier = InsulinPatternClassifier()
+
+
+def ogtt_columns(columns):
+    """(minutes, column) pairs of the glucose_<minutes> and insulin_<minutes> columns, in time order"""
+    found = {"glucose": [], "insulin": []}
+    for column in columns:
+        match = re.fullmatch(r"(glucose|insulin)_(\d+)", str(column).strip().lower())
+        if match:
+            found[match.group(1)].append((int(match.group(2)), column))
+    return {kind: sorted(pairs) for kind, pairs in found.items()}
+
+
+def ogtt_metrics(chunk, columns):
+    """AUCs (trapezoidal), HOMA-IR, Matsuda index and insulin pattern for a chunk of patients at once"""
+    glucose_times, glucose_columns = zip(*columns["glucose"])
+    insulin_times, insulin_columns = zip(*columns["insulin"])
+    glucose = chunk[list(glucose_columns)].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+    insulin = chunk[list(insulin_columns)].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+    no_fasting = np.full(len(chunk), np.nan)
+    g0 = glucose[:, 0] if glucose_times[0] == 0 else no_fasting
+    i0 = insulin[:, 0] if insulin_times[0] == 0 else no_fasting
+
+    best, confidence, probabilities = insulin_classifier.classify(insulin, insulin_times)
+    names = np.array(insulin_classifier.names, dtype=object)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        glucose_mean = np.nansum(glucose, axis=1) / (~np.isnan(glucose)).sum(axis=1)
+        insulin_mean = np.nansum(insulin, axis=1) / (~np.isnan(insulin)).sum(axis=1)
+        return pd.DataFrame({
+            "patient_id": chunk["patient_id"].to_numpy(),
+            "glucose_auc": np.trapz(InsulinPatternClassifier.fill_missing(glucose), glucose_times, axis=1).round(1),
+            "insulin_auc": np.trapz(InsulinPatternClassifier.fill_missing(insulin), insulin_times, axis=1).round(1),
+            "homa_ir": (g0 * i0 / 405).round(2),
+            "matsuda": (10000 / np.sqrt(g0 * i0 * glucose_mean * insulin_mean)).round(2),
+            "pattern": np.where(np.isnan(confidence), "", names[best]),
+            "confidence": confidence.round(3),
+        })
+
+
+def process_ogtt_panel(source, output_path, chunksize=OGTT_CHUNK_ROWS):
+    """Stream a panel CSV through ogtt_metrics a chunk at a time and write the results to output_path
+
+    Only running totals and the first OGTT_PREVIEW_ROWS results are kept, so memory does not grow with the file.
+    """
+    patterns = np.zeros(len(insulin_classifier.names), dtype=np.int64)
+    homa = np.zeros(len(OGTT_HOMA_LABELS), dtype=np.int64)
+    patients = 0
+    preview = []
+    columns = None
+    with open(output_path, "w", newline="") as output:
+        for chunk in pd.read_csv(source, chunksize=chunksize, dtype={"patient_id": str}):
+            if columns is None:
+                columns = ogtt_columns(chunk.columns)
+                if "patient_id" not in chunk.columns or len(columns["glucose"]) < 2 or len(columns["insulin"]) < 2:
+                    raise ValueError("The CSV needs a patient_id column and at least two glucose_<minutes> "
+                                     "and two insulin_<minutes> columns.")
+            results = ogtt_metrics(chunk, columns)
+            results.to_csv(output, header=patients == 0, index=False)
+
+            patients += len(results)
+            classified = results["pattern"] != ""
+            patterns += np.bincount(pd.Index(insulin_classifier.names).get_indexer(results.loc[classified, "pattern"]),
+                                    minlength=len(patterns))
+            homa += np.histogram(results["homa_ir"].dropna(), bins=OGTT_HOMA_BINS)[0]
+            if sum(map(len, preview)) < OGTT_PREVIEW_ROWS:
+                preview.append(results.head(OGTT_PREVIEW_ROWS - sum(map(len, preview))))
+    if columns is None:
+        raise ValueError("The CSV has no patients.")
+    return {"patients": patients, "patterns": patterns.tolist(), "homa": homa.tolist()}, pd.concat(preview)
+
+
+def cgm_header(lines):
+    """(format name, header row number, glucose column) of a CGM export from its first lines"""
+    for row, line in enumerate(lines):
+        columns = next(csv.reader([line]), [])
+        for name, spec in CGM_FORMATS.items():
+            glucose = [column for column in columns if column.startswith(spec["glucose"])]
+            if spec["timestamp"] in columns and glucose:
+                return name, row, glucose[0]
+    raise ValueError("Not a Dexcom or Libre CSV export.")
+
+
+def read_cgm_export(source, chunksize=CGM_CHUNK_ROWS):
+    """Timestamps (datetime64[s]) and glucose (mg/dL) of a Dexcom or Libre CSV export, sorted and de-duplicated
+
+    source is a path or a binary file. The export is parsed a chunk at a time and only the readings are kept.
+    """
+    text = open(source, encoding="utf-8-sig", newline="") if isinstance(source, str) else \
+        io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+    with text:
+        name, row, glucose_column = cgm_header([text.readline() for _ in range(5)])
+        spec = CGM_FORMATS[name]
+        scale = CGM_MMOL_TO_MGDL if "mmol" in glucose_column.lower() else 1
+        text.seek(0)
+        times, values = [], []
+        timestamp_format = None
+        for chunk in pd.read_csv(text, skiprows=row, usecols=[spec["timestamp"], spec["type"], glucose_column],
+                                 dtype=str, chunksize=chunksize):
+            chunk = chunk[chunk[spec["type"]].str.strip() == spec["keep"]]
+            stamps = chunk[spec["timestamp"]].str.strip()
+            if timestamp_format is None and len(chunk):
+                timestamp_format = next((fmt for fmt in CGM_TIMESTAMP_FORMATS
+                                         if pd.to_datetime(stamps, format=fmt, errors="coerce").notna().all()), None)
+                if timestamp_format is None:
+                    raise ValueError(f"Unrecognized timestamp format: {stamps.iloc[0]}")
+            glucose = pd.to_numeric(chunk[glucose_column], errors="coerce") * scale
+            text_readings = chunk[glucose_column].str.strip().str.lower().map(spec["text"])
+            times.append(pd.to_datetime(stamps, format=timestamp_format, errors="coerce").to_numpy("datetime64[s]"))
+            values.append(glucose.fillna(text_readings).to_numpy(dtype=np.float64))
+    if not times:
+        raise ValueError("The export has no glucose readings.")
+    times, values = np.concatenate(times), np.concatenate(values)
+    valid = ~np.isnat(times) & ~np.isnan(values)
+    times, first = np.unique(times[valid], return_index=True)
+    if not len(times):
+        raise ValueError("The export has no glucose readings.")
+    return name, times, values[valid][first]
+
+
+def grouped_percentiles(groups, values, percentiles, n_groups):
+    """Percentiles (linear interpolation, like np.percentile) of values within each group, NaN for empty groups
+
+    One sort for all groups instead of a percentile call per group.
+    """
+    values = values[np.lexsort((values, groups))]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    positions = starts[:, None] + (counts[:, None] - 1) * (np.asarray(percentiles, dtype=np.float64) / 100)
+    positions = np.clip(positions, 0, len(values) - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    result = values[lower] + (positions - lower) * (values[upper] - values[lower])
+    result[counts == 0] = np.nan
+    return result
+
+
+def downsample_min_max(x, y, points=CGM_DISPLAY_POINTS):
+    """Thin a series to about points by keeping the lowest and highest value of each bucket, so excursions survive"""
+    if len(y) <= points:
+        return x, y
+    buckets = np.arange(len(y)) * (points // 2) // len(y)
+    order = np.lexsort((y, buckets))
+    ends = np.cumsum(np.bincount(buckets))
+    starts = np.concatenate([[0], ends[:-1]])
+    keep = np.unique(np.concatenate([order[starts], order[ends - 1]]))
+    return x[keep], y[keep]
+
+
+def cgm_metrics(times, glucose):
+    """Time in ranges, mean, GMI, CV and sensor wear over a CGM export, plus the AGP percentile bands"""
+    span = (times[-1] - times[0]).astype(np.int64)
+    interval = np.median(np.diff(times).astype(np.int64)) if len(times) > 1 else 300
+    mean = glucose.mean()
+    ranges = np.histogram(glucose, bins=CGM_RANGE_BINS)[0] / len(glucose) * 100
+
+    minutes = (times - times.astype("datetime64[D]")).astype(np.int64) // 60
+    bins = 24 * 60 // CGM_AGP_BIN_MINUTES
+    agp = grouped_percentiles(minutes // CGM_AGP_BIN_MINUTES, glucose, CGM_AGP_PERCENTILES, bins)
+    return {
+        "start": str(times[0].astype("datetime64[D]")),
+        "end": str(times[-1].astype("datetime64[D]")),
+        "days": span / 86400,
+        "readings": len(glucose),
+        "active": min(100.0, len(glucose) / (span / interval + 1) * 100),
+        "mean": mean,
+        "gmi": 3.31 + 0.02392 * mean,
+        "cv": glucose.std() / mean * 100,
+        "ranges": ranges.round(1).tolist(),
+        "agp_minutes": np.arange(bins) * CGM_AGP_BIN_MINUTES,
+        "agp": agp,
+    }
+
+
+def analyze_cgm(source):
+    """Read a CGM export and compute its metrics and a display sized glucose trace"""
+    name, times, glucose = read_cgm_export(source)
+    metrics = cgm_metrics(times, glucose)
+    trace_times, trace_glucose = downsample_min_max(times, glucose)
+    # Break the line over sensor gaps with a null point just after the last reading before each gap
+    gaps = np.flatnonzero(np.diff(times).astype(np.int64) > CGM_GAP_MINUTES * 60)
+    trace_times = np.concatenate([trace_times, times[gaps] + np.timedelta64(1, "s")])
+    trace_glucose = np.concatenate([trace_glucose, np.full(len(gaps), np.nan)])
+    order = np.argsort(trace_times, kind="stable")
+    milliseconds = trace_times[order].astype("datetime64[ms]").astype(np.int64)
+    trace = [[int(t), None if np.isnan(g) else round(float(g))] for t, g in zip(milliseconds, trace_glucose[order])]
+    metrics["source"] = name
+    metrics["trace"] = trace
+    return metrics
+
+
+def patch_series_data(chart, index, data):
+    """Replace one series' points with Highcharts setData instead of re-sending the whole options tree
+
+    The server side options are kept in sync, so a later full update or a page reload shows the same data.
+    """
+    chart.options["series"][index]["data"] = data
+    chart.client.run_javascript(f"getElement({chart.id}).chart?.series[{index}].setData({json.dumps(data)})")
+
+
+def parse_lab_value(value):
+    """Float from an input box, NaN when it is left blank"""
+    return float(value) if value not in (None, "") else np.nan
+
+
 class InsulinGlucosePlot:
     def __init__(self):
         self.i1 = None
@@ -93,25 +1885,109 @@ class InsulinGlucosePlot:
         self.g4 = None
         self.insulin_chart = None
         self.glucose_chart = None
+        self.pattern_lab = None
+        self.export_format = None
+        self.mode = None
+        self.batch_lab = None
+        self.batch_download = None
+        self.batch_results = None
+        self.pattern_counts_chart = None
+        self.homa_chart = None
+        self.batch_path = None
+        self.cgm_lab = None
+        self.cgm_metrics_md = None
+        self.cgm_range_chart = None
+        self.agp_chart = None
+        self.cgm_trace_chart = None
+
+    async def batch_upload(self, e):
+        # Results go to a temporary file for download, the upload is never loaded whole
+        output = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+        output.close()
+        try:
+            summary, preview = await run.io_bound(process_ogtt_panel, e.content, output.name)
+        except (ValueError, pd.errors.ParserError) as error:
+            os.remove(output.name)
+            ui.notify(f"Could not process {e.name}: {error}", position="center", type="negative")
+            return
+        if self.batch_path is None:
+            ui.context.client.on_disconnect(self.batch_cleanup)
+        self.batch_cleanup()
+        self.batch_path = output.name
+
+        shown = f", first {len(preview)} shown" if len(preview) < summary["patients"] else ""
+        self.batch_lab.set_text(f"{e.name}: {summary['patients']} patients{shown}")
+        self.batch_download.set_visibility(True)
+        patch_series_data(self.pattern_counts_chart, 0, summary["patterns"])
+        patch_series_data(self.homa_chart, 0, summary["homa"])
+        self.batch_results.options["columnDefs"] = [{"headerName": column, "field": column} for column in preview.columns]
+        self.batch_results.options["rowData"] = json.loads(preview.to_json(orient="records"))
+        self.batch_results.update()
+
+    async def cgm_upload(self, e):
+        try:
+            metrics = await run.io_bound(analyze_cgm, e.content)
+        except (ValueError, pd.errors.ParserError) as error:
+            ui.notify(f"Could not read {e.name}: {error}", position="center", type="negative")
+            return
+
+        self.cgm_lab.set_text(f"{e.name}: {metrics['source']} export, {metrics['start']} to {metrics['end']} "
+                              f"({metrics['days']:.0f} days, {metrics['readings']} readings)")
+        ranges = "\n".join(f"| {label} | {percent:.1f}% |" for label, percent in zip(CGM_RANGE_LABELS, metrics["ranges"]))
+        self.cgm_metrics_md.set_content(
+            "| Metric | Value |\n| ------ | ----- |\n" + ranges + "\n"
+            f"| Mean Glucose | {metrics['mean']:.0f} mg/dL |\n"
+            f"| GMI | {metrics['gmi']:.1f}% |\n"
+            f"| Coefficient of Variation | {metrics['cv']:.1f}% |\n"
+            f"| CGM Active | {metrics['active']:.0f}% |\n"
+        )
+        for index, percent in enumerate(metrics["ranges"]):
+            patch_series_data(self.cgm_range_chart, index, [percent])
+        # AGP bands: 5-95% and 25-75% as area ranges and the median line, x in milliseconds since midnight
+        agp = np.where(np.isnan(metrics["agp"]), None, metrics["agp"].round(1)).tolist()
+        x = (metrics["agp_minutes"] * 60000).tolist()
+        patch_series_data(self.agp_chart, 0, [[t, p[0], p[4]] for t, p in zip(x, agp)])
+        patch_series_data(self.agp_chart, 1, [[t, p[1], p[3]] for t, p in zip(x, agp)])
+        patch_series_data(self.agp_chart, 2, [[t, p[2]] for t, p in zip(x, agp)])
+        patch_series_data(self.cgm_trace_chart, 0, metrics["trace"])
+
+    def batch_save(self):
+        if self.batch_path is not None:
+            ui.download(self.batch_path, filename="ogtt_results.csv")
+
+    def batch_cleanup(self):
+        if self.batch_path is not None and os.path.exists(self.batch_path):
+            os.remove(self.batch_path)
 
     def gather_data_ins_glu(self):
         if self.i1 is None or self.i2 is None or self.i3 is None or self.i4 is None:
             print("Input fields are not initialized. Please call InsGlu_UI_Setup first.")
             return
 
-        insulin = [self.i1.value, self.i2.value, self.i3.value, self.i4.value]
-        glucose = [self.g1.value, self.g2.value, self.g3.value, self.g4.value]
-        
-        for i, (ins, glu) in enumerate(zip(insulin, glucose)):
-            self.insulin_chart.options["series"][5]["data"][i][1] = float(ins)
-            self.glucose_chart.options["series"][3]["data"][i][1] = float(glu)
-        
-        self.insulin_chart.update()
-        self.glucose_chart.update()
+        try:
+            insulin = [parse_lab_value(i.value) for i in (self.i1, self.i2, self.i3, self.i4)]
+            glucose = [parse_lab_value(g.value) for g in (self.g1, self.g2, self.g3, self.g4)]
+        except ValueError:
+            ui.notify("Lab results must be numbers.", position="center", type="negative")
+            return
 
-    def save_chart_ins_glu(self):    
-        # Implement saving functionality here
-        pass
+        # Only the patient series change, missing results are left as gaps
+        patch_series_data(self.insulin_chart, 5,
+                          [[t, None if np.isnan(ins) else ins] for t, ins in zip(INSULIN_TIMES, insulin)])
+        patch_series_data(self.glucose_chart, 3,
+                          [[t, None if np.isnan(glu) else glu] for t, glu in zip(INSULIN_TIMES, glucose)])
+
+        if np.isnan(insulin).sum() > len(insulin) - 2:
+            self.pattern_lab.set_text("Enter at least two insulin results to identify the pattern.")
+            return
+        best, confidence, probabilities = insulin_classifier.classify([insulin])
+        self.pattern_lab.set_text(
+            f"Closest insulin pattern: {insulin_classifier.names[best[0]]} ({confidence[0]:.0%} confidence)"
+        )
+
+    async def save_chart_ins_glu(self):
+        fig = highchart_figure(self.insulin_chart.options, self.glucose_chart.options)
+        await export_chart(fig, self.export_format.value, "insulin_glucose")
 
     def InsGlu_UI_Setup(self):
         with ui.column().classes("w-full items-center").style("align-items: center;"):
@@ -119,110 +1995,167 @@ class InsulinGlucosePlot:
                 "font-weight: bold; font-size: 25px;"
             )
             ui.separator().style('width: 85%')
-            ui.label(text="Patient Lab Results").style(
-                "font-size: 16px; padding-top: 10px;"
-            )
-            with ui.row():
-                self.i1 = ui.input("Baseline Insulin").style("width: 300px")
-                self.g1 = ui.input("Baseline Glucose").style("width: 300px")
-            with ui.row():
-                self.i2 = ui.input("30 Minute Insulin").style("width: 300px")
-                self.g2 = ui.input("30 Minute Glucose").style("width: 300px")
-            with ui.row():
-                self.i3 = ui.input("60 Minute Insulin").style("width: 300px")
-                self.g3 = ui.input("60 Minute Glucose").style("width: 300px")
-            with ui.row():
-                self.i4 = ui.input("120 Minute Insulin").style("width: 300px")
-                self.g4 = ui.input("120 Minute Glucose").style("width: 300px")
-            with ui.row():
-                ui.button(text="Generate Plot", on_click=self.gather_data_ins_glu).style("width:150px")
-                ui.button(text="Save Figure", on_click=self.save_chart_ins_glu).style("width:150px")
-
-            self.insulin_chart = (
-                ui.highchart(
-                    {
-                        "title": {"text": "Insulin Response"},
-                        "xAxis": {"title": {"text": "Time (min)"}},
-                        "yAxis": {"title": {"text": "Insulin Level (uIU/ml)"}},
-                        "chart": {"type": "line", "borderRadius": "10"},
-                        "series": [
-                            {
-                                "name": "Pattern 1",
-                                "data": [[0, 8], [30, 59], [60, 61], [120, 30]],
-                                "color": "#9FE9EF",
-                            },
-                            {
-                                "name": "Pattern 2",
-                                "data": [[0, 13], [30, 93], [60, 116], [120, 80]],
-                                "color": "#62D1E4",
-                            },
-                            {
-                                "name": "Pattern 3",
-                                "data": [[0, 13], [30, 64], [60, 93], [120, 133]],
-                                "color": "#25B0DA",
-                            },
-                            {
-                                "name": "Pattern 4",
-                                "data": [[0, 56], [30, 147], [60, 165], [120, 185]],
-                                "color": "#1B749D",
-                            },
-                            {
-                                "name": "Pattern 5",
-                                "data": [[0, 5], [30, 15], [60, 16], [120, 15]],
-                                "color": "#104060",
-                            },
-                            {
-                                "name": "Patient",
-                                "data": [[0, 0], [30, 0], [60, 0], [120, 0]],
-                                "lineWidth": 4,
-                                "color": "#061523",
-                            },
-                        ],
-                    }
-                )
-                .classes("w-500 h-300")
-                .style("padding-top: 15px;")
-            )
+            self.mode = ui.toggle({1: "Single Patient", 2: "Batch", 3: "CGM"}, value=1)
 
-            self.glucose_chart = (
-                ui.highchart(
-                    {
-                        "title": {"text": "Glucose Response"},
-                        "xAxis": {"title": {"text": "Time (min)"}},
-                        "yAxis": {"title": {"text": "Glucose Level (mg/dL)"}},
-                        "chart": {"type": "line", "borderRadius": "10"},
-                        "series": [
-                            {
-                                "name": "Normal",
-                                "data": [[0, 80], [30, 130], [60, 120], [120, 100]],
-                                "color": "green",
-                            },
-                            {
-                                "name": "Impaired Glucose Tolerance",
-                                "data": [[0, 95], [30, 180], [60, 170], [120, 140]],
-                                "color": "orange",
-                            },
-                            {
-                                "name": "Diabetes",
-                                "data": [[0, 110], [30, 220], [60, 210], [120, 180]],
-                                "color": "red",
-                            },
-                            {
-                                "name": "Patient",
-                                "data": [[0, 0], [30, 0], [60, 0], [120, 0]],
-                                "lineWidth": 4,
-                                "color": "#061523",
-                                "marker": {
-                                    "symbol": "circle",
-                                    "radius": 6,
+            # Single Patient Container
+            single_container = ui.column().bind_visibility_from(self.mode, "value", value=1)
+            with single_container.classes("w-full items-center").style("align-items: center;"):
+                ui.label(text="Patient Lab Results").style(
+                    "font-size: 16px; padding-top: 10px;"
+                )
+                with ui.row():
+                    self.i1 = ui.input("Baseline Insulin").style("width: 300px")
+                    self.g1 = ui.input("Baseline Glucose").style("width: 300px")
+                with ui.row():
+                    self.i2 = ui.input("30 Minute Insulin").style("width: 300px")
+                    self.g2 = ui.input("30 Minute Glucose").style("width: 300px")
+                with ui.row():
+                    self.i3 = ui.input("60 Minute Insulin").style("width: 300px")
+                    self.g3 = ui.input("60 Minute Glucose").style("width: 300px")
+                with ui.row():
+                    self.i4 = ui.input("120 Minute Insulin").style("width: 300px")
+                    self.g4 = ui.input("120 Minute Glucose").style("width: 300px")
+                with ui.row():
+                    ui.button(text="Generate Plot", on_click=self.gather_data_ins_glu).style("width:150px")
+                    ui.button(text="Save Figure", on_click=self.save_chart_ins_glu).style("width:150px")
+                    self.export_format = ui.select(list(CHART_EXPORT_FORMATS), value="png").style("width: 70px;")
+                self.pattern_lab = ui.label("").style("font-size: 16px;")
+
+                self.insulin_chart = (
+                    ui.highchart(
+                        {
+                            "title": {"text": "Insulin Response"},
+                            "xAxis": {"title": {"text": "Time (min)"}},
+                            "yAxis": {"title": {"text": "Insulin Level (uIU/ml)"}},
+                            "chart": {"type": "line", "borderRadius": "10"},
+                            "series": [
+                                {
+                                    "name": name,
+                                    "data": [list(point) for point in zip(INSULIN_TIMES, levels)],
+                                    "color": color,
                                 }
-                            },
-                        ],
-                    }
+                                for (name, levels), color in zip(INSULIN_PATTERNS.items(), INSULIN_PATTERN_COLORS)
+                            ] + [
+                                {
+                                    "name": "Patient",
+                                    "data": [[0, 0], [30, 0], [60, 0], [120, 0]],
+                                    "lineWidth": 4,
+                                    "color": "#061523",
+                                },
+                            ],
+                        }
+                    )
+                    .classes("w-500 h-300")
+                    .style("padding-top: 15px;")
                 )
-                .classes("w-500 h-300")
-                .style("padding-top: 15px;")
-            )
+
+                self.glucose_chart = (
+                    ui.highchart(
+                        {
+                            "title": {"text": "Glucose Response"},
+                            "xAxis": {"title": {"text": "Time (min)"}},
+                            "yAxis": {"title": {"text": "Glucose Level (mg/dL)"}},
+                            "chart": {"type": "line", "borderRadius": "10"},
+                            "series": [
+                                {
+                                    "name": "Normal",
+                                    "data": [[0, 80], [30, 130], [60, 120], [120, 100]],
+                                    "color": "green",
+                                },
+                                {
+                                    "name": "Impaired Glucose Tolerance",
+                                    "data": [[0, 95], [30, 180], [60, 170], [120, 140]],
+                                    "color": "orange",
+                                },
+                                {
+                                    "name": "Diabetes",
+                                    "data": [[0, 110], [30, 220], [60, 210], [120, 180]],
+                                    "color": "red",
+                                },
+                                {
+                                    "name": "Patient",
+                                    "data": [[0, 0], [30, 0], [60, 0], [120, 0]],
+                                    "lineWidth": 4,
+                                    "color": "#061523",
+                                    "marker": {
+                                        "symbol": "circle",
+                                        "radius": 6,
+                                    }
+                                },
+                            ],
+                        }
+                    )
+                    .classes("w-500 h-300")
+                    .style("padding-top: 15px;")
+                )
+            # Batch Container
+            batch_container = ui.column().bind_visibility_from(self.mode, "value", value=2)
+            with batch_container.classes("w-full items-center").style("align-items: center;"):
+                ui.upload(label="Upload an OGTT panel CSV (patient_id, glucose_0, insulin_0, glucose_30, ...)",
+                          on_upload=self.batch_upload, auto_upload=True).props("accept=.csv").style("width: 60%")
+                with ui.row().classes("items-center"):
+                    self.batch_lab = ui.label("").style("font-size: 16px;")
+                    self.batch_download = ui.button("Download Results", on_click=self.batch_save).style("width:200px")
+                    self.batch_download.set_visibility(False)
+                with ui.row().classes("w-full justify-center"):
+                    self.pattern_counts_chart = ui.highchart({
+                        "title": {"text": "Insulin Patterns"},
+                        "chart": {"type": "column", "borderRadius": "10"},
+                        "xAxis": {"categories": list(INSULIN_PATTERNS)},
+                        "yAxis": {"title": {"text": "Patients"}},
+                        "legend": {"enabled": False},
+                        "series": [{"name": "Patients", "data": [0] * len(INSULIN_PATTERNS)}],
+                    }).style("width: 45%; padding-top: 15px;")
+                    self.homa_chart = ui.highchart({
+                        "title": {"text": "HOMA-IR"},
+                        "chart": {"type": "column", "borderRadius": "10"},
+                        "xAxis": {"categories": OGTT_HOMA_LABELS},
+                        "yAxis": {"title": {"text": "Patients"}},
+                        "legend": {"enabled": False},
+                        "series": [{"name": "Patients", "data": [0] * len(OGTT_HOMA_LABELS)}],
+                    }).style("width: 45%; padding-top: 15px;")
+                self.batch_results = ui.aggrid({"columnDefs": [], "rowData": []}).style("width:80%; min-height: 400px")
+            # CGM Container
+            cgm_container = ui.column().bind_visibility_from(self.mode, "value", value=3)
+            with cgm_container.classes("w-full items-center").style("align-items: center;"):
+                ui.upload(label="Upload a Dexcom Clarity or LibreView CSV export",
+                          on_upload=self.cgm_upload, auto_upload=True).props("accept=.csv").style("width: 60%")
+                self.cgm_lab = ui.label("").style("font-size: 16px;")
+                with ui.row().classes("w-full justify-center items-center"):
+                    self.cgm_metrics_md = ui.markdown("")
+                    self.cgm_range_chart = ui.highchart({
+                        "title": {"text": "Time in Ranges"},
+                        "chart": {"type": "column", "borderRadius": "10"},
+                        "xAxis": {"categories": ["Readings"], "visible": False},
+                        "yAxis": {"title": {"text": "% of Readings"}, "max": 100, "reversedStacks": False},
+                        "plotOptions": {"column": {"stacking": "normal"}},
+                        "series": [{"name": label, "data": [0], "color": color}
+                                   for label, color in zip(CGM_RANGE_LABELS, CGM_RANGE_COLORS)],
+                    }).style("width: 30%; padding-top: 15px;")
+                self.agp_chart = ui.highchart({
+                    "title": {"text": "Ambulatory Glucose Profile"},
+                    "chart": {"borderRadius": "10"},
+                    "xAxis": {"type": "datetime", "labels": {"format": "{value:%H:%M}"}},
+                    "yAxis": {"title": {"text": "Glucose Level (mg/dL)"},
+                              "plotBands": [{"from": 70, "to": 180, "color": "rgba(67, 160, 71, 0.1)"}]},
+                    "tooltip": {"shared": True, "xDateFormat": "%H:%M"},
+                    "series": [
+                        {"name": "5-95%", "type": "arearange", "data": [], "color": "#9FE9EF", "marker": {"enabled": False}},
+                        {"name": "25-75%", "type": "arearange", "data": [], "color": "#25B0DA", "marker": {"enabled": False}},
+                        {"name": "Median", "type": "line", "data": [], "color": "#061523", "lineWidth": 3,
+                         "marker": {"enabled": False}},
+                    ],
+                }).style("width: 80%; padding-top: 15px;")
+                self.cgm_trace_chart = ui.highchart({
+                    "title": {"text": "Glucose Readings"},
+                    "chart": {"type": "line", "borderRadius": "10", "zoomType": "x"},
+                    "xAxis": {"type": "datetime"},
+                    "yAxis": {"title": {"text": "Glucose Level (mg/dL)"},
+                              "plotBands": [{"from": 70, "to": 180, "color": "rgba(67, 160, 71, 0.1)"}]},
+                    "legend": {"enabled": False},
+                    "series": [{"name": "Glucose", "data": [], "color": "#1B749D", "lineWidth": 1,
+                                "marker": {"enabled": False}}],
+                }).style("width: 80%; padding-top: 15px;")
 
             ui.markdown(
                 """
@@ -245,6 +2178,329 @@ class InsulinGlucosePlot:
             )
 
 #%% ========== Wound Tracker Plot ================================================================
+# Plotted wound metrics: (key, trace name, y axis)
+WOUND_METRICS = [
+    ("width", "Wound Width", "y"),
+    ("length", "Wound Length", "y"),
+    ("depth", "Wound Depth", "y"),
+    ("volume", "Wound Volume", "y2"),
+    ("area", "Wound Area", "y3"),
+]
+# Healing analytics: percent area reduction (PAR) at 4 weeks below the threshold flags a wound as not healing,
+# closure is predicted for when the fitted area falls to WOUND_CLOSURE_FRACTION of the first measurement
+WOUND_PAR_DAYS = 28
+WOUND_PAR_THRESHOLD = 40
+WOUND_CLOSURE_FRACTION = 0.01
+WOUND_PREDICTION_MAX_DAYS = 365
+WOUND_TREND_POINTS = 30
+WOUND_PREVIEW_ROWS = 1000
+# Longer series are plotted LTTB downsampled to this many points per trace, with WebGL
+WOUND_MAX_POINTS = 1000
+# A loaded history longer than that is plotted from the store, only its latest measurements go in the textareas
+WOUND_EDIT_ROWS = 30
+WOUND_IMPORT_CHUNK_ROWS = 50000
+# Saved measurements, stored in cm and converted to the selected unit when loaded
+WOUND_DB_FILE = "wound_measurements.db"
+WOUND_UNIT_CM = {"cm": 1.0, "mm": 0.1, "in": 2.54}
+
+
+class WoundStore:
+    """Wound measurements per patient and wound site in an embedded SQLite database
+
+    The table is clustered on its (patient, site, date) primary key, so a site's whole history is one index
+    range scan already in date order. Writes share one connection guarded by a lock, opened on first use. Reads
+    use a connection per thread without the lock, WAL lets them run while an import is writing.
+    """
+    def __init__(self, path=WOUND_DB_FILE):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+        self.readers = threading.local()
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS measurements ("
+                "patient TEXT NOT NULL, site TEXT NOT NULL, date TEXT NOT NULL, "
+                "width REAL NOT NULL, length REAL NOT NULL, depth REAL NOT NULL, "
+                "PRIMARY KEY (patient, site, date)) WITHOUT ROWID"
+            )
+        return self.connection
+
+    def reader(self):
+        """This thread's read-only connection"""
+        connection = getattr(self.readers, "connection", None)
+        if connection is None:
+            with self.lock:
+                self.connect()  # the writer creates the table and switches the file to WAL
+            connection = self.readers.connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA query_only=ON")
+        return connection
+
+    def save(self, patient, site, rows):
+        """Insert (date, width, length, depth) rows in cm in one transaction, replacing measurements on the same date"""
+        with self.lock, self.connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO measurements VALUES (?, ?, ?, ?, ?, ?)",
+                                   [(patient, site, *row) for row in rows])
+
+    def history(self, patient, site, start=None, end=None):
+        """(date, width, length, depth) rows of a wound site, oldest first, optionally only from start to end"""
+        return self.reader().execute(
+            "SELECT date, width, length, depth FROM measurements WHERE patient = ? AND site = ? "
+            "AND date BETWEEN ? AND ? ORDER BY date",
+            (patient, site, start or "", end or "\uffff"),
+        ).fetchall()
+
+    def patients(self):
+        return [row[0] for row in self.reader().execute("SELECT DISTINCT patient FROM measurements")]
+
+    def sites(self, patient):
+        return [row[0] for row in self.reader().execute(
+            "SELECT DISTINCT site FROM measurements WHERE patient = ?", (patient,))]
+
+
+wound_store = WoundStore()
+
+
+def wound_healing(wounds, dates, areas):
+    """Healing metrics of every wound in one pass
+
+    wounds: wound number (0..n-1) of each measurement, dates: datetime64 measurement dates, areas: length x width.
+    Per wound: PAR at 4 weeks (interpolated, NaN until 4 weeks of measurements), the log-linear healing
+    regression log(area) = intercept + slope * day (zero areas left out) and the predicted closure day.
+    """
+    order = np.lexsort((dates, wounds))
+    wounds, dates, areas = wounds[order], dates[order], areas[order].astype(np.float64)
+    counts = np.bincount(wounds)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    first_dates = dates[starts].astype("datetime64[D]")
+    days = (dates - dates[starts][wounds]) / np.timedelta64(1, "D")
+    baseline = areas[starts]
+    last = areas[ends - 1]
+
+    # Area at 4 weeks from the measurements either side of it
+    index = np.arange(len(areas))
+    before = np.maximum.reduceat(np.where(days <= WOUND_PAR_DAYS, index, -1), starts)
+    after = np.minimum.reduceat(np.where(days >= WOUND_PAR_DAYS, index, len(areas)), starts)
+    reached = after < ends
+    after = np.where(reached, after, before)
+    span = days[after] - days[before]
+    weight = np.divide(WOUND_PAR_DAYS - days[before], span, out=np.zeros_like(span), where=span > 0)
+    area_4wk = areas[before] + weight * (areas[after] - areas[before])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        par = np.where(reached & (baseline > 0), (baseline - area_4wk) / baseline * 100, np.nan)
+
+        # Least squares per wound from bincount sums
+        positive = areas > 0
+        log_areas = np.log(np.where(positive, areas, 1))
+        n = np.bincount(wounds, weights=positive, minlength=len(counts))
+        st = np.bincount(wounds, weights=days * positive, minlength=len(counts))
+        sy = np.bincount(wounds, weights=log_areas * positive, minlength=len(counts))
+        stt = np.bincount(wounds, weights=days ** 2 * positive, minlength=len(counts))
+        sty = np.bincount(wounds, weights=days * log_areas * positive, minlength=len(counts))
+        denominator = n * stt - st ** 2
+        fitted = (n >= 2) & (denominator > 0)
+        slope = np.where(fitted, (n * sty - st * sy) / denominator, np.nan)
+        intercept = np.where(fitted, (sy - slope * st) / n, np.nan)
+        closure_day = np.where(slope < 0, (np.log(baseline * WOUND_CLOSURE_FRACTION) - intercept) / slope, np.nan)
+
+    closure_day = np.where(closure_day <= WOUND_PREDICTION_MAX_DAYS, closure_day, np.nan)
+    status = np.select(
+        [last == 0, ~fitted, (par < WOUND_PAR_THRESHOLD) | (slope >= 0)],
+        ["Closed", "Insufficient data", "Not healing"],
+        "Healing",
+    )
+    return pd.DataFrame({
+        "measurements": counts,
+        "first_date": first_dates,
+        "last_date": dates[ends - 1].astype("datetime64[D]"),
+        "first_area": baseline.round(2),
+        "last_area": last.round(2),
+        "par_4wk": par.round(1),
+        "weekly_reduction": ((1 - np.exp(slope * 7)) * 100).round(1),
+        "intercept": intercept,
+        "slope": slope,
+        "predicted_closure": first_dates + np.round(np.nan_to_num(closure_day)).astype("timedelta64[D]"),
+        "closure_day": closure_day,
+        "status": status,
+    })
+
+
+def process_wound_cohort(source):
+    """Score every open wound in a clinic measurement CSV (patient_id, optional wound_id, date, length, width)
+
+    Returns the open wounds, not healing first, and the number of closed wounds.
+    """
+    df = pd.read_csv(source, dtype={"patient_id": str, "wound_id": str})
+    df.columns = [str(column).strip().lower() for column in df.columns]
+    missing = [column for column in ("patient_id", "date", "length", "width") if column not in df.columns]
+    if missing:
+        raise ValueError(f"The CSV is missing the {', '.join(missing)} column(s).")
+    if "wound_id" not in df.columns:
+        df["wound_id"] = ""
+    df["wound_id"] = df["wound_id"].fillna("")
+    dates = pd.to_datetime(df["date"], errors="coerce")
+    areas = pd.to_numeric(df["length"], errors="coerce") * pd.to_numeric(df["width"], errors="coerce")
+    valid = (dates.notna() & areas.notna()).to_numpy()
+    if not valid.any():
+        raise ValueError("The CSV has no measurements with a date, length and width.")
+
+    df = df[valid]
+    wounds, keys = pd.MultiIndex.from_frame(df[["patient_id", "wound_id"]]).factorize()
+    results = wound_healing(wounds, dates[valid].to_numpy("datetime64[s]"), areas[valid].to_numpy())
+    results.insert(0, "patient_id", keys.get_level_values(0))
+    results.insert(1, "wound_id", keys.get_level_values(1))
+    results["predicted_closure"] = results["predicted_closure"].where(results["closure_day"].notna())
+    closed = results["status"] == "Closed"
+    results = results[~closed].drop(columns=["intercept", "slope", "closure_day"])
+    order = results["status"].map({"Not healing": 0, "Insufficient data": 1, "Healing": 2})
+    results = results.assign(order=order).sort_values(["order", "par_4wk"], kind="stable").drop(columns="order")
+    return results.reset_index(drop=True), int(closed.sum())
+
+
+def lttb(x, y, points):
+    """Indices of the Largest-Triangle-Three-Buckets downsample of (x, y) to points points
+
+    Keeps the first and last point and from each bucket in between the point forming the largest triangle with
+    the point kept before it and the mean of the next bucket, so peaks and the shape of the line survive.
+    """
+    n = len(x)
+    if n <= points or points < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    # Means of every bucket from prefix sums, the last point stands in for the bucket after the last one
+    sum_x = np.concatenate([[0], np.cumsum(x)])
+    sum_y = np.concatenate([[0], np.cumsum(y)])
+    sizes = edges[1:] - edges[:-1]
+    mean_x = np.append((sum_x[edges[1:]] - sum_x[edges[:-1]]) / sizes, x[-1])
+    mean_y = np.append((sum_y[edges[1:]] - sum_y[edges[:-1]]) / sizes, y[-1])
+
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        area = np.abs((x[a] - mean_x[i + 1]) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (mean_y[i + 1] - y[a]))
+        a = start + np.argmax(area)
+        selected[i + 1] = a
+    return selected
+
+
+def import_wound_history(source, patient, site=None, scale=1.0, chunksize=WOUND_IMPORT_CHUNK_ROWS):
+    """Stream a wound history CSV (date, width, length, depth, optional site) into the wound store
+
+    Each chunk is parsed into typed arrays and written in one transaction per site. Sizes are multiplied by scale
+    (to cm), rows without a site use the given one. Returns the number of imported measurements per site.
+    """
+    counts = {}
+    for chunk in pd.read_csv(source, chunksize=chunksize, dtype=str):
+        chunk.columns = [str(column).strip().lower() for column in chunk.columns]
+        missing = [column for column in ("date", "width", "length", "depth") if column not in chunk.columns]
+        if missing:
+            raise ValueError(f"The CSV is missing the {', '.join(missing)} column(s).")
+        dates = pd.to_datetime(chunk["date"], errors="coerce")
+        sizes = chunk[["width", "length", "depth"]].apply(pd.to_numeric, errors="coerce").to_numpy(np.float64) * scale
+        sites = chunk["site"].fillna("").str.strip() if "site" in chunk.columns else pd.Series("", index=chunk.index)
+        sites = sites.mask(sites == "", site or "").to_numpy(dtype=object)
+        valid = dates.notna().to_numpy() & ~np.isnan(sizes).any(axis=1)
+        if (valid & (sites == "")).any():
+            raise ValueError("Select a wound site or add a site column.")
+        dates = dates.dt.strftime("%Y-%m-%d").to_numpy(dtype=object)
+        for name in pd.unique(sites[valid]):
+            rows = valid & (sites == name)
+            wound_store.save(patient, name, zip(dates[rows], *sizes[rows].T.tolist()))
+            counts[name] = counts.get(name, 0) + int(rows.sum())
+    return counts
+
+
+class WoundSeries:
+    """The wound plot data as typed arrays, with one trace per metric
+
+    Up to WOUND_MAX_POINTS measurements the traces show every point and new measurements are appended to them.
+    Longer series are shown LTTB downsampled to that budget per trace with WebGL, and refresh(window)
+    re-samples the full resolution data inside a zoomed window.
+    """
+    def __init__(self):
+        self.dates = np.array([], dtype=object)
+        self.times = np.array([], dtype=np.float64)
+        self.values = {key: np.array([], dtype=np.float64) for key, _, _ in WOUND_METRICS}
+        self.traces = [
+            {"type": "scatter", "mode": "lines+markers", "name": name, "yaxis": axis, "x": [], "y": []}
+            for _, name, axis in WOUND_METRICS
+        ]
+        self.dated = False
+
+    @property
+    def downsampled(self):
+        return len(self.dates) > WOUND_MAX_POINTS
+
+    def update(self, dates, width, length, depth):
+        """Bring the series up to the given measurements
+
+        Returns the added points as (dates, values per metric) when the measurements only extend a series that
+        is shown in full, or None when the traces were rebuilt.
+        """
+        # Lines past the shortest textarea are ignored, derived metrics need equal lengths
+        n = min(len(dates), len(width), len(length), len(depth))
+        dates = np.array(dates[:n], dtype=object)
+        values = self.metrics(width[:n], length[:n], depth[:n])
+
+        old = len(self.dates)
+        extends = n >= old and np.array_equal(dates[:old], self.dates) and \
+            all(np.array_equal(values[key][:old], self.values[key]) for key in self.values)
+        self.dates, self.values = dates, values
+        # Numeric x for downsampling and zoom windows: seconds when every date parses, otherwise line numbers
+        times = pd.to_datetime(pd.Series(dates, dtype=object).str.strip(), errors="coerce")
+        self.dated = bool(times.notna().all())
+        self.times = times.to_numpy("datetime64[s]").astype(np.int64).astype(np.float64) if self.dated else \
+            np.arange(n, dtype=np.float64)
+
+        if extends and not self.downsampled:
+            added = (dates[old:].tolist(), {key: v[old:].tolist() for key, v in values.items()})
+            for trace, (key, _, _) in zip(self.traces, WOUND_METRICS):
+                trace["x"].extend(added[0])
+                trace["y"].extend(added[1][key])
+            return added
+        self.refresh()
+        return None
+
+    @staticmethod
+    def metrics(width, length, depth):
+        return {"width": width, "length": length, "depth": depth, "volume": width * length * depth,
+                "area": width * length}
+
+    def refresh(self, window=None):
+        """Show every point, or the downsampled points inside window (x axis range) of a long series
+
+        Returns the new trace data for Plotly.restyle.
+        """
+        index = np.arange(len(self.dates))
+        if window is not None:
+            start, end = (pd.Timestamp(value).timestamp() if self.dated else float(value) for value in window)
+            index = index[(self.times >= start) & (self.times <= end)]
+        return self.show(self.dates[index], self.times[index], {key: v[index] for key, v in self.values.items()})
+
+    def show(self, dates, times, values):
+        """Set the traces to the given points, downsampled, and return the trace data for Plotly.restyle"""
+        data = {"x": [], "y": []}
+        for trace, (key, _, _) in zip(self.traces, WOUND_METRICS):
+            shown = lttb(times, values[key], WOUND_MAX_POINTS)
+            trace["type"] = "scattergl" if self.downsampled else "scatter"
+            trace["mode"] = "lines" if self.downsampled else "lines+markers"
+            trace["x"] = dates[shown].tolist()
+            trace["y"] = values[key][shown].tolist()
+            data["x"].append(trace["x"])
+            data["y"].append(trace["y"])
+        return data
+
+    def clear(self):
+        self.update([], np.array([]), np.array([]), np.array([]))
+
+
 class WoundTracker:
     def __init__(self):
         self.dates = None
@@ -252,14 +2508,74 @@ class WoundTracker:
         self.w_length = None
         self.w_depth = None
         self.unit_select = None
+        self.patient = None
+        self.site = None
         self.plot = None
+        self.series = WoundSeries()
+        # (patient, site, dates, sizes in cm) of the saved measurements plotted before the ones in the textareas
+        self.history = None
+        self.zoom_window = None
+        # The healing overlay the browser shows, so a click only sends the parts of it that changed
+        self.shown_overlay = {}
         self.fig = None
+        self.unit = None
+        self.export_format = None
+        self.mode = None
+        self.cohort_lab = None
+        self.cohort_download = None
+        self.cohort_results = None
+        self.cohort_csv = None
 
     def generate_plot(self):
         if self.dates is None or self.w_width is None or self.w_length is None or self.w_depth is None:
             print("UI components are not initialized. Please call woundtracker_UI_Setup first.")
             return
 
+        try:
+            sp_dates, sp_width, sp_length, sp_depth = self.read_measurements()
+        except ValueError:
+            ui.notify("Please enter valid numeric values.", position="center", type="negative")
+            return
+        if self.history is not None:
+            # The textareas hold the latest measurements of a long saved history
+            _, _, head_dates, head_sizes = self.history
+            head_sizes = head_sizes / WOUND_UNIT_CM[self.unit_select.value]
+            sp_dates = head_dates.tolist() + sp_dates
+            sp_width, sp_length, sp_depth = (np.concatenate([head_sizes[:, i], values])
+                                             for i, values in enumerate((sp_width, sp_length, sp_depth)))
+
+        # Only new measurements are sent to the browser, a full redraw is only needed when earlier ones were edited
+        added = self.series.update(sp_dates, sp_width, sp_length, sp_depth)
+        layout = {}
+        if self.unit_select.value != self.unit:
+            self.unit = self.unit_select.value
+            layout = {"yaxis.title.text": "Size ({})".format(self.unit),
+                      "yaxis2.title.text": "Volume ({})^2".format(self.unit),
+                      "yaxis3.title.text": "Area ({})^2".format(self.unit)}
+            for key, text in layout.items():
+                self.fig["layout"][key.split(".")[0]]["title"]["text"] = text
+        if added is None or added[0]:
+            layout.update(self.healing_overlay())
+
+        if added is None:
+            self.plot.update()
+            self.shown_overlay = self.overlay()
+        elif added[0]:
+            new_points = {"x": [added[0]] * len(WOUND_METRICS), "y": [added[1][key] for key, _, _ in WOUND_METRICS]}
+            script = f"Plotly.extendTraces('c{self.plot.id}', {json.dumps(new_points)}, {list(range(len(WOUND_METRICS)))});"
+            overlay = self.overlay()
+            changed = {key for key, value in overlay.items() if self.shown_overlay.get(key) != value}
+            self.shown_overlay = overlay
+            trend = {"x": [overlay["trend"][0]], "y": [overlay["trend"][1]]} if "trend" in changed else {}
+            layout = {key: value for key, value in layout.items() if key not in overlay or key in changed}
+            if trend or layout:
+                script += f"Plotly.update('c{self.plot.id}', {json.dumps(trend)}, {json.dumps(layout)}, [{len(WOUND_METRICS)}])"
+            self.plot.client.run_javascript(script)
+        elif layout:
+            self.plot.client.run_javascript(f"Plotly.relayout('c{self.plot.id}', {json.dumps(layout)})")
+
+    def read_measurements(self):
+        """Dates and width, length and depth values from the textareas, one measurement per line"""
         # Split data
         sp_dates = self.dates.value.split("\n")
         sp_width = self.w_width.value.split("\n")
@@ -267,57 +2583,183 @@ class WoundTracker:
         sp_depth = self.w_depth.value.split("\n")
 
         # Validate and convert to float
+        sp_width = np.array(sp_width, dtype=np.float64)
+        sp_length = np.array(sp_length, dtype=np.float64)
+        sp_depth = np.array(sp_depth, dtype=np.float64)
+        return sp_dates, sp_width, sp_length, sp_depth
+
+    async def show_patients(self):
+        self.patient.set_autocomplete(await run.io_bound(wound_store.patients))
+
+    async def show_sites(self):
+        """Offer the saved wound sites of the entered patient"""
+        patient = (self.patient.value or "").strip()
+        sites = await run.io_bound(wound_store.sites, patient)
+        if patient != (self.patient.value or "").strip():
+            return  # a later keystroke has its own lookup
+        if self.site.value and self.site.value not in sites:
+            sites.append(self.site.value)
+        self.site.set_options(sites, value=self.site.value)
+
+    async def load_history(self):
+        patient, site = (self.patient.value or "").strip(), self.site.value
+        if not patient or not site:
+            ui.notify("Enter the patient and wound site.", position="center", type="negative")
+            return
+        rows = await run.io_bound(wound_store.history, patient, site)
+        if not rows:
+            ui.notify(f"No saved measurements for {patient}, {site}.", position="center", type="negative")
+            return
+
+        # A long history is kept as arrays for the plot, only its latest measurements are put in the textareas
+        head = len(rows) - WOUND_EDIT_ROWS if len(rows) > WOUND_MAX_POINTS else 0
+        self.history = None
+        if head:
+            self.history = (patient, site, np.array([row[0] for row in rows[:head]], dtype=object),
+                            np.array([row[1:] for row in rows[:head]], dtype=np.float64))
+        scale = WOUND_UNIT_CM[self.unit_select.value]
+        dates, widths, lengths, depths = zip(*rows[head:])
+        self.dates.set_value("\n".join(dates))
+        for box, values in ((self.w_width, widths), (self.w_length, lengths), (self.w_depth, depths)):
+            box.set_value("\n".join(f"{value / scale:g}" for value in values))
+        self.generate_plot()
+        if head:
+            ui.notify(f"Loaded {len(rows)} measurements, the latest {len(rows) - head} are shown for editing.",
+                      position="center", type="info")
+
+    async def save_measurements(self):
+        patient, site = (self.patient.value or "").strip(), self.site.value
+        if not patient or not site:
+            ui.notify("Enter the patient and wound site.", position="center", type="negative")
+            return
         try:
-            sp_width = [float(x) for x in sp_width]
-            sp_length = [float(x) for x in sp_length]
-            sp_depth = [float(x) for x in sp_depth]
+            sp_dates, sp_width, sp_length, sp_depth = self.read_measurements()
         except ValueError:
-            print("Please enter valid numeric values.")
+            ui.notify("Please enter valid numeric values.", position="center", type="negative")
+            return
+        dates = pd.to_datetime(pd.Series(sp_dates, dtype=object).str.strip(), errors="coerce")
+        if dates.isna().any():
+            ui.notify("Enter dates as MM/DD/YYYY or YYYY-MM-DD to save.", position="center", type="negative")
             return
 
-        sp_vol = [
-            width * length * depth
-            for width, length, depth in zip(sp_width, sp_length, sp_depth)
-        ]
+        # Measurements already saved for a date are overwritten, so saving the loaded history again is harmless
+        scale = WOUND_UNIT_CM[self.unit_select.value]
+        rows = [(date, width * scale, length * scale, depth * scale)
+                for date, width, length, depth in zip(dates.dt.strftime("%Y-%m-%d"), sp_width, sp_length, sp_depth)]
+        await run.io_bound(wound_store.save, patient, site, rows)
+        await self.show_patients()
+        await self.show_sites()
+        ui.notify(f"Saved {len(rows)} measurements for {patient}, {site}.", position="center", type="positive")
 
-        # Plot using Plotly
-        self.fig.add_trace(
-            go.Scatter(
-                x=sp_dates, y=sp_width, mode="lines+markers", name="Wound Width", yaxis="y1"
-            )
-        )
-        self.fig.add_trace(
-            go.Scatter(
-                x=sp_dates,
-                y=sp_length,
-                mode="lines+markers",
-                name="Wound Length",
-                yaxis="y1",
-            )
-        )
-        self.fig.add_trace(
-            go.Scatter(
-                x=sp_dates, y=sp_depth, mode="lines+markers", name="Wound Depth", yaxis="y1"
-            )
-        )
-        self.fig.add_trace(
-            go.Scatter(
-                x=sp_dates, y=sp_vol, mode="lines+markers", name="Wound Volume", yaxis="y2"
-            )
-        )
-        self.fig.update_layout(
-            legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01),
-            xaxis=dict(title="Date"),
-            yaxis=dict(title="Size ({})".format(self.unit_select.value)),
-            yaxis2=dict(
-                title="Volume ({})^2".format(self.unit_select.value),
-                overlaying="y",
-                side="right",
-                tickmode="sync",
-                autoshift=True,
-            ),
+    async def zoom_plot(self, e):
+        """Re-sample a downsampled plot at full resolution for the zoomed window, or the overview on reset
+
+        The window of a loaded history is read from the wound store, with the measurements in the textareas.
+        """
+        args = e.args or {}
+        if not self.series.downsampled:
+            return
+        if "xaxis.range[0]" in args:
+            window = (args["xaxis.range[0]"], args["xaxis.range[1]"])
+        elif "xaxis.range" in args:
+            window = tuple(args["xaxis.range"])
+        elif args.get("xaxis.autorange"):
+            window = None
+        else:
+            return
+        self.zoom_window = window
+        if window is None or self.history is None or not self.series.dated:
+            data = self.series.refresh(window)
+        else:
+            patient, site, head_dates, _ = self.history
+            start, end = (pd.Timestamp(value) for value in window)
+            rows = await run.io_bound(wound_store.history, patient, site, start.strftime("%Y-%m-%d"),
+                                      min(end.strftime("%Y-%m-%d"), head_dates[-1]))
+            if window != self.zoom_window:
+                return  # a later zoom has its own query
+            head = len(head_dates)
+            stored = np.array([row[1:] for row in rows], dtype=np.float64).reshape(-1, 3) / \
+                WOUND_UNIT_CM[self.unit_select.value]
+            width, length, depth = np.concatenate(
+                [stored, np.column_stack([self.series.values[key][head:] for key in ("width", "length", "depth")])]).T
+            dates = np.concatenate([np.array([row[0] for row in rows], dtype=object), self.series.dates[head:]])
+            times = np.concatenate([pd.to_datetime([row[0] for row in rows]).to_numpy("datetime64[s]")
+                                    .astype(np.int64).astype(np.float64), self.series.times[head:]])
+            inside = (times >= start.timestamp()) & (times <= end.timestamp())
+            values = WoundSeries.metrics(width, length, depth)
+            data = self.series.show(dates[inside], times[inside], {key: v[inside] for key, v in values.items()})
+        self.plot.client.run_javascript(
+            f"Plotly.restyle('c{self.plot.id}', {json.dumps(data)}, {list(range(len(WOUND_METRICS)))})"
         )
-        ui.update(self.plot)
+
+    async def history_upload(self, e):
+        patient = (self.patient.value or "").strip()
+        if not patient:
+            ui.notify("Enter the patient before importing.", position="center", type="negative")
+            return
+        try:
+            counts = await run.io_bound(import_wound_history, e.content, patient, self.site.value,
+                                        WOUND_UNIT_CM[self.unit_select.value])
+        except (ValueError, pd.errors.ParserError) as error:
+            ui.notify(f"Could not import {e.name}: {error}", position="center", type="negative")
+            return
+        if not counts:
+            ui.notify(f"{e.name} has no measurements with a date, width, length and depth.", position="center",
+                      type="negative")
+            return
+
+        await self.show_patients()
+        site = self.site.value if self.site.value in counts else next(iter(counts))
+        sites = await run.io_bound(wound_store.sites, patient)
+        self.site.set_options(sorted(set(sites) | set(counts)), value=site)
+        imported = ", ".join(f"{name}: {count}" for name, count in counts.items())
+        ui.notify(f"Imported {sum(counts.values())} measurements ({imported}).", position="center", type="positive")
+        await self.load_history()
+
+    def overlay(self):
+        """The healing overlay in the figure: trend trace points, annotations and shapes"""
+        trend = self.fig["data"][len(WOUND_METRICS)]
+        return {"trend": (trend["x"], trend["y"]), "annotations": self.fig["layout"].get("annotations", []),
+                "shapes": self.fig["layout"].get("shapes", [])}
+
+    def healing_overlay(self):
+        """Fit the healing trend of the entered measurements into the figure, returns the layout changes
+
+        Sets the area trend trace and returns the summary annotation and 4 week marker.
+        """
+        trend = self.fig["data"][len(WOUND_METRICS)]
+        trend["x"], trend["y"] = [], []
+        layout = {"annotations": [], "shapes": []}
+        if len(self.series.dates) >= 2 and self.series.dated:
+            healing = wound_healing(np.zeros(len(self.series.dates), dtype=np.int64),
+                                    self.series.times.astype(np.int64).astype("datetime64[s]"),
+                                    self.series.values["area"]).iloc[0]
+            first_date = np.datetime64(healing["first_date"], "D")
+            if healing["status"] != "Insufficient data":
+                last_day = (np.datetime64(healing["last_date"], "D") - first_date).astype(np.int64)
+                end = healing["closure_day"] if np.isfinite(healing["closure_day"]) else last_day
+                days = np.linspace(0, max(end, last_day), WOUND_TREND_POINTS)
+                trend["x"] = np.datetime_as_string(first_date + np.round(days).astype("timedelta64[D]")).tolist()
+                trend["y"] = np.exp(healing["intercept"] + healing["slope"] * days).round(2).tolist()
+
+            par = "after 4 weeks" if np.isnan(healing["par_4wk"]) else f"{healing['par_4wk']:.0f}%"
+            closure = str(np.datetime64(healing["predicted_closure"], "D")) if np.isfinite(healing["closure_day"]) \
+                else "not within a year"
+            rate = "" if np.isnan(healing["weekly_reduction"]) else f"{healing['weekly_reduction']:.1f}% per week"
+            four_weeks = str(first_date + np.timedelta64(WOUND_PAR_DAYS, "D"))
+            layout["annotations"] = [{
+                "text": f"<b>{healing['status']}</b><br>4 week area reduction: {par}<br>"
+                        f"Healing rate: {rate}<br>Predicted closure: {closure}",
+                "xref": "paper", "yref": "paper", "x": 0.99, "y": 0.99, "xanchor": "right", "yanchor": "top",
+                "align": "left", "showarrow": False, "bgcolor": "rgba(255, 255, 255, 0.8)",
+                "font": {"color": "red" if healing["status"] == "Not healing" else "black"},
+            }]
+            layout["shapes"] = [{
+                "type": "line", "xref": "x", "yref": "paper", "x0": four_weeks, "x1": four_weeks, "y0": 0, "y1": 1,
+                "line": {"dash": "dot", "color": "gray"},
+            }]
+        self.fig["layout"].update(layout)
+        return layout
 
     def reset_plot(self):
         if self.dates is None or self.w_width is None or self.w_length is None or self.w_depth is None:
@@ -328,8 +2770,40 @@ class WoundTracker:
         self.w_width.set_value("")
         self.w_length.set_value("")
         self.w_depth.set_value("")
-        self.fig.data = []
-        ui.update(self.plot)
+        self.history = None
+        self.series.clear()
+        self.healing_overlay()
+        self.plot.update()
+        self.shown_overlay = self.overlay()
+
+    async def cohort_upload(self, e):
+        try:
+            results, closed = await run.io_bound(process_wound_cohort, e.content)
+        except (ValueError, pd.errors.ParserError) as error:
+            ui.notify(f"Could not process {e.name}: {error}", position="center", type="negative")
+            return
+        for column in ("first_date", "last_date", "predicted_closure"):
+            results[column] = results[column].dt.strftime("%Y-%m-%d")
+        self.cohort_csv = results.to_csv(index=False).encode()
+
+        not_healing = int((results["status"] == "Not healing").sum())
+        shown = f", first {WOUND_PREVIEW_ROWS} shown" if len(results) > WOUND_PREVIEW_ROWS else ""
+        self.cohort_lab.set_text(f"{e.name}: {len(results)} open wounds ({not_healing} not healing), "
+                                 f"{closed} closed{shown}")
+        self.cohort_download.set_visibility(True)
+        preview = results.head(WOUND_PREVIEW_ROWS)
+        self.cohort_results.options["columnDefs"] = [{"headerName": column, "field": column} for column in preview.columns]
+        self.cohort_results.options["rowData"] = json.loads(preview.to_json(orient="records"))
+        self.cohort_results.update()
+
+    def cohort_save(self):
+        if self.cohort_csv is not None:
+            ui.download(self.cohort_csv, filename="wound_healing.csv", media_type="text/csv")
+
+    async def save_plot(self):
+        # skip_invalid: older plotly.py releases reject layout options (tickmode "sync") the browser's plotly.js supports
+        fig = go.Figure(self.fig, skip_invalid=True)
+        await export_chart(fig, self.export_format.value, "wound_dimensions")
 
     def woundtracker_UI_Setup(self):
         with ui.column().classes("w-full items-center").style("align-items: center;"):
@@ -337,37 +2811,508 @@ class WoundTracker:
                 "font-weight: bold; font-size: 25px;"
             )
             ui.separator().style('width: 85%')
-            with ui.row():
-                self.dates = ui.textarea("Measurement Dates").style("width: 300px")
-                self.w_width = ui.textarea("Wound Width").style("width: 300px")
-            with ui.row():
-                self.w_length = ui.textarea("Wound Length").style("width: 300px")
-                self.w_depth = ui.textarea("Wound Depth").style("width: 300px")
-            with ui.row():
-                self.unit_select = ui.select(["cm", "mm", "in"], value="cm").style("width: 50px;")
-                ui.button(text="Generate Plot", on_click=self.generate_plot).style(
-                    "margin-top: 20px; width:150px"
-                )
-                ui.button(text="Reset Plot", on_click=self.reset_plot).style(
-                    "margin-top: 20px; width:150px"
-                )
-            with ui.row().style("padding: 10px"):
-                self.fig = go.Figure()
-                self.fig.update_layout(
-                    title=" Wound Dimensions",
-                    margin=dict(l=0, r=0, t=30, b=0),
-                )
+            self.mode = ui.toggle({1: "Patient", 2: "Clinic"}, value=1)
+
+            # Patient Container
+            patient_container = ui.column().bind_visibility_from(self.mode, "value", value=1)
+            with patient_container.classes("w-full items-center").style("align-items: center;"):
+                with ui.row().classes("items-center"):
+                    self.patient = ui.input("Patient", on_change=self.show_sites).style("width: 200px")
+                    ui.timer(0, self.show_patients, once=True)  # saved patients are read off the event loop
+                    self.site = ui.select([], label="Wound Site", with_input=True,
+                                          new_value_mode="add-unique").style("width: 200px")
+                    ui.button(text="Load History", on_click=self.load_history).style("width:150px")
+                    ui.button(text="Save Measurements", on_click=self.save_measurements).style("width:200px")
+                ui.upload(label="Import a history CSV (date, width, length, depth, optional site) in the selected unit",
+                          on_upload=self.history_upload, auto_upload=True).props("accept=.csv").style("width: 60%")
+                with ui.row():
+                    self.dates = ui.textarea("Measurement Dates").style("width: 300px")
+                    self.w_width = ui.textarea("Wound Width").style("width: 300px")
+                with ui.row():
+                    self.w_length = ui.textarea("Wound Length").style("width: 300px")
+                    self.w_depth = ui.textarea("Wound Depth").style("width: 300px")
+                with ui.row():
+                    self.unit_select = ui.select(["cm", "mm", "in"], value="cm").style("width: 50px;")
+                    ui.button(text="Generate Plot", on_click=self.generate_plot).style(
+                        "margin-top: 20px; width:150px"
+                    )
+                    ui.button(text="Reset Plot", on_click=self.reset_plot).style(
+                        "margin-top: 20px; width:150px"
+                    )
+                    ui.button(text="Save Figure", on_click=self.save_plot).style(
+                        "margin-top: 20px; width:150px"
+                    )
+                    self.export_format = ui.select(list(CHART_EXPORT_FORMATS), value="png").style("width: 70px;")
+                with ui.row().style("padding: 10px"):
+                    self.unit = self.unit_select.value
+                    self.fig = {
+                        "data": self.series.traces + [
+                            {"type": "scatter", "mode": "lines", "name": "Area Trend", "yaxis": "y3", "x": [], "y": [],
+                             "line": {"dash": "dash"}},
+                        ],
+                        "layout": {
+                            "title": {"text": " Wound Dimensions"},
+                            "margin": {"l": 0, "r": 0, "t": 30, "b": 0},
+                            "legend": {"yanchor": "top", "y": 0.99, "xanchor": "left", "x": 0.01},
+                            "xaxis": {"title": {"text": "Date"}},
+                            "yaxis": {"title": {"text": "Size ({})".format(self.unit)}},
+                            "yaxis2": {
+                                "title": {"text": "Volume ({})^2".format(self.unit)},
+                                "overlaying": "y",
+                                "side": "right",
+                                "tickmode": "sync",
+                                "autoshift": True,
+                            },
+                            "yaxis3": {
+                                "title": {"text": "Area ({})^2".format(self.unit)},
+                                "overlaying": "y",
+                                "side": "right",
+                                "anchor": "free",
+                                "autoshift": True,
+                                "showgrid": False,
+                            },
+                        },
+                    }
 
-                self.plot = ui.plotly(self.fig).classes("w-full h-82")
+                    self.plot = ui.plotly(self.fig).classes("w-full h-82")
+                    self.plot.on("plotly_relayout", self.zoom_plot)
+            # Clinic Container
+            cohort_container = ui.column().bind_visibility_from(self.mode, "value", value=2)
+            with cohort_container.classes("w-full items-center").style("align-items: center;"):
+                ui.upload(label="Upload clinic wound measurements (patient_id, wound_id, date, length, width)",
+                          on_upload=self.cohort_upload, auto_upload=True).props("accept=.csv").style("width: 60%")
+                with ui.row().classes("items-center"):
+                    self.cohort_lab = ui.label("").style("font-size: 16px;")
+                    self.cohort_download = ui.button("Download Results", on_click=self.cohort_save).style("width:200px")
+                    self.cohort_download.set_visibility(False)
+                self.cohort_results = ui.aggrid({"columnDefs": [], "rowData": []}).style("width:80%; min-height: 400px")
 
 
 #%% ========== Cost Extimator ====================================================================
+# Fee schedule: CPT, Description and RVU columns followed by one price column per payer (and contract year).
+# The CSV is compiled into a directory of .npy columns that is memory mapped, and rebuilt when the CSV changes.
+# Every build is a new version directory in FEE_STORE_DIR, the CURRENT file names the one in use.
+FEE_SCHEDULE_FILE = "fee_schedule.csv"
+FEE_STORE_DIR = "fee_schedule_store"
+FEE_STORE_POINTER = "CURRENT"
+# Builds that never finished are removed after this many seconds
+FEE_STORE_ABANDONED_SECONDS = 60 * 60
+FEE_RVU_COLUMN = "Total RVU"
+# Multiple procedure payment reduction: the highest RVU line is paid at the first ladder step, the next at the
+# second and so on (the last step repeats). Per payer ladders, exempt codes and modifiers come from the rules file,
+# MPPR_DEFAULT_RULES apply to payers it does not list and when it is missing.
+PAYMENT_REDUCTIONS_FILE = "payment_reductions.json"
+MPPR_DEFAULT_RULES = {"ladder": [1.0, 0.5], "exempt_codes": [], "exempt_modifiers": []}
+# CPT/HCPCS modifiers are two letters or digits (25, 59, LT, RT), any other token after a code makes the line invalid
+CPT_MODIFIER_PATTERN = re.compile(r"[0-9A-Z]{2}")
+# Batch estimates (POST /api/cost/estimate): insurance fields of an encounter, as in the estimator form with
+# coinsurance as its Co-Insurance % (the insurance share), and results are streamed this many rows at a time
+COST_BATCH_FIELDS = ["deductible", "met_deductible", "out_of_pocket", "met_out_of_pocket", "coinsurance"]
+COST_BATCH_CHUNK_ROWS = 10_000
+# Payer columns whose name contains this (any case, e.g. "Office Self Pay" or "Self Pay 2025") are billed to the
+# patient in full, without the deductible and coinsurance split
+SELF_PAY_PAYER = "self pay"
+
+
+def fee_source_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def is_self_pay(payer):
+    return SELF_PAY_PAYER in str(payer).lower()
+
+
+class FeeSchedule:
+    """Fee schedule in a columnar store of memory mapped .npy files, shared read-only by every session
+
+    CPT codes are kept sorted so a lookup is a binary search, descriptions are one UTF-8 blob with offsets and
+    each payer's prices are their own file, only read from disk once that payer is queried. Mapped pages come from
+    the OS page cache, so processes opening the same store share them. Every file is mapped when the version is
+    opened, so an instance keeps working after a rebuild deletes its version directory.
+    """
+    def __init__(self, path):
+        """Map the version directory at path"""
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.payers = self.meta["payers"]
+        self.payer_index = {payer: i for i, payer in enumerate(self.payers)}
+        self.codes = np.asarray(np.load(os.path.join(path, "cpt.npy"), mmap_mode="r"))
+        self.rvus = np.asarray(np.load(os.path.join(path, "rvu.npy"), mmap_mode="r"))
+        self.description_offsets = np.asarray(np.load(os.path.join(path, "description_offsets.npy"), mmap_mode="r"))
+        self.descriptions = np.asarray(np.load(os.path.join(path, "descriptions.npy"), mmap_mode="r"))
+        self.price_columns = [np.asarray(np.load(os.path.join(path, f"price_{i}.npy"), mmap_mode="r"))
+                              for i in range(len(self.payers))]
+
+    @staticmethod
+    def current_version(path=FEE_STORE_DIR):
+        """Name of the version directory in use, None before the first build"""
+        try:
+            with open(os.path.join(path, FEE_STORE_POINTER)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def compile(csv_path=FEE_SCHEDULE_FILE, path=FEE_STORE_DIR):
+        """Build a new version of the store for csv_path and make it current, returns its directory
+
+        Readers never see a missing or half written store: the version is complete before the CURRENT file is
+        atomically replaced to name it. Processes still using an older version keep their mapped files.
+        """
+        df = pd.read_csv(csv_path, dtype={"CPT": str})
+        df["CPT"] = df["CPT"].astype(str).str.strip()
+        df = df.drop_duplicates("CPT").sort_values("CPT", kind="stable")
+        payers = df.columns[df.columns.get_loc(FEE_RVU_COLUMN) + 1:].tolist()
+
+        os.makedirs(path, exist_ok=True)
+        build = tempfile.mkdtemp(prefix="v", dir=path)
+        np.save(os.path.join(build, "cpt.npy"), df["CPT"].str.encode("ascii", "replace").to_numpy(dtype=bytes))
+        np.save(os.path.join(build, "rvu.npy"), pd.to_numeric(df[FEE_RVU_COLUMN], errors="coerce").to_numpy(np.float64))
+        descriptions = [description.encode() for description in df["Description"].fillna("").astype(str)]
+        np.save(os.path.join(build, "description_offsets.npy"), np.cumsum([0] + [len(d) for d in descriptions]))
+        np.save(os.path.join(build, "descriptions.npy"), np.frombuffer(b"".join(descriptions) or b"\0", dtype=np.uint8))
+        for i, payer in enumerate(payers):
+            np.save(os.path.join(build, f"price_{i}.npy"), pd.to_numeric(df[payer], errors="coerce").to_numpy(np.float64))
+        with open(os.path.join(build, "meta.json"), "w") as f:
+            json.dump({"source": fee_source_signature(csv_path), "payers": payers, "rows": len(df)}, f)
+
+        previous = FeeSchedule.current_version(path)
+        with tempfile.NamedTemporaryFile("w", dir=path, prefix="pointer.", delete=False) as f:
+            f.write(os.path.basename(build))
+        os.replace(f.name, os.path.join(path, FEE_STORE_POINTER))
+        FeeSchedule.remove_old_versions(path, keep={os.path.basename(build), previous})
+        return build
+
+    @staticmethod
+    def remove_old_versions(path, keep):
+        """Delete versions other than keep (the new and the previous one)
+
+        A version is renamed before it is deleted. On Windows that fails while a process has its files mapped,
+        so it is left for a later build; elsewhere the mapped files stay readable until they are unmapped.
+        Unfinished builds are only removed once they are abandoned.
+        """
+        for name in os.listdir(path):
+            version = os.path.join(path, name)
+            if name in keep or not os.path.isdir(version):
+                continue
+            finished = os.path.exists(os.path.join(version, "meta.json"))
+            if not finished and time.time() - os.path.getmtime(version) < FEE_STORE_ABANDONED_SECONDS:
+                continue  # another process may still be writing it
+            try:
+                trash = tempfile.mkdtemp(prefix="old.", dir=path)
+                os.rmdir(trash)
+                os.rename(version, trash)
+            except OSError:
+                continue
+            shutil.rmtree(trash, ignore_errors=True)
+
+    @classmethod
+    def open(cls, csv_path=FEE_SCHEDULE_FILE, path=FEE_STORE_DIR):
+        """Open the current version of the store, compiling a new one when there is none or the CSV changed"""
+        version = cls.current_version(path)
+        try:
+            with open(os.path.join(path, version, "meta.json")) as f:
+                current = json.load(f)["source"] == fee_source_signature(csv_path)
+        except (TypeError, OSError, ValueError, KeyError):
+            current = False
+        return cls(os.path.join(path, version) if current else cls.compile(csv_path, path))
+
+    def prices(self, payer):
+        """The payer's price column"""
+        return self.price_columns[self.payer_index[payer]]
+
+    def rows(self, codes):
+        """Row of each code, -1 for codes not in the schedule"""
+        keys = np.array([code.encode("ascii", "replace") for code in codes], dtype=bytes)
+        rows = np.searchsorted(self.codes, keys)
+        found = rows < len(self.codes)
+        found[found] = self.codes[rows[found]] == keys[found]
+        return np.where(found, rows, -1)
+
+    def unknown(self, codes):
+        return [code for code, row in zip(codes, self.rows(codes)) if row < 0]
+
+    def description(self, row):
+        return self.descriptions[self.description_offsets[row]:self.description_offsets[row + 1]].tobytes().decode()
+
+    def lookup(self, codes, payer):
+        """(code, description, price, RVU) for each code at the payer's prices, KeyError for an unknown code"""
+        rows = self.rows(codes)
+        if (rows < 0).any():
+            raise KeyError(self.unknown(codes))
+        prices = self.prices(payer)[rows].tolist()
+        return [(code, self.description(row), price, rvu)
+                for code, row, price, rvu in zip(codes, rows.tolist(), prices, self.rvus[rows].tolist())]
+
+
+fee_schedule = None
+
+
+def get_fee_schedule():
+    """Open the fee schedule store once per process, and again after the CSV changes"""
+    global fee_schedule
+    if fee_schedule is None or fee_schedule.meta["source"] != fee_source_signature(FEE_SCHEDULE_FILE):
+        fee_schedule = FeeSchedule.open()
+    return fee_schedule
+
+
+app.on_startup(get_fee_schedule)
+
+
+def split_cpt_modifiers(line):
+    """CPT code and modifiers of an entered line (20610-59, 20610 59 RT), ValueError when a token is not a modifier"""
+    code, *modifiers = [part for part in re.split(r"[\s,\-]+", line.strip().upper()) if part]
+    invalid = [modifier for modifier in modifiers if not CPT_MODIFIER_PATTERN.fullmatch(modifier)]
+    if invalid:
+        raise ValueError(f"{line.strip()}: {', '.join(invalid)} is not a modifier")
+    return code, tuple(modifiers)
+
+
+def multiple_procedure_factors(claims, rvus, costs, exempt, ladders):
+    """Fraction of the fee paid on each claim line
+
+    Within a claim the lines that are not exempt are ranked by RVU (then fee) from the highest and paid at
+    that step of their ladder, ladders has one row per line and its last step repeats for lower ranks.
+    Exempt lines are paid in full.
+    """
+    claims = np.asarray(claims)
+    exempt = np.asarray(exempt, dtype=bool)
+    if not len(claims):
+        return np.ones(0)
+    order = np.lexsort((-np.asarray(costs, dtype=np.float64), -np.asarray(rvus, dtype=np.float64), exempt, claims))
+    ranked = claims[order]
+    starts = np.r_[True, ranked[1:] != ranked[:-1]]
+    rank = np.arange(len(order)) - np.maximum.accumulate(np.where(starts, np.arange(len(order)), 0))
+    factors = np.empty(len(order))
+    steps = np.minimum(rank, ladders.shape[1] - 1)
+    factors[order] = np.where(exempt[order], 1.0, ladders[order, steps])
+    return factors
+
+
+class PaymentReductions:
+    """Multiple procedure payment reduction ladders and exemptions per payer, applied to whole batches of claims"""
+    def __init__(self, rules=None):
+        rules = rules or {}
+        self.default = {**MPPR_DEFAULT_RULES, **rules.get("default", {})}
+        self.payer_rules = {payer: {**self.default, **payer_rules} for payer, payer_rules in rules.get("payers", {}).items()}
+        for payer, payer_rules in [("default", self.default), *self.payer_rules.items()]:
+            if not payer_rules["ladder"]:
+                raise ValueError(f"Empty payment reduction ladder for {payer}")
+
+    @classmethod
+    def from_file(cls, path=PAYMENT_REDUCTIONS_FILE):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def rules(self, payer):
+        return self.payer_rules.get(payer, self.default)
+
+    def factors(self, claims, payers, codes, modifiers, rvus, costs):
+        """Fraction of the fee paid on each line of a batch, lines are grouped into claims by claim key"""
+        claim_ids = pd.factorize(np.asarray(claims))[0]
+        payer_ids, names = pd.factorize(pd.Series(payers, dtype=object))
+        rules = [self.rules(name) for name in names]
+        steps = max((len(payer_rules["ladder"]) for payer_rules in rules), default=1)
+        ladders = np.ones((len(rules), steps))
+        for i, payer_rules in enumerate(rules):
+            ladders[i] = np.pad(np.asarray(payer_rules["ladder"], dtype=np.float64), (0, steps - len(payer_rules["ladder"])), mode="edge")
+
+        # Exempt codes per payer, then modifiers as flat (line, modifier) pairs so any listed modifier exempts its line
+        codes = np.asarray(codes, dtype=object)
+        lines = np.repeat(np.arange(len(codes)), [len(line_modifiers) for line_modifiers in modifiers])
+        flat_modifiers = np.array([modifier for line_modifiers in modifiers for modifier in line_modifiers], dtype=object)
+        exempt = np.zeros(len(codes), dtype=bool)
+        for i, payer_rules in enumerate(rules):
+            payer_lines = payer_ids == i
+            exempt |= payer_lines & np.isin(codes, payer_rules["exempt_codes"])
+            hits = lines[np.isin(flat_modifiers, payer_rules["exempt_modifiers"]) & payer_lines[lines]]
+            exempt[hits] = True
+        return multiple_procedure_factors(claim_ids, rvus, costs, exempt, ladders[payer_ids])
+
+
+payment_reductions = None
+
+
+def get_payment_reductions():
+    """Load the payment reduction rules once per process, the default ladder when the file is missing"""
+    global payment_reductions
+    if payment_reductions is None:
+        if os.path.exists(PAYMENT_REDUCTIONS_FILE):
+            payment_reductions = PaymentReductions.from_file()
+        else:
+            payment_reductions = PaymentReductions()
+    return payment_reductions
+
+
+app.on_startup(get_payment_reductions)
+
+
+def round_cents(values):
+    """round(value, 2) on arrays: whole cents, with values within rounding error of a half cent left to Python
+
+    x * 100 can round onto or off a half cent, so only those values need round()'s exact decimal tie breaking.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    scaled = values * 100
+    rounded = np.asarray(np.rint(scaled) / 100)
+    near_tie = np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) <= 4 * np.spacing(np.abs(scaled))
+    if near_tie.any():
+        rounded[near_tie] = [round(value, 2) for value in values[near_tie].tolist()]
+    return rounded
+
+
+def payment_split(cost, deductible, met_deductible, out_of_pocket, met_out_of_pocket, insurance_percent):
+    """Patient and insurance shares of the estimated cost, for floats or whole arrays of encounters"""
+    # Step 1: Patient is fully responsible up to the deductible amount
+    in_deductible = met_deductible < deductible
+    within = cost <= deductible - met_deductible
+    patient_payment = np.where(in_deductible, round_cents(np.where(within, cost, deductible - met_deductible)), 0.0)
+    met_deductible = np.where(in_deductible, np.where(within, met_deductible + round_cents(cost), deductible), met_deductible)
+
+    # Step 2: Insurance covers a percentage until out-of-pocket maximum is met
+    coinsured = (met_deductible >= deductible) & (met_out_of_pocket < out_of_pocket)
+    remaining_cost = cost - patient_payment
+    remaining_out_of_pocket = out_of_pocket - met_out_of_pocket
+    patient_percent_payment = round_cents(np.minimum(remaining_cost, remaining_out_of_pocket) * (1 - insurance_percent / 100))
+    insurance_payment = np.where(
+        coinsured, round_cents(np.minimum(remaining_cost - patient_percent_payment, remaining_out_of_pocket)), 0.0
+    )
+    patient_payment = patient_payment + np.where(coinsured, patient_percent_payment, 0.0)
+
+    # Insurance takes any remaining amount after step 2
+    remaining_after_step_2 = cost - patient_payment - insurance_payment
+    insurance_payment = insurance_payment + np.where(coinsured & (remaining_after_step_2 > 0), round_cents(remaining_after_step_2), 0.0)
+
+    # Step 3: Insurance covers the full remaining cost after out-of-pocket maximum is met
+    insurance_payment = insurance_payment + np.where(met_out_of_pocket >= out_of_pocket, round_cents(cost - patient_payment), 0.0)
+    return patient_payment, insurance_payment
+
+
+def read_encounters(body, content_type):
+    """Encounter table from a CSV body or a JSON list (or {"encounters": [...]}), codes as lists of entered lines"""
+    if "csv" in content_type:
+        df = pd.read_csv(io.BytesIO(body), dtype={"id": str, "payer": str, "codes": str}, keep_default_na=False, na_values=[""])
+    else:
+        payload = json.loads(body)
+        records = payload.get("encounters") if isinstance(payload, dict) else payload
+        if not isinstance(records, list):
+            raise ValueError("Expected a list of encounters")
+        not_objects = [str(i) for i, record in enumerate(records) if not isinstance(record, dict)]
+        if not_objects:
+            raise ValueError(f"Expected encounter objects, got other values at item(s) {', '.join(not_objects[:10])}")
+        df = pd.DataFrame.from_records(records) if records else pd.DataFrame(columns=["payer", "codes"])
+    missing = [column for column in ("payer", "codes") if column not in df.columns]
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(missing)}")
+    if "id" not in df.columns:
+        df["id"] = np.arange(len(df))
+    df["payer"] = df["payer"].fillna("").astype(str)
+    df["codes"] = [
+        codes if isinstance(codes, list) else re.split(r"[;|,\n]+", codes) if isinstance(codes, str) else []
+        for codes in df["codes"]
+    ]
+    for column in COST_BATCH_FIELDS:
+        df[column] = pd.to_numeric(df[column], errors="coerce") if column in df.columns else np.nan
+    return df.reset_index(drop=True)
+
+
+def estimate_encounters(df, fees, reductions):
+    """Reduced cost and patient/insurance split of every encounter, the cost estimator's math on whole columns"""
+    counts = [len(codes) for codes in df["codes"]]
+    entered = [str(line) for codes in df["codes"] for line in codes]
+    line_encounters = np.repeat(np.arange(len(df)), counts)
+    # A schedule repeats the same few hundred codes, so each distinct line is split once (None when invalid)
+    parsed = {}
+    for line in set(entered):
+        if line.strip():
+            try:
+                parsed[line] = split_cpt_modifiers(line)
+            except ValueError:
+                parsed[line] = None
+    valid = np.array([parsed.get(line) is not None for line in entered], dtype=bool)
+    invalid = np.array([line in parsed and parsed[line] is None for line in entered], dtype=bool)
+    encounters = line_encounters[valid]
+    entries = [parsed[line] for line, kept in zip(entered, valid) if kept]
+    codes = [code for code, _ in entries]
+    modifiers = [line_modifiers for _, line_modifiers in entries]
+
+    # Price every line at its encounter's payer, unknown codes and payers mark the encounter instead
+    payers = df["payer"].to_numpy(dtype=object)
+    line_payers = payers[encounters]
+    rows = fees.rows(codes)
+    costs = np.full(len(codes), np.nan)
+    for payer in pd.unique(line_payers):
+        if payer in fees.payer_index:
+            lines = (line_payers == payer) & (rows >= 0)
+            costs[lines] = fees.prices(payer)[rows[lines]]
+    rvus = np.where(rows >= 0, fees.rvus[np.maximum(rows, 0)], np.nan)
+    errors = pd.Series("", index=df.index)
+    unknown = pd.Series(np.asarray(codes, dtype=object)[rows < 0]).groupby(encounters[rows < 0]).agg(", ".join)
+    errors[unknown.index] = "Unknown CPT codes: " + unknown
+    invalid_lines = pd.Series(np.asarray(entered, dtype=object)[invalid]).groupby(line_encounters[invalid]).agg(" | ".join)
+    errors[invalid_lines.index] = "Not a CPT code with modifiers: " + invalid_lines
+    errors[~df["payer"].isin(fees.payer_index)] = "Unknown payer"
+    # Self pay encounters are billed in full, whatever insurance fields were sent with them
+    self_pay = df["payer"].map({payer: is_self_pay(payer) for payer in pd.unique(payers)}).to_numpy(dtype=bool)
+    insured = df["deductible"].notna().to_numpy() & ~self_pay
+    incomplete = insured & df[COST_BATCH_FIELDS].isna().any(axis=1).to_numpy()
+    errors[incomplete & (errors == "")] = "Incomplete insurance fields"
+    failed = (errors != "").to_numpy()
+
+    priced = ~failed[encounters]
+    factors = reductions.factors(encounters[priced], line_payers[priced], np.asarray(codes, dtype=object)[priced],
+                                 [m for m, p in zip(modifiers, priced) if p], rvus[priced], costs[priced])
+    cost = np.bincount(encounters[priced], weights=costs[priced] * factors, minlength=len(df))
+
+    fields = [df[column].to_numpy(dtype=np.float64) for column in COST_BATCH_FIELDS]
+    patient_payment, insurance_payment = payment_split(cost, *fields)
+    patient_payment = np.where(insured, patient_payment, cost)
+    insurance_payment = np.where(insured, insurance_payment, np.nan)
+    return pd.DataFrame({
+        "id": df["id"],
+        "payer": df["payer"],
+        "cost": np.where(failed, np.nan, cost).round(2),
+        "patient_payment": np.where(failed, np.nan, patient_payment).round(2),
+        "insurance_payment": np.where(failed, np.nan, insurance_payment).round(2),
+        "error": errors,
+    })
+
+
+def stream_estimates(results, as_csv, chunk_rows=COST_BATCH_CHUNK_ROWS):
+    """Serialize the results COST_BATCH_CHUNK_ROWS rows at a time, as CSV or one JSON array"""
+    if as_csv:
+        for start in range(0, max(len(results), 1), chunk_rows):
+            yield results.iloc[start:start + chunk_rows].to_csv(index=False, header=start == 0)
+        return
+    yield "["
+    for start in range(0, len(results), chunk_rows):
+        yield ("," if start else "") + results.iloc[start:start + chunk_rows].to_json(orient="records")[1:-1]
+    yield "]"
+
+
+@app.post("/api/cost/estimate")
+async def cost_estimate(request: Request, fmt: Optional[str] = Query(None, alias="format")):
+    """Batch cost estimates for a JSON or CSV list of encounters, streamed back as JSON or CSV"""
+    content_type = request.headers.get("content-type", "")
+    body = await request.body()
+    try:
+        df = await run.io_bound(read_encounters, body, content_type)
+        results = await run.io_bound(estimate_encounters, df, get_fee_schedule(), get_payment_reductions())
+    except (ValueError, pd.errors.ParserError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    as_csv = fmt == "csv" if fmt else "csv" in content_type
+    return StreamingResponse(stream_estimates(results, as_csv), media_type="text/csv" if as_csv else "application/json")
+
+
 class CostEstimator:
-    def __init__(self):
-        self.fee_df = pd.read_csv("fee_schedule.csv")
-        self.ins_list = self.fee_df.columns[4:].tolist()
+    def __init__(self, provider=None):
+        self.ins_list = get_fee_schedule().payers
+        self.provider = provider
         
         # Initialize UI components
+        self.favorites = None
         self.codes = None
         self.ins_choice = None
         self.codes_ordered = None
@@ -387,8 +3332,25 @@ class CostEstimator:
             ui.notify("Please select an insurance option first.", position="center", type="negative")
             return
 
-        s_code = self.codes.value.split("\n")
-        unknown_codes = [code for code in s_code if code not in self.fee_df["CPT"].values]
+        entries, invalid_lines = [], []
+        for line in self.codes.value.split("\n"):
+            if line.strip():
+                try:
+                    entries.append(split_cpt_modifiers(line))
+                except ValueError:
+                    invalid_lines.append(line.strip())
+        if invalid_lines:
+            ui.notify(
+                f"Enter one CPT code per line, optionally with modifiers (20610-59): {', '.join(invalid_lines)}",
+                position="center",
+                type="negative",
+            )
+            return
+        s_code = [code for code, _ in entries]
+        modifiers = [line_modifiers for _, line_modifiers in entries]
+        # The current schedule for every estimate, the page may have been open across a fee schedule update
+        fees = get_fee_schedule()
+        unknown_codes = fees.unknown(s_code)
 
         if unknown_codes:
             ui.notify(
@@ -398,57 +3360,27 @@ class CostEstimator:
             )
             return
 
-        self.INScontainer.remove(0)
         pt_ins = self.ins_choice.value
+        if pt_ins not in fees.payer_index:
+            ui.notify(f"{pt_ins} is no longer in the fee schedule, reload the page.", position="center",
+                      type="negative")
+            return
+        self.INScontainer.remove(0)
 
-        # Initialize the lists for the dataframe
-        s_code_list = []
-        desc_list = []
-        cost_list = []
-        rvu_list = []
-
-        for code in s_code:
-            try:
-                # Get the data for the current code
-                code_df = self.fee_df.loc[self.fee_df["CPT"] == code]
-                if code_df.empty:
-                    raise ValueError(f"No data found for CPT code: {code}")
-
-                cost = code_df[pt_ins].astype(float).values[0]
-                rvu = code_df["Total RVU Office"].astype(float).values[0]
-                desc = code_df["Description"].values[0]
-
-                # Add the data to the respective lists
-                s_code_list.append(code)
-                desc_list.append(desc)
-                cost_list.append(cost)
-                rvu_list.append(rvu)
-            except Exception as e:
-                ui.notify(f"Error processing code {code}: {str(e)}", position="center", type="negative")
-                return
-
-        # Create the dataframe
+        # Look up every code in the shared fee schedule index
         cost_df = pd.DataFrame(
-            data={
-                "Codes": s_code_list,
-                "Description": desc_list,
-                "Cost": cost_list,
-                "RVU": rvu_list,
-            }
+            fees.lookup(s_code, pt_ins),
+            columns=["Codes", "Description", "Cost", "RVU"],
         )
-        # Reset the index of the cost_df dataframe
-        cost_df = cost_df.reset_index(drop=True)
-
-        # Convert the 'RVU' column to numeric values
-        cost_df["RVU"] = pd.to_numeric(cost_df["RVU"], errors='coerce')
+        cost_df["Codes"] = ["-".join((code,) + line_modifiers) for code, line_modifiers in zip(s_code, modifiers)]
 
-        # Find the maximum RVU
-        max_rvu = cost_df["RVU"].max()
-
-        # Create a new column 'Adjusted Cost'
-        cost_df["Adj Cost"] = cost_df.apply(
-            lambda row: row["Cost"] * 0.5 if row["RVU"] == max_rvu else row["Cost"], axis=1
+        # Multiple procedure reduction: highest RVU line in full, the rest down the payer's ladder
+        factors = get_payment_reductions().factors(
+            [0] * len(cost_df), [pt_ins] * len(cost_df), s_code, modifiers,
+            cost_df["RVU"].to_numpy(), cost_df["Cost"].to_numpy(),
         )
+        cost_df["Paid %"] = (factors * 100).round(1)
+        cost_df["Adj Cost"] = cost_df["Cost"] * factors
 
         with self.INScontainer.classes("w-full items-center").style("align-items: center;"):
             self.Cresults = ui.aggrid.from_pandas(cost_df).style("width:80%; min-height: 500px")
@@ -457,6 +3389,7 @@ class CostEstimator:
         self.Cresults.options["columnDefs"][2]["width"] = "50px"
         self.Cresults.options["columnDefs"][3]["width"] = "50px"
         self.Cresults.options["columnDefs"][4]["width"] = "50px"
+        self.Cresults.options["columnDefs"][5]["width"] = "50px"
 
         # Get estimated cost
         self.est_cost = sum(cost_df["Adj Cost"])
@@ -476,8 +3409,24 @@ class CostEstimator:
         self.ipatient_payment .value = pt_out
         self.iinsurance_payment.value = ins_out
 
+        code_usage.record(self.provider_name(), "cpt", s_code)
+        self.show_favorites()
+
         ui.notify("Cost estimation completed successfully.", position="center", type="positive")
 
+    def provider_name(self):
+        return self.provider.value if self.provider is not None else None
+
+    def show_favorites(self):
+        # Quick pick chips for the provider's most used CPT codes, clicking one adds it to the codes list
+        self.favorites.clear()
+        with self.favorites:
+            for code in code_usage.top(self.provider_name(), "cpt"):
+                ui.chip(code, on_click=lambda code=code: self.pick_favorite(code)).props("outline")
+
+    def pick_favorite(self, code):
+        self.codes.value = "\n".join(filter(None, [self.codes.value, code]))
+
     def cost_reset(self):
         self.INScontainer.remove(0)
         self.codes_ordered.value = ""
@@ -494,7 +3443,7 @@ class CostEstimator:
             self.Cresults = ui.aggrid({}).style("width:80%; min-height: 500px")
 
     def calculate_payment(self):
-        if self.ins_choice.value == "Self Pay" or self.ideductible.value == "":
+        if is_self_pay(self.ins_choice.value) or self.ideductible.value == "":
             pt_out = f"${self.est_cost:.2f}"
             ins_out = "N/A"
             return pt_out, ins_out
@@ -507,42 +3456,10 @@ class CostEstimator:
         met_out_of_pocket_amount = float(self.imet_out_of_pocket_amount.value)
         insurance_percent = float(self.iinsurance_percent.value)
 
-        # Initialize
-        patient_payment = 0
-        insurance_payment = 0
-
-        # Step 1: Patient is fully responsible up to the deductible amount
-        if met_deductible_amount < deductible:
-            remaining_deductible_amount = deductible - met_deductible_amount
-            if cost_before_insurance <= remaining_deductible_amount:
-                patient_payment += round(cost_before_insurance, 2)
-                met_deductible_amount += round(cost_before_insurance, 2)
-            else:
-                patient_payment += round(remaining_deductible_amount, 2)
-                met_deductible_amount = deductible
-
-        # Step 2: Insurance covers a percentage until out-of-pocket maximum is met
-        if met_deductible_amount >= deductible and met_out_of_pocket_amount < out_of_pocket:
-            remaining_cost = cost_before_insurance - patient_payment
-            patient_percent_payment = round(
-                min(remaining_cost, out_of_pocket - met_out_of_pocket_amount) * (1 - insurance_percent / 100),
-                2,
-            )
-            patient_payment += patient_percent_payment
-            insurance_payment += round(
-                min(remaining_cost - patient_percent_payment, out_of_pocket - met_out_of_pocket_amount),
-                2,
-            )
-
-            # Check if there's a remaining amount after step 2
-            remaining_after_step_2 = cost_before_insurance - patient_payment - insurance_payment
-            if remaining_after_step_2 > 0:
-                # Proceed to Step 3
-                insurance_payment += round(remaining_after_step_2, 2)
-
-        # Step 3: Insurance covers the full remaining cost after out-of-pocket maximum is met
-        if met_out_of_pocket_amount >= out_of_pocket:
-            insurance_payment += round(cost_before_insurance - patient_payment, 2)
+        patient_payment, insurance_payment = payment_split(
+            cost_before_insurance, deductible, met_deductible_amount, out_of_pocket, met_out_of_pocket_amount,
+            insurance_percent,
+        )
 
         # Output
         pt_out = f"${patient_payment:.2f}"
@@ -555,6 +3472,10 @@ class CostEstimator:
             ui.separator().style('width: 85%')
             with ui.row():
                 self.ins_choice = ui.select(self.ins_list, with_input=True, label="Insurance").style("width: 40em")
+            self.favorites = ui.row().classes("items-center")
+            self.show_favorites()
+            if self.provider is not None:
+                self.provider.on_value_change(self.show_favorites)
             with ui.grid(columns=2).style("align-items: center;"):
                 self.codes = ui.textarea("Codes").style("width: 275px").props("clearable")
                 self.codes_ordered = ui.textarea("Ordered Codes & Cost").style("width: 275px")
@@ -2441,6 +5362,10 @@ def main_page():
         ui.button(on_click=lambda: left_drawer.toggle(),
                 icon='menu').props('flat color=white size=18px').style('padding-left: 25px;')
         ui.space()
+        # Provider whose most used codes are suggested in the ICD and cost tabs, defaults to the last active one
+        providers = code_usage.providers()
+        provider = ui.select(providers, label="Provider", value=providers[0] if providers else None, with_input=True,
+                             new_value_mode="add-unique").props('dense dark').style('width: 200px; padding-right: 25px;')
         ui.label('Clinical Tool Hub').style('font-size: 25px; font-weight: bold; padding-right: 25px;')
     with ui.left_drawer().classes('w-full').props('width=235').style('background-color: #121212; border-right: 1px solid #606060;') as left_drawer:
         # Icons from google icons
@@ -2460,7 +5385,7 @@ def main_page():
     # Transitions ex: jump-up, jump-left, etc. fade, scale
     with ui.tab_panels(tabs, value=icd_look_tab).classes("w-full h-full").props('transition-prev=jump-up transition-next=jump-down'):
         with ui.tab_panel(icd_look_tab).classes('w-full h-full'):
-            icd_lookup_instance = ICDLookup()
+            icd_lookup_instance = ICDLookup(provider)
             icd_lookup_instance.ICD_UI_SetUp()
 
         with ui.tab_panel(ins_glu_tab).classes('w-full h-full'):
@@ -2472,7 +5397,7 @@ def main_page():
             wound_tracker_instance.woundtracker_UI_Setup()
 
         with ui.tab_panel(cost_est_tab).classes('w-full h-full'):
-            cost_estimator_instance = CostEstimator()
+            cost_estimator_instance = CostEstimator(provider)
             cost_estimator_instance.cost_estimator_UI_Setup()
         
         with ui.tab_panel(npi_look_tab).classes('w-full h-full'):
@@ -2555,4 +5480,5 @@ app.on_startup(lambda: print(
     ))
 # Base64 image for site icon
 fav_icon = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAABgAAAAYCAYAAADgdz34AAAEtGlUWHRYTUw6Y29tLmFkb2JlLnhtcAAAAAAAPD94cGFja2V0IGJlZ2luPSLvu78iIGlkPSJXNU0wTXBDZWhpSHpyZVN6TlRjemtjOWQiPz4KPHg6eG1wbWV0YSB4bWxuczp4PSJhZG9iZTpuczptZXRhLyIgeDp4bXB0az0iWE1QIENvcmUgNS41LjAiPgogPHJkZjpSREYgeG1sbnM6cmRmPSJodHRwOi8vd3d3LnczLm9yZy8xOTk5LzAyLzIyLXJkZi1zeW50YXgtbnMjIj4KICA8cmRmOkRlc2NyaXB0aW9uIHJkZjphYm91dD0iIgogICAgeG1sbnM6dGlmZj0iaHR0cDovL25zLmFkb2JlLmNvbS90aWZmLzEuMC8iCiAgICB4bWxuczpleGlmPSJodHRwOi8vbnMuYWRvYmUuY29tL2V4aWYvMS4wLyIKICAgIHhtbG5zOnBob3Rvc2hvcD0iaHR0cDovL25zLmFkb2JlLmNvbS9waG90b3Nob3AvMS4wLyIKICAgIHhtbG5zOnhtcD0iaHR0cDovL25zLmFkb2JlLmNvbS94YXAvMS4wLyIKICAgIHhtbG5zOnhtcE1NPSJodHRwOi8vbnMuYWRvYmUuY29tL3hhcC8xLjAvbW0vIgogICAgeG1sbnM6c3RFdnQ9Imh0dHA6Ly9ucy5hZG9iZS5jb20veGFwLzEuMC9zVHlwZS9SZXNvdXJjZUV2ZW50IyIKICAgdGlmZjpJbWFnZUxlbmd0aD0iMjQiCiAgIHRpZmY6SW1hZ2VXaWR0aD0iMjQiCiAgIHRpZmY6UmVzb2x1dGlvblVuaXQ9IjIiCiAgIHRpZmY6WFJlc29sdXRpb249IjcyLzEiCiAgIHRpZmY6WVJlc29sdXRpb249IjcyLzEiCiAgIGV4aWY6UGl4ZWxYRGltZW5zaW9uPSIyNCIKICAgZXhpZjpQaXhlbFlEaW1lbnNpb249IjI0IgogICBleGlmOkNvbG9yU3BhY2U9IjEiCiAgIHBob3Rvc2hvcDpDb2xvck1vZGU9IjMiCiAgIHBob3Rvc2hvcDpJQ0NQcm9maWxlPSJzUkdCIElFQzYxOTY2LTIuMSIKICAgeG1wOk1vZGlmeURhdGU9IjIwMjQtMDItMDZUMTA6NTU6MjAtMDc6MDAiCiAgIHhtcDpNZXRhZGF0YURhdGU9IjIwMjQtMDItMDZUMTA6NTU6MjAtMDc6MDAiPgogICA8eG1wTU06SGlzdG9yeT4KICAgIDxyZGY6U2VxPgogICAgIDxyZGY6bGkKICAgICAgc3RFdnQ6YWN0aW9uPSJwcm9kdWNlZCIKICAgICAgc3RFdnQ6c29mdHdhcmVBZ2VudD0iQWZmaW5pdHkgRGVzaWduZXIgMiAyLjAuMyIKICAgICAgc3RFdnQ6d2hlbj0iMjAyNC0wMi0wNlQxMDo1NToyMC0wNzowMCIvPgogICAgPC9yZGY6U2VxPgogICA8L3htcE1NOkhpc3Rvcnk+CiAgPC9yZGY6RGVzY3JpcHRpb24+CiA8L3JkZjpSREY+CjwveDp4bXBtZXRhPgo8P3hwYWNrZXQgZW5kPSJyIj8+VeB+KAAAAX9pQ0NQc1JHQiBJRUM2MTk2Ni0yLjEAACiRdZHPK0RRFMc/ZjBihFhYWLyEFcLUxEaZSUNJGqMMNm+eNzNqfrzee5Jsle0UJTZ+LfgL2CprpYiUrK2JDXrOM2okc27nns/93ntO954LnlhGy1qVfZDN2WY0ElJm43OK7wkP1TQRJKBqljEyNTVBWXu7pcKN1z1urfLn/rW6Rd3SoKJGeFgzTFt4THhixTZc3hJu0dLqovCJcLcpFxS+cfVEkZ9cThX5w2UzFg2Dp1FYSf3ixC/W0mZWWF5ORzazrP3cx32JX8/NTEtsF2/DIkqEEArjjBKWnvQzJHOQHgbolRVl8vu+8yfJS64ms8EqJkukSGPTLeqyVNclJkXXZWRYdfv/t69WMjBQrO4PQdWj47x0gm8TPguO837gOJ+H4H2A81wpP78Pg6+iF0paxx40rMPpRUlLbMPZBrTeG6qpfktecU8yCc/HUB+H5iuonS/27GefozuIrclXXcLOLnTJ+YaFL5niZ/3Y3/GwAAAACXBIWXMAAAsTAAALEwEAmpwYAAAAsElEQVRIie2SwQ3DIAxFf6oMkt4Ygz24NBMwQpIRmCC9sAdjcMwmzcWViFWCk6rKobwLsjG2vz7Aj2mkhdbHAcCDwqczapK8ux1oPlLYARgpV2SjwPqoAczU5BM9nXPmfgHQO6PCO9GygmGnueS+o+H33AANAM4osTcp1scXX0DkwTdwBRtooyJ7iq9VcNaLlOpBkT/2QKquelCEKwgAtPT/ZwhpwBVMvOAgC/WoyFkByGYvOegQWMwAAAAASUVORK5CYII="
-ui.run(dark=True, title="Work Tool Hub", favicon=fav_icon, show_welcome_message=False)
+if __name__ in {"__main__", "__mp_main__"}:
+    ui.run(dark=True, title="Work Tool Hub", favicon=fav_icon, show_welcome_message=False)